@@ -0,0 +1,348 @@
+import asyncio
+import logging
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from collections import Counter, deque
+from collections.abc import Awaitable, Callable
+from typing import Optional
+
+from metrics import REGISTRY
+
+logger = logging.getLogger("voicerag")
+
+ADMISSION_SECONDS = REGISTRY.histogram("rtmt_admission_wait_seconds", "Time sessions waited for an upstream slot", ("outcome",),
+                                       buckets=(0.01, 0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300))
+
+class AdmissionRejected(Exception):
+    """The session can't get an upstream slot: the queue is full or it waited too long"""
+
+class Ticket:
+    """A session's place in the admission queue, and its upstream slot once admitted"""
+    __slots__ = ("classroom", "admitted", "slot", "position", "enqueued_at", "released")
+
+    def __init__(self, classroom: Optional[str]):
+        self.classroom = classroom
+        self.admitted: asyncio.Future = asyncio.get_running_loop().create_future()
+        self.slot: Optional[int] = None
+        self.position = 0
+        self.enqueued_at = time.monotonic()
+        self.released = False
+
+class SlotStore:
+    """Counts the upstream sessions AdmissionController has admitted"""
+    # Seconds between retries for waiting sessions when slots are also freed outside this process, None if they aren't
+    poll_interval: Optional[float] = None
+    # Seconds between calls to renew, None if the store doesn't need them
+    renew_interval: Optional[float] = None
+    # Whether calls do I/O, AdmissionController then makes them in a worker thread (all but count)
+    blocking = False
+
+    def acquire(self, classroom: Optional[str], max_sessions: int, classroom_quota: int) -> Optional[int]:
+        """Take a slot if fewer than max_sessions are taken and the classroom is under its quota, returns its id"""
+        raise NotImplementedError
+
+    def release(self, slot: int, classroom: Optional[str]) -> None:
+        raise NotImplementedError
+
+    def count(self) -> int:
+        """Slots taken, never blocks: a blocking store answers as of its last call"""
+        raise NotImplementedError
+
+    def renew(self) -> None:
+        pass
+
+    def close(self) -> None:
+        pass
+
+class LocalSlotStore(SlotStore):
+    """Slots of this process only"""
+
+    def __init__(self):
+        self.active = 0
+        self.active_by_classroom: Counter[str] = Counter()
+
+    def acquire(self, classroom: Optional[str], max_sessions: int, classroom_quota: int) -> Optional[int]:
+        if self.active >= max_sessions:
+            return None
+        if classroom is not None:
+            if classroom_quota and self.active_by_classroom[classroom] >= classroom_quota:
+                return None
+            self.active_by_classroom[classroom] += 1
+        self.active += 1
+        return self.active
+
+    def release(self, slot: int, classroom: Optional[str]) -> None:
+        self.active -= 1
+        if classroom is not None:
+            self.active_by_classroom[classroom] -= 1
+            if self.active_by_classroom[classroom] <= 0:
+                del self.active_by_classroom[classroom]
+
+    def count(self) -> int:
+        return self.active
+
+class SqliteSlotStore(SlotStore):
+    """Slots shared by the worker processes on the host through a single SQLite file.
+
+    Each slot is a row leased by the process that took it. The process renews its leases every lease / 3 seconds,
+    so the slots of a worker that died are taken back after at most lease seconds. Slots freed by other processes
+    aren't signalled, waiting sessions retry every poll_interval seconds.
+    """
+    blocking = True
+
+    def __init__(self, path: str, lease: float = 30, poll_interval: float = 0.5):
+        self.path = path
+        self.lease = lease
+        self.poll_interval = poll_interval
+        self.renew_interval = lease / 3
+        self.owner = f"{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        self.held = 0
+        self._count = 0
+        # Calls come from worker threads, the lease renewal can overlap with the others
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, isolation_level=None, check_same_thread=False, timeout=5)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS upstream_slots ("
+            "id INTEGER PRIMARY KEY, owner TEXT NOT NULL, classroom TEXT, expires_at REAL NOT NULL)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS upstream_slots_classroom ON upstream_slots (classroom)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS upstream_slots_owner ON upstream_slots (owner)")
+
+    def acquire(self, classroom: Optional[str], max_sessions: int, classroom_quota: int) -> Optional[int]:
+        with self._lock:
+            return self._acquire_locked(classroom, max_sessions, classroom_quota)
+
+    def _acquire_locked(self, classroom: Optional[str], max_sessions: int, classroom_quota: int) -> Optional[int]:
+        now = time.time()
+        # BEGIN IMMEDIATE takes the write lock up front, so two workers can't both see the last free slot
+        try:
+            self._db.execute("BEGIN IMMEDIATE")
+        except sqlite3.OperationalError as e:
+            logger.warning("Could not take an upstream slot: %s", str(e))
+            return None
+        try:
+            self._db.execute("DELETE FROM upstream_slots WHERE expires_at < ?", (now,))
+            slot = None
+            self._count = self._db.execute("SELECT count(*) FROM upstream_slots").fetchone()[0]
+            if self._count < max_sessions and (
+                    not classroom_quota or classroom is None or self._db.execute(
+                        "SELECT count(*) FROM upstream_slots WHERE classroom = ?", (classroom,)).fetchone()[0] < classroom_quota):
+                slot = self._db.execute("INSERT INTO upstream_slots (owner, classroom, expires_at) VALUES (?, ?, ?)",
+                                        (self.owner, classroom, now + self.lease)).lastrowid
+                self._count += 1
+            self._db.execute("COMMIT")
+        except BaseException:
+            self._db.execute("ROLLBACK")
+            raise
+        if slot is not None:
+            self.held += 1
+        return slot
+
+    def renew(self) -> None:
+        with self._lock:
+            try:
+                if self.held:
+                    self._db.execute("UPDATE upstream_slots SET expires_at = ? WHERE owner = ?", (time.time() + self.lease, self.owner))
+                self._count = self._db.execute("SELECT count(*) FROM upstream_slots WHERE expires_at >= ?", (time.time(),)).fetchone()[0]
+            except sqlite3.Error as e:
+                logger.warning("Could not renew upstream slot leases: %s", str(e))
+
+    def release(self, slot: int, classroom: Optional[str]) -> None:
+        with self._lock:
+            self.held -= 1
+            self._db.execute("DELETE FROM upstream_slots WHERE id = ?", (slot,))
+            self._count = max(self._count - 1, 0)
+
+    def count(self) -> int:
+        return self._count
+
+    def close(self) -> None:
+        with self._lock:
+            self._db.execute("DELETE FROM upstream_slots WHERE owner = ?", (self.owner,))
+            self._db.close()
+
+class AdmissionController:
+    """Caps concurrent upstream realtime sessions, queuing the sessions over the cap in arrival order.
+
+    A classroom_quota also caps the upstream sessions of any one classroom; a waiting session whose classroom is
+    at its quota lets the ones behind it go first. When max_queue sessions are already waiting, new ones are
+    rejected immediately rather than queued, and queued sessions give up after max_wait seconds.
+
+    Slots are counted in this process unless another slot store is given. With a SqliteSlotStore, the cap and
+    quotas hold across worker processes, and each worker queues its own sessions.
+    """
+    # Seconds before a dispatch pass retries slots the store failed to give back
+    release_retry_interval: float = 1
+
+    def __init__(self, max_sessions: int, max_queue: int = 200, max_wait: float = 120, classroom_quota: int = 0,
+                 position_interval: float = 1, slots: Optional[SlotStore] = None):
+        self.max_sessions = max_sessions
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+        self.classroom_quota = classroom_quota
+        self.position_interval = position_interval
+        self.slots = slots or LocalSlotStore()
+        self._queue: deque[Ticket] = deque()
+        # Slots of finished sessions, given back by the next dispatch pass
+        self._releases: list[tuple[int, Optional[str]]] = []
+        self._dispatcher: Optional[asyncio.Task] = None
+        self._pass_done: Optional[asyncio.Future] = None
+        self._renewer: Optional[asyncio.Task] = None
+        self._poll: Optional[asyncio.TimerHandle] = None
+        self.rejected = 0
+        self.timed_out = 0
+
+    def __len__(self) -> int:
+        """Sessions waiting"""
+        return len(self._queue)
+
+    async def _slot_call(self, method: Callable, *args):
+        if self.slots.blocking:
+            return await asyncio.to_thread(method, *args)
+        return method(*args)
+
+    def _dispatch(self) -> asyncio.Future:
+        """Ask for a dispatch pass, returns a future done once a pass started after this call has finished.
+
+        Passes run one at a time in a background task, so slot store calls never overlap and never block the loop.
+        """
+        if self._pass_done is None:
+            self._pass_done = asyncio.get_running_loop().create_future()
+            if self._dispatcher is None or self._dispatcher.done():
+                self._dispatcher = asyncio.create_task(self._run_dispatch())
+        return self._pass_done
+
+    async def _run_dispatch(self):
+        while self._pass_done is not None:
+            done, self._pass_done = self._pass_done, None
+            try:
+                await self._dispatch_pass()
+            except Exception as e:
+                logger.error("Admitting sessions failed: %s", str(e))
+            finally:
+                if not done.done():
+                    done.set_result(None)
+
+    async def _dispatch_pass(self):
+        """Give back released slots, admit waiting sessions in arrival order while there are free ones, then
+        renumber the rest"""
+        releases, self._releases = self._releases, []
+        for slot, classroom in releases:
+            await self._give_back(slot, classroom)
+        full = False
+        for ticket in list(self._queue):
+            if full:
+                break
+            if ticket.released:
+                continue
+            slot = await self._slot_call(self.slots.acquire, ticket.classroom, self.max_sessions, self.classroom_quota)
+            if slot is None:
+                # Without a classroom quota in the way, no slot is free for the sessions behind it either
+                full = not self.classroom_quota or ticket.classroom is None
+            elif ticket.released:
+                # Gave up while the slot was being taken
+                await self._give_back(slot, ticket.classroom)
+            else:
+                ticket.slot = slot
+                ticket.position = 0
+                ticket.admitted.set_result(None)
+        self._queue = deque(ticket for ticket in self._queue if ticket.slot is None and not ticket.released)
+        for i, ticket in enumerate(self._queue):
+            ticket.position = i + 1
+        if self._poll is None:
+            if self._releases:
+                self._poll = asyncio.get_running_loop().call_later(self.release_retry_interval, self._retry)
+            elif self._queue and self.slots.poll_interval is not None:
+                self._poll = asyncio.get_running_loop().call_later(self.slots.poll_interval, self._retry)
+
+    async def _give_back(self, slot: int, classroom: Optional[str]):
+        try:
+            await self._slot_call(self.slots.release, slot, classroom)
+        except Exception as e:
+            # Keep it for a later pass, renew would otherwise hold the slot for good
+            logger.warning("Could not give back upstream slot %s, retrying: %s", slot, str(e))
+            self._releases.append((slot, classroom))
+
+    def _retry(self):
+        self._poll = None
+        self._dispatch()
+
+    async def _renew_loop(self):
+        while True:
+            await asyncio.sleep(self.slots.renew_interval)
+            await self._slot_call(self.slots.renew)
+
+    async def request(self, classroom: Optional[str] = None) -> Ticket:
+        """Queue a session for a slot, ticket.admitted is already done if one was free"""
+        if len(self._queue) >= self.max_queue:
+            self.rejected += 1
+            logger.warning("Rejecting session, %d sessions already waiting for an upstream slot", len(self._queue))
+            raise AdmissionRejected("The waiting queue is full")
+        if self.slots.renew_interval is not None and self._renewer is None:
+            self._renewer = asyncio.create_task(self._renew_loop())
+        ticket = Ticket(classroom)
+        self._queue.append(ticket)
+        try:
+            await asyncio.shield(self._dispatch())
+        except BaseException:
+            self.release(ticket)
+            raise
+        return ticket
+
+    async def wait(self, ticket: Ticket, on_position: Optional[Callable[[int, int], Awaitable[None]]] = None):
+        """Wait until the ticket is admitted, calling on_position(position, queue length) when its position changes"""
+        reported = None
+        deadline = ticket.enqueued_at + self.max_wait
+        try:
+            while not ticket.admitted.done():
+                if ticket.position != reported and on_position is not None:
+                    reported = ticket.position
+                    await on_position(ticket.position, len(self._queue))
+                    continue
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self.timed_out += 1
+                    raise AdmissionRejected(f"No upstream session became available within {self.max_wait:g}s")
+                await asyncio.wait((ticket.admitted,), timeout=min(self.position_interval, remaining))
+        except BaseException as e:
+            ADMISSION_SECONDS.observe(time.monotonic() - ticket.enqueued_at, "timed_out" if isinstance(e, AdmissionRejected) else "abandoned")
+            self.release(ticket)
+            raise
+        ADMISSION_SECONDS.observe(time.monotonic() - ticket.enqueued_at, "admitted")
+
+    def release(self, ticket: Ticket):
+        """Give up the ticket's slot, or its place in the queue if it wasn't admitted yet"""
+        if ticket.released:
+            return
+        ticket.released = True
+        if ticket.slot is not None:
+            self._releases.append((ticket.slot, ticket.classroom))
+        else:
+            ticket.admitted.cancel()
+            try:
+                self._queue.remove(ticket)
+            except ValueError:
+                pass
+        self._dispatch()
+
+    def stats(self) -> dict[str, int]:
+        return {
+            "active": self.slots.count(),
+            "waiting": len(self._queue),
+            "rejected": self.rejected,
+            "timed_out": self.timed_out
+        }
+
+    async def close(self, _app=None):
+        if self._renewer is not None:
+            self._renewer.cancel()
+        if self._dispatcher is not None:
+            # Let a running pass finish and give back the slots of sessions that ended
+            await self._dispatcher
+        if self._poll is not None:
+            self._poll.cancel()
+        await self._slot_call(self.slots.close)
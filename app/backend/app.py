@@ -7,8 +7,17 @@ from azure.core.credentials import AzureKeyCredential
 from azure.identity import AzureDeveloperCliCredential, DefaultAzureCredential
 from dotenv import load_dotenv
 
+from admission import AdmissionController, SqliteSlotStore
+from codec import get_codec
+from embeddings import AzureOpenAIEmbedder, create_embedder
+from metrics import REGISTRY, metrics_handler
+from progress_db import SqliteProgressStore
+from progress_tracker import ProgressTracker
 from ragtools import attach_rag_tools
-from rtmt import RTMiddleTier
+from retrieval import LocalSearchBackend, read_local_index_meta
+from rtmt import RTMiddleTier, SessionRegistry
+from search_cache import InMemoryCacheBackend, SearchCache, SqliteCacheBackend
+from semantic_cache import SemanticCache
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger("voicerag")
@@ -38,8 +47,46 @@ async def create_app():
         credentials=llm_credential,
         endpoint=os.environ["AZURE_OPENAI_ENDPOINT"],
         deployment=os.environ["AZURE_OPENAI_REALTIME_DEPLOYMENT"],
-        voice_choice=os.environ.get("AZURE_OPENAI_REALTIME_VOICE_CHOICE") or "alloy"
+        voice_choice=os.environ.get("AZURE_OPENAI_REALTIME_VOICE_CHOICE") or "alloy",
+        sessions=SessionRegistry(
+            max_sessions=int(os.environ.get("RTMT_MAX_SESSIONS") or 1000),
+            max_lifetime=float(os.environ.get("RTMT_SESSION_MAX_LIFETIME") or 3600),
+            idle_timeout=float(os.environ.get("RTMT_SESSION_IDLE_TIMEOUT") or 600)),
+        upstream_options={
+            "connection_limit": int(os.environ.get("RTMT_UPSTREAM_CONNECTION_LIMIT") or 0),
+            "dns_cache_ttl": int(os.environ.get("RTMT_UPSTREAM_DNS_CACHE_TTL") or 300),
+            "keepalive_timeout": float(os.environ.get("RTMT_UPSTREAM_KEEPALIVE_TIMEOUT") or 30)
+        },
+        send_buffer_options={
+            "max_bytes": int(os.environ.get("RTMT_SEND_BUFFER_BYTES") or 2 * 1024 * 1024),
+            "max_audio_delay": float(os.environ.get("RTMT_SEND_BUFFER_AUDIO_DELAY") or 5),
+            "max_delay": float(os.environ.get("RTMT_SEND_BUFFER_MAX_DELAY") or 15),
+            "coalesce_window": float(os.environ.get("RTMT_TEXT_COALESCE_WINDOW") or 0.05),
+            "coalesce_max_chars": int(os.environ.get("RTMT_TEXT_COALESCE_MAX_CHARS") or 200)
+        }
         )
+    if json_codec := os.environ.get("RTMT_JSON_CODEC"):
+        rtmt.codec = get_codec(json_codec)
+    logger.info("Relaying realtime events with the %s codec", rtmt.codec.name)
+    if max_upstream_sessions := int(os.environ.get("RTMT_MAX_UPSTREAM_SESSIONS") or 0):
+        slots = None
+        if admission_db := os.environ.get("RTMT_ADMISSION_DB"):
+            logger.info("Sharing upstream session slots through %s", admission_db)
+            slots = SqliteSlotStore(admission_db)
+        rtmt.admission = AdmissionController(
+            max_sessions=max_upstream_sessions,
+            max_queue=int(os.environ.get("RTMT_ADMISSION_QUEUE_SIZE") or 200),
+            max_wait=float(os.environ.get("RTMT_ADMISSION_MAX_WAIT") or 120),
+            classroom_quota=int(os.environ.get("RTMT_CLASSROOM_MAX_SESSIONS") or 0),
+            slots=slots)
+        app.on_cleanup.append(rtmt.admission.close)
+        REGISTRY.register_snapshot("rtmt_admission", "Upstream session admission statistics", rtmt.admission.stats)
+        logger.info("Admitting up to %d upstream sessions at once", max_upstream_sessions)
+    if os.environ.get("PROGRESS_STORE") == "sqlite":
+        progress_db = os.environ.get("PROGRESS_DB_PATH") or "progress.db"
+        logger.info("Storing student progress in %s", progress_db)
+        rtmt.progress_tracker = ProgressTracker(store=SqliteProgressStore(progress_db))
+    rtmt.attach_quiz_tool()
     rtmt.system_message = """
     You are a friendly and encouraging AI tutor named 'Edu Echo' for grade school children (ages 9-12) at Bright Horizons Academy.
     Your job is to help them learn through conversation and gentle guidance. You must ONLY answer using information from the knowledge base.
@@ -72,6 +119,8 @@ async def create_app():
        - If the answer is wrong, gently suggest they try again with the same question
        - Allow the child to try again 2 times before providing the answer
        - If their answer is correct, congratulate them and ask if they have any more questions
+       - Before asking a follow-up question, ALWAYS use the 'record_quiz_question' tool with the question, the answer
+         you expect and its difficulty, so the student's progress can be tracked. Never say the expected answer aloud.
 
     Example interaction:
     Child: "Hi!"
@@ -87,6 +136,7 @@ async def create_app():
     
     You: "Based on our textbook, plants make their own food using sunlight, water, and air - it's like they're tiny food factories!
     
+    [Use 'record_quiz_question' tool]
     Can you name the three things plants need to make their food?"
     
     Child: "Uhh... sunlight and meat?"
@@ -105,6 +155,62 @@ async def create_app():
     
     IMPORTANT: Remove ALL citation markers/codes from your responses. The student should never see things like [xxxxx_page_0] or similar reference codes.
     """
+    search_cache = None
+    search_cache_ttl = float(os.environ.get("AZURE_SEARCH_CACHE_TTL") or 600)
+    if search_cache_ttl > 0:
+        search_cache_size = int(os.environ.get("AZURE_SEARCH_CACHE_SIZE") or 1024)
+        if search_cache_path := os.environ.get("AZURE_SEARCH_CACHE_PATH"):
+            logger.info("Using shared search cache at %s", search_cache_path)
+            cache_backend = SqliteCacheBackend(search_cache_path, max_entries=search_cache_size)
+        else:
+            cache_backend = InMemoryCacheBackend(max_entries=search_cache_size)
+        search_cache = SearchCache(cache_backend, ttl=search_cache_ttl)
+        REGISTRY.register_snapshot("search_cache", "Search cache statistics", search_cache.stats)
+
+        async def log_search_cache_stats(_):
+            logger.info("Search cache stats: %s", search_cache.stats())
+        app.on_cleanup.append(log_search_cache_stats)
+
+    embedding_token_provider = rtmt.token_manager.get_token if rtmt.token_manager is not None else None
+
+    def create_app_embedder(model: str, dimensions: int):
+        embedder = create_embedder(model, dimensions,
+            endpoint=os.environ["AZURE_OPENAI_ENDPOINT"],
+            deployment=os.environ.get("AZURE_OPENAI_EMBEDDING_DEPLOYMENT"),
+            key=llm_key,
+            token_provider=embedding_token_provider)
+        if isinstance(embedder, AzureOpenAIEmbedder):
+            async def close_embedder(_):
+                await embedder.close()
+            app.on_cleanup.append(close_embedder)
+        return embedder
+
+    semantic_cache = None
+    if semantic_cache_threshold := os.environ.get("AZURE_SEARCH_SEMANTIC_CACHE_THRESHOLD"):
+        if os.environ.get("AZURE_SEARCH_SEMANTIC_CACHE_EMBEDDER") == "hashing":
+            embedding_model = "hashing"
+        else:
+            embedding_model = os.environ.get("AZURE_OPENAI_EMBEDDING_MODEL") or "text-embedding-3-large"
+        embedder = create_app_embedder(embedding_model, int(os.environ.get("AZURE_SEARCH_SEMANTIC_CACHE_DIMENSIONS") or 256))
+        semantic_cache = SemanticCache(embedder,
+            capacity=int(os.environ.get("AZURE_SEARCH_SEMANTIC_CACHE_SIZE") or 512),
+            threshold=float(semantic_cache_threshold),
+            ttl=search_cache_ttl or 600)
+        REGISTRY.register_snapshot("semantic_cache", "Semantic cache statistics", semantic_cache.stats)
+
+        async def log_semantic_cache_stats(_):
+            logger.info("Semantic cache stats: %s", semantic_cache.stats())
+        app.on_cleanup.append(log_semantic_cache_stats)
+
+    retrieval_backend = None
+    if os.environ.get("RETRIEVAL_BACKEND") == "local":
+        local_index_dir = os.environ.get("LOCAL_INDEX_DIR") or "local_index"
+        local_index_meta = read_local_index_meta(local_index_dir)
+        logger.info("Using local retrieval index at %s", local_index_dir)
+        retrieval_backend = LocalSearchBackend(local_index_dir,
+            embedder=create_app_embedder(local_index_meta["model"], local_index_meta["dimensions"]),
+            use_vector_query=(os.environ.get("AZURE_SEARCH_USE_VECTOR_QUERY") or "true") == "true")
+
     logger.info("Attaching RAG tools to RTMiddleTier...")
     attach_rag_tools(rtmt,
         credentials=search_credential,
@@ -115,11 +221,19 @@ async def create_app():
         content_field=os.environ.get("AZURE_SEARCH_CONTENT_FIELD") or "chunk",
         embedding_field=os.environ.get("AZURE_SEARCH_EMBEDDING_FIELD") or "text_vector",
         title_field=os.environ.get("AZURE_SEARCH_TITLE_FIELD") or "title",
-        use_vector_query=(os.environ.get("AZURE_SEARCH_USE_VECTOR_QUERY") == "true") or True
+        use_vector_query=(os.environ.get("AZURE_SEARCH_USE_VECTOR_QUERY") == "true") or True,
+        search_cache=search_cache,
+        semantic_cache=semantic_cache,
+        backend=retrieval_backend,
+        tool_timeout=float(os.environ.get("AZURE_SEARCH_TOOL_TIMEOUT") or 10),
+        max_concurrent_calls=int(os.environ.get("AZURE_SEARCH_MAX_CONCURRENT_CALLS") or 0) or None
         )
     logger.info(f"RAG tools attached. Available tools: {list(rtmt.tools.keys())}")
 
     rtmt.attach_to_app(app, "/realtime")
+    REGISTRY.register_snapshot("rtmt_upstream", "Upstream realtime connection statistics", rtmt.upstream_stats.snapshot)
+    if os.environ.get("RTMT_METRICS_ENABLED") == "true":
+        app.router.add_get("/metrics", metrics_handler)
 
     current_directory = Path(__file__).parent
     app.add_routes([web.get('/', lambda _: web.FileResponse(current_directory / 'static/index.html'))])
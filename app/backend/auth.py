@@ -0,0 +1,106 @@
+import asyncio
+import inspect
+import logging
+import time
+from typing import Any, Optional
+
+from azure.core.credentials import AccessToken
+
+logger = logging.getLogger("voicerag")
+
+class AsyncTokenManager:
+    """Caches an Entra ID token for one scope and refreshes it in the background before it expires.
+
+    Works with both sync and async credentials; sync credentials are called in a worker thread so
+    fetching a token never blocks the event loop. Concurrent callers share a single in-flight refresh.
+    """
+
+    def __init__(self, credential: Any, scope: str, refresh_margin: float = 300, retry_interval: float = 10):
+        self.credential = credential
+        self.scope = scope
+        self.refresh_margin = refresh_margin
+        self.retry_interval = retry_interval
+        self._token: Optional[AccessToken] = None
+        self._refreshing: Optional[asyncio.Future] = None
+        self._refresher: Optional[asyncio.Task] = None
+        self.refreshes = 0
+        self.refresh_failures = 0
+
+    async def _fetch(self) -> AccessToken:
+        if inspect.iscoroutinefunction(self.credential.get_token):
+            return await self.credential.get_token(self.scope)
+        return await asyncio.to_thread(self.credential.get_token, self.scope)
+
+    async def _do_refresh(self) -> AccessToken:
+        try:
+            self._token = await self._fetch()
+            self.refreshes += 1
+            return self._token
+        except Exception:
+            self.refresh_failures += 1
+            raise
+        finally:
+            self._refreshing = None
+
+    async def refresh(self) -> AccessToken:
+        if self._refreshing is None:
+            self._refreshing = asyncio.create_task(self._do_refresh())
+        # Shielded so a caller giving up doesn't cancel the refresh other callers are waiting on
+        return await asyncio.shield(self._refreshing)
+
+    async def get_access_token(self) -> AccessToken:
+        if self._refresher is None:
+            self._refresher = asyncio.create_task(self._refresh_loop())
+        if self._token is None or self._token.expires_on <= time.time():
+            return await self.refresh()
+        return self._token
+
+    async def get_token(self) -> str:
+        return (await self.get_access_token()).token
+
+    async def _refresh_loop(self):
+        while True:
+            if self._token is None:
+                delay = 0
+            else:
+                remaining = self._token.expires_on - time.time()
+                # Short-lived tokens are refreshed half way through their lifetime instead of spinning
+                delay = remaining - self.refresh_margin if remaining > 2 * self.refresh_margin else max(1, remaining / 2)
+            await asyncio.sleep(delay)
+            try:
+                await self.refresh()
+            except Exception as e:
+                logger.warning("Refreshing token for %s failed, retrying in %ss: %s", self.scope, self.retry_interval, str(e))
+                await asyncio.sleep(self.retry_interval)
+
+    async def start(self, _app=None):
+        await self.get_access_token()
+
+    async def close(self, _app=None):
+        if self._refresher is not None:
+            self._refresher.cancel()
+            self._refresher = None
+
+class ManagedTokenCredential:
+    """Async credential for Azure SDK clients that serves tokens from AsyncTokenManagers, one per scope"""
+
+    def __init__(self, credential: Any, refresh_margin: float = 300):
+        self.credential = credential
+        self.refresh_margin = refresh_margin
+        self._managers: dict[str, AsyncTokenManager] = {}
+
+    async def get_token(self, *scopes: str, **kwargs: Any) -> AccessToken:
+        scope = " ".join(scopes)
+        if scope not in self._managers:
+            self._managers[scope] = AsyncTokenManager(self.credential, scope, self.refresh_margin)
+        return await self._managers[scope].get_access_token()
+
+    async def close(self):
+        for manager in self._managers.values():
+            await manager.close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        await self.close()
@@ -0,0 +1,47 @@
+"""Throughput of the JSON codecs available to the relay over a realtime event trace.
+
+    python benchmarks/codec.py [--trace events.jsonl] [--repeat 20]
+"""
+import argparse
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from codec import available_codecs, get_codec
+from realtime_trace import load_trace
+
+
+def measure(name: str, trace: list[str], repeat: int) -> dict:
+    codec = get_codec(name)
+    messages = [codec.loads(data) for data in trace]
+    text_deltas = [data for data, m in zip(trace, messages) if m["type"] == "response.audio_transcript.delta"]
+    size = sum(len(data) for data in trace)
+    timings = {}
+    for label, work in (
+        ("loads", lambda: [codec.loads(data) for data in trace]),
+        ("dumps", lambda: [codec.dumps(m) for m in messages]),
+        ("event_type", lambda: [codec.event_type(data) for data in trace]),
+        ("text_delta", lambda: [codec.text_delta(data) for data in text_deltas])):
+        start = time.perf_counter()
+        for _ in range(repeat):
+            work()
+        timings[label] = (time.perf_counter() - start) / repeat
+    return {"codec": name, "events": len(trace), "text_delta_events": len(text_deltas), "bytes": size, **timings}
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--trace", help="JSONL file of recorded server events, a synthetic session is used by default")
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+    trace = load_trace(args.trace)
+    print(f"{'codec':8} {'loads MB/s':>11} {'dumps MB/s':>11} {'event_type us':>14} {'text_delta us':>14}")
+    for name in available_codecs():
+        r = measure(name, trace, args.repeat)
+        mb = r["bytes"] / 1e6
+        print(f"{name:8} {mb / r['loads']:11.0f} {mb / r['dumps']:11.0f} "
+              f"{r['event_type'] / r['events'] * 1e6:14.2f} {r['text_delta'] / max(1, r['text_delta_events']) * 1e6:14.2f}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,332 @@
+"""Load test of the /realtime relay against a local mock of the Azure OpenAI realtime API.
+
+Three processes: a mock realtime server replaying a conversation script (session.created, function calls,
+paced audio and transcript deltas, response.done), the middle tier under test, and N websocket clients
+streaming microphone audio through /realtime. Each level of concurrency runs for a fixed time and reports:
+
+* relay latency: the time from the mock server sending an event to a client receiving it, for events the
+  middle tier relays verbatim (the mock stamps its send time into event_id); --baseline also connects the
+  clients straight to the mock, so the difference is what the middle tier adds
+* middle tier CPU and memory per session, read from the middle tier process itself
+* the saturation point: the first level where p95 latency exceeds --slo-ms or the middle tier uses a full core
+* with --slow-clients, a share of clients on a bad network (a tiny socket receive buffer and --read-delay per
+  frame): audio frames the middle tier dropped for them and sessions it closed as hopeless, while memory per
+  session stays flat; their latencies are left out of the percentiles
+* with --session-length, clients hang up after that many seconds and reconnect, a second after a failed or
+  rejected attempt: sessions completed, rejected and failed. --upstream-quota makes the mock refuse connections
+  over a concurrent session quota, as the Azure deployment does, and --max-upstream puts the middle tier's
+  admission control in front of it, so the clients over the quota wait in line instead of failing
+
+All clients share one process; if latency climbs while the middle tier is well below a full core, the clients
+are the bottleneck, which --baseline shows as high direct latency too.
+
+    python benchmarks/load_test.py [--sessions 10 50 100 200] [--duration 10] [--trace events.jsonl] [--baseline]
+                                   [--slow-clients 0.2 --read-delay 0.5]
+                                   [--session-length 5 --upstream-quota 50 [--max-upstream 50]]
+"""
+import argparse
+import asyncio
+import base64
+import json
+import multiprocessing
+import os
+import resource
+import socket
+import sys
+import time
+from pathlib import Path
+
+import aiohttp
+import numpy as np
+from aiohttp import web
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from realtime_trace import load_trace
+
+MOCK_PORT = 8911
+MIDDLE_TIER_PORT = 8912
+AUDIO_INTERVAL = 0.1  # 100ms audio chunks, both directions
+_EVENT_ID_PREFIX = '"event_id": "'
+
+def _stamp(data: str) -> str:
+    return data.replace(_EVENT_ID_PREFIX, f'{_EVENT_ID_PREFIX}t{time.monotonic_ns()}_', 1)
+
+async def create_mock_app(trace_path: str, speed: float, transcript_burst: int, transcript_gap: float, upstream_quota: int = 0) -> web.Application:
+    """Replays the conversation script on every connection, pacing audio deltas in real time"""
+    # Re-serialized so event_id always has the spacing _stamp looks for
+    trace = [json.dumps(json.loads(data)) for data in load_trace(trace_path, transcript_burst=transcript_burst)]
+    active = 0
+
+    async def realtime(request: web.Request):
+        nonlocal active
+        if upstream_quota and active >= upstream_quota:
+            raise web.HTTPTooManyRequests()
+        active += 1
+        ws = web.WebSocketResponse(max_msg_size=0)
+        await ws.prepare(request)
+
+        async def drain():
+            nonlocal active
+            # Client audio, session updates and tool outputs are accepted and ignored
+            try:
+                async for _ in ws:
+                    pass
+            finally:
+                # The quota is freed as soon as the session is closed
+                active -= 1
+        reader = asyncio.create_task(drain())
+        try:
+            while not ws.closed:
+                for data in trace:
+                    if ws.closed:
+                        break
+                    if '"response.audio.delta"' in data[:64]:
+                        await asyncio.sleep(AUDIO_INTERVAL / speed)
+                    elif transcript_gap and '"response.audio_transcript.delta"' in data[:64]:
+                        await asyncio.sleep(transcript_gap / speed)
+                    await ws.send_str(_stamp(data))
+        except ConnectionResetError:
+            pass
+        finally:
+            reader.cancel()
+        return ws
+
+    app = web.Application()
+    app.router.add_get("/openai/realtime", realtime)
+    return app
+
+def run_mock_server(trace_path: str, speed: float, transcript_burst: int, transcript_gap: float, upstream_quota: int = 0):
+    web.run_app(create_mock_app(trace_path, speed, transcript_burst, transcript_gap, upstream_quota),
+                host="127.0.0.1", port=MOCK_PORT, print=None, access_log=None)
+
+async def create_middle_tier_app(coalesce_window: float, max_upstream: int = 0) -> web.Application:
+    from azure.core.credentials import AzureKeyCredential
+
+    from admission import AdmissionController
+    from rtmt import (
+        RTMiddleTier,
+        SessionRegistry,
+        Tool,
+        ToolResult,
+        ToolResultDirection,
+    )
+    from send_buffer import DROPPED_FRAMES, SLOW_CONSUMERS
+
+    async def search(args):
+        return ToolResult("[doc_0]: Plants make food from sunlight.\n-----\n", ToolResultDirection.TO_SERVER)
+
+    async def stats(_request):
+        with open("/proc/self/statm") as f:
+            rss = int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        return web.json_response({"cpu_seconds": usage.ru_utime + usage.ru_stime, "rss_bytes": rss,
+                                  "dropped_frames": DROPPED_FRAMES.value("to_client"), "slow_consumers": SLOW_CONSUMERS.value("to_client")})
+
+    sys.stdout = open(os.devnull, "w")  # the relay prints on every disconnect
+    rtmt = RTMiddleTier(f"http://127.0.0.1:{MOCK_PORT}", "load-test", AzureKeyCredential("load-test"),
+                        sessions=SessionRegistry(max_sessions=100000), send_buffer_options={"coalesce_window": coalesce_window})
+    rtmt.system_message = "You are a tutor."
+    rtmt.tools["search"] = Tool(target=search, schema={"type": "function", "name": "search"})
+    if max_upstream:
+        rtmt.admission = AdmissionController(max_upstream, max_queue=100000)
+    app = web.Application()
+    rtmt.attach_to_app(app, "/realtime")
+    app.router.add_get("/_load_test/stats", stats)
+    return app
+
+def run_middle_tier(coalesce_window: float, max_upstream: int = 0):
+    web.run_app(create_middle_tier_app(coalesce_window, max_upstream), host="127.0.0.1", port=MIDDLE_TIER_PORT, print=None, access_log=None)
+
+class Results:
+    def __init__(self):
+        self.latencies: list[float] = []
+        self.frames = 0
+        self.errors = 0
+        self.completed = 0
+        self.rejected = 0
+        self.admission_waits: list[float] = []
+
+async def client(session: aiohttp.ClientSession, url: str, deadline: float, results: Results, read_delay: float = 0,
+                 session_length: float = 0) -> bool:
+    """One session until the deadline, or session_length seconds after it was admitted. Returns whether it ran
+    rather than being rejected or failing"""
+    audio = base64.b64encode(os.urandom(4800)).decode("ascii")
+    connected_at = time.monotonic()
+    hang_up_at = min(deadline, connected_at + session_length) if session_length else deadline
+    admitted = True
+    try:
+        async with session.ws_connect(url, max_msg_size=0) as ws:
+            if read_delay:
+                # A slow network: the kernel holds little for us, so the middle tier sees the backlog
+                ws.get_extra_info("socket").setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+            await ws.send_str(json.dumps({"type": "session.update", "session": {"turn_detection": {"type": "server_vad"}}}))
+
+            async def microphone():
+                while time.monotonic() < hang_up_at:
+                    await ws.send_str(json.dumps({"type": "input_audio_buffer.append", "audio": audio}))
+                    await asyncio.sleep(AUDIO_INTERVAL)
+                await ws.close()
+            sender = asyncio.create_task(microphone())
+            async for msg in ws:
+                if msg.type != aiohttp.WSMsgType.TEXT:
+                    break
+                received_at = time.monotonic_ns()
+                results.frames += 1
+                if '"extension.queue_position"' in msg.data[:64]:
+                    admitted = json.loads(msg.data)["position"] == 0
+                    if admitted:
+                        results.admission_waits.append(time.monotonic() - connected_at)
+                        if session_length:
+                            hang_up_at = min(deadline, time.monotonic() + session_length)
+                    continue
+                if read_delay:
+                    await asyncio.sleep(read_delay)
+                    continue
+                start = msg.data.find(f'{_EVENT_ID_PREFIX}t', 0, 256)
+                if start >= 0:
+                    start += len(_EVENT_ID_PREFIX) + 1
+                    sent_at = int(msg.data[start:msg.data.index("_", start)])
+                    results.latencies.append((received_at - sent_at) / 1e6)
+            await sender
+            if ws.close_code == aiohttp.WSCloseCode.TRY_AGAIN_LATER:
+                results.rejected += 1
+                return False
+            if not admitted:
+                # Still waiting for a slot when the level ended
+                return False
+            if ws.close_code != aiohttp.WSCloseCode.OK:
+                results.errors += 1
+                return False
+            results.completed += 1
+            return True
+    except (aiohttp.ClientError, ConnectionResetError):
+        results.errors += 1
+        return False
+
+async def returning_client(session: aiohttp.ClientSession, url: str, deadline: float, results: Results, session_length: float):
+    """Back to back sessions of session_length seconds until the deadline"""
+    while time.monotonic() < deadline:
+        if not await client(session, url, deadline, results, session_length=session_length):
+            await asyncio.sleep(1)
+
+async def middle_tier_stats(session: aiohttp.ClientSession) -> dict:
+    async with session.get(f"http://127.0.0.1:{MIDDLE_TIER_PORT}/_load_test/stats") as response:
+        return await response.json()
+
+async def run_level(sessions: int, duration: float, url: str, measure_middle_tier: bool, slow_clients: float = 0, read_delay: float = 0,
+                    session_length: float = 0) -> dict:
+    results = Results()
+    async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=0)) as http:
+        before = await middle_tier_stats(http) if measure_middle_tier else None
+        started_at = time.monotonic()
+        deadline = started_at + duration
+
+        async def sample_while_busy():
+            # Memory is read while every session is still open
+            await asyncio.sleep(duration * 0.8)
+            return await middle_tier_stats(http)
+        busy = asyncio.create_task(sample_while_busy()) if measure_middle_tier else None
+        slow = round(sessions * slow_clients)
+        if session_length:
+            await asyncio.gather(*(returning_client(http, url, deadline, results, session_length) for _ in range(sessions)))
+        else:
+            await asyncio.gather(*(client(http, url, deadline, results, read_delay if i < slow else 0) for i in range(sessions)))
+        elapsed = time.monotonic() - started_at
+        after = await middle_tier_stats(http) if measure_middle_tier else None
+        busy_stats = await busy if busy is not None else None
+    latencies = np.array(results.latencies) if results.latencies else np.zeros(1)
+    level = {
+        "sessions": sessions,
+        "frames_per_second": results.frames / elapsed,
+        "errors": results.errors,
+        "p50_ms": float(np.percentile(latencies, 50)),
+        "p95_ms": float(np.percentile(latencies, 95)),
+        "p99_ms": float(np.percentile(latencies, 99)),
+        "sessions_completed": results.completed,
+        "sessions_rejected": results.rejected,
+        "admission_wait_p95_s": float(np.percentile(results.admission_waits, 95)) if results.admission_waits else 0.0
+    }
+    if measure_middle_tier:
+        cpu = after["cpu_seconds"] - before["cpu_seconds"]
+        level.update({
+            "cpu_utilization": cpu / elapsed,
+            "cpu_ms_per_session_second": cpu * 1000 / (sessions * elapsed),
+            "rss_mb": busy_stats["rss_bytes"] / 1e6,
+            "dropped_frames": after["dropped_frames"] - before["dropped_frames"],
+            "slow_sessions_closed": after["slow_consumers"] - before["slow_consumers"]
+        })
+    return level
+
+async def wait_for_port(port: int, timeout: float = 20):
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            _, writer = await asyncio.open_connection("127.0.0.1", port)
+            writer.close()
+            return
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            await asyncio.sleep(0.1)
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sessions", type=int, nargs="+", default=[10, 50, 100, 200])
+    parser.add_argument("--duration", type=float, default=10, help="Seconds per level")
+    parser.add_argument("--trace", help="JSONL conversation script of server events, a synthetic session is used by default")
+    parser.add_argument("--speed", type=float, default=1.0, help="Replay speed of the script relative to real time")
+    parser.add_argument("--transcript-burst", type=int, default=1, help="Transcript deltas sent back to back in the synthetic script")
+    parser.add_argument("--transcript-gap", type=float, default=0, help="Seconds between transcript deltas, as they arrive over a real network")
+    parser.add_argument("--coalesce-window", type=float, default=0.05, help="Seconds the middle tier holds text deltas to merge them, 0 to disable")
+    parser.add_argument("--slo-ms", type=float, default=50, help="p95 relay latency considered saturated")
+    parser.add_argument("--baseline", action="store_true", help="Also measure clients connected directly to the mock server")
+    parser.add_argument("--slow-clients", type=float, default=0, help="Fraction of clients on a slow network")
+    parser.add_argument("--read-delay", type=float, default=0.5, help="Seconds a slow client waits after each frame it reads")
+    parser.add_argument("--session-length", type=float, default=0, help="Seconds before a client hangs up and reconnects, 0 to stay for the whole level")
+    parser.add_argument("--upstream-quota", type=int, default=0, help="Concurrent sessions the mock server accepts, 0 for no limit")
+    parser.add_argument("--max-upstream", type=int, default=0, help="Upstream sessions the middle tier admits at once, 0 to disable admission control")
+    parser.add_argument("--json", help="Write results to this file")
+    args = parser.parse_args()
+
+    mock = multiprocessing.Process(target=run_mock_server, args=(args.trace, args.speed, args.transcript_burst, args.transcript_gap,
+                                                                  args.upstream_quota), daemon=True)
+    middle_tier = multiprocessing.Process(target=run_middle_tier, args=(args.coalesce_window, args.max_upstream), daemon=True)
+    mock.start()
+    middle_tier.start()
+    try:
+        await wait_for_port(MOCK_PORT)
+        await wait_for_port(MIDDLE_TIER_PORT)
+        async with aiohttp.ClientSession() as http:
+            idle_rss = (await middle_tier_stats(http))["rss_bytes"]
+        levels = []
+        saturated_at = None
+        for sessions in args.sessions:
+            level = await run_level(sessions, args.duration, f"http://127.0.0.1:{MIDDLE_TIER_PORT}/realtime", True,
+                                    args.slow_clients, args.read_delay, args.session_length)
+            level["rss_kb_per_session"] = max(level["rss_mb"] * 1e6 - idle_rss, 0) / sessions / 1e3
+            if args.baseline:
+                direct = await run_level(sessions, args.duration, f"http://127.0.0.1:{MOCK_PORT}/openai/realtime", False)
+                level["direct_p50_ms"] = direct["p50_ms"]
+                level["direct_p95_ms"] = direct["p95_ms"]
+            levels.append(level)
+            print(f"{sessions:5d} sessions  {level['frames_per_second']:8.0f} frames/s  p50 {level['p50_ms']:7.2f} ms  "
+                  f"p95 {level['p95_ms']:7.2f} ms  p99 {level['p99_ms']:7.2f} ms"
+                  + (f" (direct p95 {level['direct_p95_ms']:.2f} ms)" if args.baseline else "")
+                  + f"  cpu {level['cpu_utilization'] * 100:5.1f}%  {level['cpu_ms_per_session_second']:.2f} ms cpu/session/s"
+                  + f"  {level['rss_kb_per_session']:.0f} KB/session  errors {level['errors']}"
+                  + (f"  dropped {level['dropped_frames']} frames, closed {level['slow_sessions_closed']} slow sessions" if args.slow_clients else "")
+                  + (f"  {level['sessions_completed']} sessions completed, {level['sessions_rejected']} rejected, "
+                     f"admission wait p95 {level['admission_wait_p95_s']:.1f} s" if args.session_length else ""))
+            if saturated_at is None and (level["p95_ms"] > args.slo_ms or level["cpu_utilization"] >= 0.95 or level["errors"]):
+                saturated_at = sessions
+        print(f"Saturation point: {saturated_at} sessions" if saturated_at else f"Not saturated at {args.sessions[-1]} sessions")
+        if args.json:
+            with open(args.json, "w") as f:
+                json.dump({"duration": args.duration, "slo_ms": args.slo_ms, "saturated_at": saturated_at, "levels": levels}, f, indent=2)
+    finally:
+        middle_tier.terminate()
+        mock.terminate()
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,106 @@
+"""Overhead of the relay instrumentation: the cost of each metric update, and relay CPU with metrics on and off.
+
+    python benchmarks/metrics_overhead.py [--trace events.jsonl] [--repeat 20] [--rounds 7]
+
+The relay comparison replays a session through RTMiddleTier the way _forward_messages does, timing every
+event into rtmt_relay_seconds, once with the real metrics and once with rtmt's metrics replaced by no-ops.
+"""
+import argparse
+import asyncio
+import statistics
+import sys
+import time
+import timeit
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from azure.core.credentials import AzureKeyCredential
+
+import rtmt as rtmt_module
+from metrics import Registry
+from realtime_trace import load_trace
+from relay import _Message, _NullWebSocket, _search
+from rtmt import RTMiddleTier, RTSession, Tool
+
+_METRICS = ("EVENTS", "RELAY_SECONDS_TO_CLIENT", "RELAY_SECONDS_TO_SERVER", "TOOL_SECONDS", "TOOL_CALLS_PENDING", "ACTIVE_SESSIONS", "TIME_TO_FIRST_AUDIO")
+
+class _NullMetric:
+    def inc(self, *args):
+        pass
+
+    dec = observe = inc
+
+def update_costs(number: int) -> dict[str, float]:
+    """Nanoseconds per update, for a metric that already has the label set"""
+    registry = Registry()
+    counter = registry.counter("c", "", ("direction", "type"))
+    gauge = registry.gauge("g", "")
+    histogram = registry.histogram("h", "", ("direction",))
+    counter.inc(1, "to_client", "response.audio.delta")
+    series = histogram.labels("to_client")
+    statements = {
+        "counter.inc": lambda: counter.inc(1, "to_client", "response.audio.delta"),
+        "gauge.inc": lambda: gauge.inc(),
+        "histogram.observe": lambda: histogram.observe(0.0004, "to_client"),
+        "bound series.observe": lambda: series.observe(0.0004),
+        "perf_counter": time.perf_counter
+    }
+    empty = min(timeit.repeat(lambda: None, number=number, repeat=5))
+    return {name: (min(timeit.repeat(statement, number=number, repeat=5)) - empty) / number * 1e9
+            for name, statement in statements.items()}
+
+async def relay_trace(rtmt: RTMiddleTier, trace: list[str]) -> int:
+    client_ws, server_ws = _NullWebSocket(), _NullWebSocket()
+    session = RTSession(client_ws)
+    relay_seconds = rtmt_module.RELAY_SECONDS_TO_CLIENT
+    for data in trace:
+        started_at = time.perf_counter()
+        new_msg = await rtmt._process_message_to_client(_Message(data), client_ws, server_ws, session)
+        if new_msg is not None:
+            await client_ws.send_str(new_msg)
+        relay_seconds.observe(time.perf_counter() - started_at)
+    await asyncio.gather(*session.tool_tasks)
+    return client_ws.frames
+
+async def relay_cpu(trace: list[str], repeat: int) -> float:
+    rtmt = RTMiddleTier("wss://localhost", "benchmark", AzureKeyCredential("benchmark"))
+    rtmt.tools["search"] = Tool(target=_search, schema={})
+    await relay_trace(rtmt, trace)
+    start = time.process_time()
+    for _ in range(repeat):
+        await relay_trace(rtmt, trace)
+    return (time.process_time() - start) / repeat
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--trace", help="JSONL file of recorded server events, a synthetic session is used by default")
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--rounds", type=int, default=7, help="Alternating on/off runs, the median of each is reported")
+    parser.add_argument("--number", type=int, default=200000, help="Iterations per metric update measurement")
+    args = parser.parse_args()
+
+    for name, ns in update_costs(args.number).items():
+        print(f"{name:20} {ns:7.1f} ns")
+
+    trace = load_trace(args.trace)
+    instrumented = {name: getattr(rtmt_module, name) for name in _METRICS}
+    # Alternate runs so frequency scaling and cache warmup affect both sides alike
+    timings = {"on": [], "off": []}
+    for _ in range(args.rounds):
+        timings["on"].append(await relay_cpu(trace, args.repeat))
+        for name in _METRICS:
+            setattr(rtmt_module, name, _NullMetric())
+        try:
+            timings["off"].append(await relay_cpu(trace, args.repeat))
+        finally:
+            for name, metric in instrumented.items():
+                setattr(rtmt_module, name, metric)
+    on, off = statistics.median(timings["on"]), statistics.median(timings["off"])
+    print(f"{len(trace)} events per session")
+    print(f"metrics off  {off * 1000:8.2f} ms CPU/session  {off / len(trace) * 1e6:6.2f} us/event")
+    print(f"metrics on   {on * 1000:8.2f} ms CPU/session  {on / len(trace) * 1e6:6.2f} us/event")
+    print(f"overhead     {(on - off) / len(trace) * 1e9:8.0f} ns/event ({(on / off - 1) * 100:.1f}%)")
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,49 @@
+import base64
+import json
+import os
+import random
+from typing import Optional
+
+
+def synthetic_session(turns: int = 10, audio_seconds_per_turn: float = 6.0, seed: int = 0, transcript_burst: int = 1) -> list[str]:
+    """Server->client realtime events shaped like a tutoring session: each turn is a search tool call
+    followed by a spoken answer streamed as 100ms pcm16 audio deltas with interleaved transcript deltas,
+    transcript_burst of them back to back every third audio delta"""
+    rng = random.Random(seed)
+    # 100ms of 24kHz 16-bit mono audio
+    audio_chunk = base64.b64encode(os.urandom(4800)).decode("ascii")
+    words = "plants make their own food using sunlight water and air it is like a tiny food factory".split()
+    events = [{"type": "session.created", "event_id": "event_0", "session": {
+        "id": "sess_0", "model": "gpt-4o-realtime-preview", "instructions": "", "voice": "alloy",
+        "tools": [], "tool_choice": "auto", "max_response_output_tokens": "inf"}}]
+    for turn in range(turns):
+        response_id = f"resp_{turn}"
+        call_id = f"call_{turn}"
+        events.append({"type": "input_audio_buffer.speech_ended", "event_id": f"event_{turn}_se", "audio_end_ms": 1000})
+        events.append({"type": "response.created", "event_id": f"event_{turn}_rc", "response": {"id": response_id, "status": "in_progress", "output": []}})
+        events.append({"type": "conversation.item.created", "event_id": f"event_{turn}_ic", "previous_item_id": f"item_{turn}_user",
+                       "item": {"id": f"item_{turn}_fc", "type": "function_call", "call_id": call_id, "name": "search", "arguments": ""}})
+        events.append({"type": "response.function_call_arguments.delta", "event_id": f"event_{turn}_fa", "call_id": call_id, "delta": "{\"query\": \"photosynthesis\"}"})
+        events.append({"type": "response.function_call_arguments.done", "event_id": f"event_{turn}_fd", "call_id": call_id, "arguments": "{\"query\": \"photosynthesis\"}"})
+        events.append({"type": "response.done", "event_id": f"event_{turn}_rd0", "response": {"id": response_id, "status": "completed",
+                       "output": [{"id": f"item_{turn}_fc", "type": "function_call", "call_id": call_id, "name": "search"}]}})
+        events.append({"type": "response.content_part.added", "event_id": f"event_{turn}_cp", "response_id": response_id, "part": {"type": "audio", "transcript": ""}})
+        for i in range(int(audio_seconds_per_turn * 10)):
+            events.append({"type": "response.audio.delta", "event_id": f"event_{turn}_a{i}", "response_id": response_id,
+                           "item_id": f"item_{turn}_msg", "output_index": 0, "content_index": 0, "delta": audio_chunk})
+            if i % 3 == 0:
+                for j in range(transcript_burst):
+                    events.append({"type": "response.audio_transcript.delta", "event_id": f"event_{turn}_t{i}" + (f"_{j}" if j else ""), "response_id": response_id,
+                                   "item_id": f"item_{turn}_msg", "output_index": 0, "content_index": 0, "delta": rng.choice(words) + " "})
+        events.append({"type": "response.audio.done", "event_id": f"event_{turn}_ad", "response_id": response_id})
+        events.append({"type": "response.audio_transcript.done", "event_id": f"event_{turn}_td", "response_id": response_id, "transcript": " ".join(words)})
+        events.append({"type": "response.done", "event_id": f"event_{turn}_rd1", "response": {"id": response_id, "status": "completed",
+                       "output": [{"id": f"item_{turn}_msg", "type": "message", "role": "assistant", "content": []}]}})
+    return [json.dumps(e) for e in events]
+
+def load_trace(path: Optional[str], **kwargs) -> list[str]:
+    """Recorded traces are JSONL files with one raw server event per line"""
+    if path is None:
+        return synthetic_session(**kwargs)
+    with open(path, encoding="utf-8") as f:
+        return [line.rstrip("\n") for line in f if line.strip()]
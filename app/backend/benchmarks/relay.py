@@ -0,0 +1,80 @@
+"""CPU cost of relaying realtime events through RTMiddleTier, with and without the fast path.
+
+    python benchmarks/relay.py [--trace events.jsonl] [--repeat 20] [--codec json|orjson|msgspec]
+"""
+import argparse
+import asyncio
+import json
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from azure.core.credentials import AzureKeyCredential
+
+from codec import JsonCodec, get_codec
+from realtime_trace import load_trace
+from rtmt import RTMiddleTier, RTSession, Tool, ToolResult, ToolResultDirection
+
+
+class _Message:
+    __slots__ = ("data",)
+
+    def __init__(self, data: str):
+        self.data = data
+
+class _NullWebSocket:
+    """Stands in for both websockets, serializing like aiohttp does but discarding the frames"""
+
+    def __init__(self):
+        self.frames = 0
+
+    async def send_json(self, data, dumps=json.dumps):
+        dumps(data)
+        self.frames += 1
+
+    async def send_str(self, data):
+        self.frames += 1
+
+async def _search(args):
+    return ToolResult("[doc_0]: Plants make food from sunlight.\n-----\n", ToolResultDirection.TO_SERVER)
+
+async def relay_trace(rtmt: RTMiddleTier, trace: list[str]) -> int:
+    client_ws, server_ws = _NullWebSocket(), _NullWebSocket()
+    session = RTSession(client_ws)
+    for data in trace:
+        new_msg = await rtmt._process_message_to_client(_Message(data), client_ws, server_ws, session)
+        if new_msg is not None:
+            await client_ws.send_str(new_msg)
+    await asyncio.gather(*session.tool_tasks)
+    return client_ws.frames
+
+async def measure(fast_path: bool, trace: list[str], repeat: int, codec: JsonCodec) -> dict:
+    rtmt = RTMiddleTier("wss://localhost", "benchmark", AzureKeyCredential("benchmark"))
+    rtmt.fast_path = fast_path
+    rtmt.codec = codec
+    rtmt.tools["search"] = Tool(target=_search, schema={})
+    await relay_trace(rtmt, trace)
+    start = time.process_time()
+    for _ in range(repeat):
+        await relay_trace(rtmt, trace)
+    cpu = (time.process_time() - start) / repeat
+    return {"fast_path": fast_path, "cpu_ms_per_session": cpu * 1000, "cpu_us_per_frame": cpu / len(trace) * 1e6}
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--trace", help="JSONL file of recorded server events, a synthetic session is used by default")
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--codec", help="JSON codec to relay with, defaults to the fastest installed")
+    args = parser.parse_args()
+    trace = load_trace(args.trace)
+    codec = get_codec(args.codec)
+    print(f"{len(trace)} events, {sum(len(t) for t in trace) / 1e6:.1f} MB per session, {codec.name} codec")
+    results = [await measure(False, trace, args.repeat, codec), await measure(True, trace, args.repeat, codec)]
+    for r in results:
+        print(f"fast_path={r['fast_path']!s:5}  {r['cpu_ms_per_session']:8.2f} ms CPU/session  {r['cpu_us_per_frame']:6.2f} us/frame")
+    print(f"speedup: {results[0]['cpu_ms_per_session'] / results[1]['cpu_ms_per_session']:.1f}x")
+
+if __name__ == "__main__":
+    asyncio.run(main())
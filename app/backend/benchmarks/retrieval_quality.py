@@ -0,0 +1,139 @@
+"""Retrieval quality and latency over a labeled question set, against the local retrieval backend.
+
+Each question in questions.jsonl lists the worksheet titles that answer it. For every configuration
+(text, vector or hybrid queries, k nearest neighbors, top) this reports recall@top and MRR by title,
+per-query latency percentiles and throughput at several concurrency levels.
+
+    python benchmarks/retrieval_quality.py [--index local_index] [--top 3] [--k 50] [--json results.json]
+
+Without --index, an index is built in a temporary directory from data/ with the offline hashing embedder,
+so results are reproducible without any Azure resources. Semantic ranking has no local equivalent.
+"""
+import argparse
+import asyncio
+import json
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from embeddings import HashingEmbedder
+from retrieval import LocalSearchBackend, build_local_index, read_local_index_meta
+
+BENCHMARK_DIR = Path(__file__).resolve().parent
+DATA_DIR = BENCHMARK_DIR.parents[2] / "data"
+
+def load_questions(path: str) -> list[dict]:
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+async def build_index(path: str, dimensions: int):
+    from ingest import document_chunks
+
+    chunks = [c for file in sorted(DATA_DIR.iterdir()) for c in document_chunks(str(file))]
+    await build_local_index(path, chunks, HashingEmbedder(dimensions))
+
+def quality(results: list[list[dict]], questions: list[dict]) -> dict[str, float]:
+    recalls, reciprocal_ranks = [], []
+    for documents, question in zip(results, questions):
+        expected = set(question["titles"])
+        titles = [doc["title"] for doc in documents]
+        recalls.append(len(expected & set(titles)) / len(expected))
+        rank = next((i + 1 for i, title in enumerate(titles) if title in expected), None)
+        reciprocal_ranks.append(1 / rank if rank else 0)
+    return {"recall": float(np.mean(recalls)), "mrr": float(np.mean(reciprocal_ranks))}
+
+async def run_configuration(backend: LocalSearchBackend, questions: list[dict], top: int, repeat: int, concurrency_levels: list[int]) -> dict:
+    results = [await backend.search(q["question"], top) for q in questions]
+    latencies = []
+    for _ in range(repeat):
+        for q in questions:
+            start = time.perf_counter()
+            await backend.search(q["question"], top)
+            latencies.append(time.perf_counter() - start)
+    latencies = np.array(latencies) * 1000
+
+    throughput = {}
+    for concurrency in concurrency_levels:
+        work = [q["question"] for q in questions] * repeat
+        position = 0
+
+        async def worker():
+            nonlocal position
+            while position < len(work):
+                query = work[position]
+                position += 1
+                await backend.search(query, top)
+        start = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        throughput[str(concurrency)] = len(work) / (time.perf_counter() - start)
+
+    return {
+        **quality(results, questions),
+        "p50_ms": float(np.percentile(latencies, 50)),
+        "p95_ms": float(np.percentile(latencies, 95)),
+        "p99_ms": float(np.percentile(latencies, 99)),
+        "queries_per_second": throughput
+    }
+
+def git_commit() -> str:
+    result = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, cwd=BENCHMARK_DIR)
+    return result.stdout.strip() if result.returncode == 0 else ""
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--index", help="Local index directory built with the hashing embedder (see ingest.py)")
+    parser.add_argument("--questions", default=str(BENCHMARK_DIR / "questions.jsonl"))
+    parser.add_argument("--dimensions", type=int, default=256, help="Hashing embedder dimensions when building an index")
+    parser.add_argument("--top", type=int, nargs="+", default=[3])
+    parser.add_argument("--k", type=int, nargs="+", default=[50])
+    parser.add_argument("--modes", nargs="+", default=["text", "vector", "hybrid"], choices=["text", "vector", "hybrid"])
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 4, 16])
+    parser.add_argument("--json", help="Write results to this file")
+    args = parser.parse_args()
+
+    questions = load_questions(args.questions)
+    with tempfile.TemporaryDirectory() as temp_dir:
+        index = args.index
+        if index is None:
+            index = temp_dir
+            await build_index(index, args.dimensions)
+        meta = read_local_index_meta(index)
+        if meta["model"] != "hashing":
+            sys.exit(f"{index} was built with {meta['model']}, only hashing embedder indexes can be queried offline")
+        embedder = HashingEmbedder(meta["dimensions"])
+
+        runs = []
+        for mode in args.modes:
+            for k in args.k:
+                backend = LocalSearchBackend(index, embedder, use_vector_query=mode != "text", k_nearest_neighbors=k,
+                                             use_text_query=mode != "vector")
+                for top in args.top:
+                    metrics = await run_configuration(backend, questions, top, args.repeat, args.concurrency)
+                    runs.append({"mode": mode, "k": k, "top": top, **metrics})
+
+    print(f"{len(questions)} questions, {meta['count']} chunks, {meta['dimensions']} dimensions")
+    print(f"{'mode':7} {'k':>4} {'top':>4} {'recall':>7} {'MRR':>6} {'p50 ms':>7} {'p95 ms':>7} {'p99 ms':>7}  queries/s by concurrency")
+    for r in runs:
+        qps = " ".join(f"{c}:{v:.0f}" for c, v in r["queries_per_second"].items())
+        print(f"{r['mode']:7} {r['k']:4d} {r['top']:4d} {r['recall']:7.3f} {r['mrr']:6.3f} {r['p50_ms']:7.3f} {r['p95_ms']:7.3f} {r['p99_ms']:7.3f}  {qps}")
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({
+                "timestamp": datetime.now(timezone.utc).isoformat(),
+                "commit": git_commit(),
+                "questions": len(questions),
+                "chunks": meta["count"],
+                "dimensions": meta["dimensions"],
+                "runs": runs
+            }, f, indent=2)
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,179 @@
+"""Recall and latency of vector compression settings, measured offline against exact float32 search.
+
+Compares truncated (Matryoshka) dimensions, int8 scalar and binary quantization, with and without rescoring
+the oversampled candidates at full precision; setup_intvect.setup_index can configure all but binary
+quantization, which needs a newer azure-search-documents than the one pinned. With
+hnswlib installed it also sweeps the HNSW m / efConstruction / efSearch parameters.
+
+    python benchmarks/vector_compression.py [--index local_index] [--scale 50] [--json results.json]
+
+Without --index the corpus is chunked from data/ and embedded with the offline hashing embedder; truncation
+only preserves quality for embeddings trained for it (text-embedding-3), so use an index built with that model
+when choosing dimensions. Latencies come from numpy kernels and are only comparable with each other, not with
+the search service.
+"""
+import argparse
+import asyncio
+import json
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from embeddings import HashingEmbedder, normalize_rows
+from retrieval import read_local_index_meta
+
+try:
+    import hnswlib
+except ImportError:
+    hnswlib = None
+
+DATA_DIR = Path(__file__).resolve().parents[3] / "data"
+_POPCOUNT = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint16)
+
+def load_corpus(index: str, dimensions: int) -> np.ndarray:
+    if index:
+        meta = read_local_index_meta(index)
+        return np.fromfile(Path(index) / "embeddings.f32", dtype=np.float32).reshape(meta["count"], meta["dimensions"])
+    from ingest import document_chunks
+
+    chunks = [c["chunk"] for path in sorted(DATA_DIR.iterdir()) for c in document_chunks(str(path))]
+    return asyncio.run(HashingEmbedder(dimensions).embed(chunks))
+
+def expand(vectors: np.ndarray, copies: int, noise: float, rng: np.random.Generator) -> np.ndarray:
+    """Perturbed copies of the corpus, to measure at the size of a larger curriculum"""
+    if copies <= 1:
+        return vectors
+    tiled = np.tile(vectors, (copies, 1))
+    return normalize_rows(tiled + rng.normal(0, noise / np.sqrt(vectors.shape[1]), tiled.shape).astype(np.float32))
+
+class Flat:
+    """Exhaustive search over (possibly truncated) float32 vectors"""
+
+    def __init__(self, vectors: np.ndarray):
+        self.vectors = np.ascontiguousarray(vectors)
+        self.bytes_per_vector = vectors.shape[1] * 4
+
+    def scores(self, query: np.ndarray) -> np.ndarray:
+        return self.vectors @ query
+
+class ScalarInt8:
+    """Per-dimension min/max int8 quantization"""
+
+    def __init__(self, vectors: np.ndarray):
+        self.low = vectors.min(axis=0)
+        self.scale = np.maximum(vectors.max(axis=0) - self.low, 1e-12) / 255
+        self.codes = np.round((vectors - self.low) / self.scale).astype(np.uint8)
+        self.bytes_per_vector = vectors.shape[1]
+
+    def scores(self, query: np.ndarray) -> np.ndarray:
+        return self.codes @ (query * self.scale) + float(query @ self.low)
+
+class Binary:
+    """One sign bit per dimension, scored by Hamming distance"""
+
+    def __init__(self, vectors: np.ndarray):
+        self.codes = np.packbits(vectors > 0, axis=1)
+        self.bytes_per_vector = self.codes.shape[1]
+
+    def scores(self, query: np.ndarray) -> np.ndarray:
+        query_code = np.packbits(query > 0)
+        return -_POPCOUNT[np.bitwise_xor(self.codes, query_code)].sum(axis=1, dtype=np.int32)
+
+def top_k(scores: np.ndarray, k: int) -> np.ndarray:
+    k = min(k, len(scores))
+    candidates = np.argpartition(-scores, k - 1)[:k]
+    return candidates[np.argsort(-scores[candidates], kind="stable")]
+
+def truncate(vectors: np.ndarray, dimensions: int) -> np.ndarray:
+    return normalize_rows(np.ascontiguousarray(vectors[:, :dimensions]))
+
+def evaluate(name: str, search, queries: np.ndarray, truth: np.ndarray, k: int, bytes_per_vector: int) -> dict:
+    latencies, recalls = [], []
+    for query, expected in zip(queries, truth):
+        start = time.perf_counter()
+        found = search(query)
+        latencies.append(time.perf_counter() - start)
+        recalls.append(len(set(found.tolist()) & set(expected.tolist())) / len(expected))
+    latencies = np.array(latencies) * 1000
+    return {
+        "setting": name,
+        "recall": float(np.mean(recalls)),
+        "p50_ms": float(np.percentile(latencies, 50)),
+        "p95_ms": float(np.percentile(latencies, 95)),
+        "bytes_per_vector": bytes_per_vector
+    }
+
+def compression_results(corpus: np.ndarray, queries: np.ndarray, truth: np.ndarray, k: int, dimension_options: list[int], oversampling: float) -> list[dict]:
+    results = []
+    for dimensions in dimension_options:
+        vectors = truncate(corpus, dimensions)
+        for label, index in (("float32", Flat(vectors)), ("int8", ScalarInt8(vectors)), ("binary", Binary(vectors))):
+            # Queries arrive at full dimensions and are truncated inside the timed search, like a vectorizer would
+            def plain(q, index=index, dimensions=dimensions):
+                q = q[:dimensions] / np.linalg.norm(q[:dimensions])
+                return top_k(index.scores(q), k)
+
+            def rescored(q, index=index, dimensions=dimensions, vectors=vectors):
+                q = q[:dimensions] / np.linalg.norm(q[:dimensions])
+                candidates = top_k(index.scores(q), int(k * oversampling))
+                return candidates[top_k(vectors[candidates] @ q, k)]
+
+            results.append(evaluate(f"{dimensions}d {label}", plain, queries, truth, k, index.bytes_per_vector))
+            if label != "float32":
+                # Rescoring reads the original vectors, which Azure AI Search keeps alongside the compressed ones
+                results.append(evaluate(f"{dimensions}d {label} + rescore x{oversampling:g}", rescored, queries, truth, k, index.bytes_per_vector))
+    return results
+
+def hnsw_results(corpus: np.ndarray, queries: np.ndarray, truth: np.ndarray, k: int) -> list[dict]:
+    results = []
+    for m in (4, 8, 16):
+        for ef_construction in (100, 400):
+            index = hnswlib.Index(space="ip", dim=corpus.shape[1])
+            index.init_index(max_elements=len(corpus), M=m, ef_construction=ef_construction)
+            index.add_items(corpus)
+            for ef_search in (50, 200, 500):
+                index.set_ef(max(ef_search, k))
+                results.append(evaluate(f"hnsw m={m} efConstruction={ef_construction} efSearch={ef_search}",
+                                        lambda q, index=index: index.knn_query(q, k=k)[0][0], queries, truth, k, corpus.shape[1] * 4 + m * 2 * 4))
+    return results
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--index", help="Local index directory to read embeddings from (see ingest.py)")
+    parser.add_argument("--dimensions", type=int, default=1024, help="Hashing embedder dimensions when no --index is given")
+    parser.add_argument("--scale", type=int, default=50, help="Perturbed copies of the corpus to search over")
+    parser.add_argument("--noise", type=float, default=0.3)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--k", type=int, default=3)
+    parser.add_argument("--oversampling", type=float, default=4)
+    parser.add_argument("--json", help="Write results to this file")
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    base = load_corpus(args.index, args.dimensions)
+    corpus = expand(base, args.scale, args.noise, rng)
+    queries = expand(base[rng.integers(0, len(base), args.queries)], 2, args.noise, rng)[:args.queries]
+    truth = np.array([top_k(corpus @ q, args.k) for q in queries])
+    full = corpus.shape[1]
+    dimension_options = sorted({d for d in (full, 1536, 1024, 512, 256) if d <= full}, reverse=True)
+
+    results = compression_results(corpus, queries, truth, args.k, dimension_options, args.oversampling)
+    if hnswlib is not None:
+        results += hnsw_results(corpus, queries, truth, args.k)
+    else:
+        print("hnswlib is not installed, skipping the HNSW parameter sweep (pip install hnswlib)")
+
+    print(f"{len(corpus)} vectors of {full} dimensions, {len(queries)} queries, recall@{args.k} against exact float32 search")
+    print(f"{'setting':50} {'recall':>7} {'p50 ms':>8} {'p95 ms':>8} {'bytes/vec':>10}")
+    for r in results:
+        print(f"{r['setting']:50} {r['recall']:7.3f} {r['p50_ms']:8.3f} {r['p95_ms']:8.3f} {r['bytes_per_vector']:10d}")
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"vectors": len(corpus), "dimensions": full, "queries": len(queries), "k": args.k, "results": results}, f, indent=2)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,148 @@
+"""Throughput of the relay against the number of worker processes serve.py runs.
+
+Starts the mock realtime server and the load test middle tier through serve.py's launcher, then for each worker
+count runs the load test's levels of concurrent sessions and reports frames/s, p95 relay latency and the CPU
+of all workers together. A worker count's capacity is the highest level whose p95 stays within --slo-ms
+without errors. Capacity grows with the workers until the cores run out: the mock server and the clients
+need cores of their own, give them some with --mock-workers and --client-processes.
+
+    python benchmarks/worker_scaling.py [--workers 1 2 4] [--sessions 50 100 200 400] [--duration 10]
+                                        [--mock-workers 2] [--client-processes 2]
+"""
+import argparse
+import asyncio
+import functools
+import json
+import logging
+import multiprocessing
+import multiprocessing.pool
+import os
+import sys
+import time
+from pathlib import Path
+
+import aiohttp
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from load_test import (
+    MIDDLE_TIER_PORT,
+    MOCK_PORT,
+    Results,
+    client,
+    create_middle_tier_app,
+    create_mock_app,
+    wait_for_port,
+)
+from serve import available_cores, serve
+
+_CLOCK_TICKS = os.sysconf("SC_CLK_TCK")
+
+logging.getLogger("aiohttp.access").setLevel(logging.WARNING)
+
+def workers_cpu_seconds(supervisor: int) -> float:
+    """CPU time of the supervisor's worker processes"""
+    with open(f"/proc/{supervisor}/task/{supervisor}/children") as f:
+        pids = f.read().split()
+    total = 0
+    for pid in pids:
+        try:
+            with open(f"/proc/{pid}/stat") as f:
+                # Fields after the parenthesized command name, utime and stime are the 12th and 13th of them
+                fields = f.read().rsplit(")", 1)[1].split()
+        except FileNotFoundError:
+            continue
+        total += int(fields[11]) + int(fields[12])
+    return total / _CLOCK_TICKS
+
+def worker_count(supervisor: int) -> int:
+    with open(f"/proc/{supervisor}/task/{supervisor}/children") as f:
+        return len(f.read().split())
+
+def run_clients(sessions: int, duration: float, url: str) -> tuple[list[float], int, int]:
+    async def run():
+        results = Results()
+        deadline = time.monotonic() + duration
+        async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=0)) as http:
+            await asyncio.gather(*(client(http, url, deadline, results) for _ in range(sessions)))
+        return results.latencies, results.frames, results.errors
+    return asyncio.run(run())
+
+async def run_level(pool: multiprocessing.pool.Pool, processes: int, sessions: int, duration: float, supervisor: int) -> dict:
+    url = f"http://127.0.0.1:{MIDDLE_TIER_PORT}/realtime"
+    shares = [sessions // processes + (i < sessions % processes) for i in range(processes)]
+    cpu_before = workers_cpu_seconds(supervisor)
+    started_at = time.monotonic()
+    outcomes = await asyncio.to_thread(pool.starmap, run_clients, [(share, duration, url) for share in shares if share])
+    elapsed = time.monotonic() - started_at
+    cpu = workers_cpu_seconds(supervisor) - cpu_before
+    latencies = np.array([latency for outcome in outcomes for latency in outcome[0]] or [0.0])
+    return {
+        "sessions": sessions,
+        "frames_per_second": sum(outcome[1] for outcome in outcomes) / elapsed,
+        "errors": sum(outcome[2] for outcome in outcomes),
+        "p50_ms": float(np.percentile(latencies, 50)),
+        "p95_ms": float(np.percentile(latencies, 95)),
+        "cpu_cores": cpu / elapsed
+    }
+
+async def measure(workers: int, args: argparse.Namespace, pool: multiprocessing.pool.Pool) -> dict:
+    middle_tier = multiprocessing.Process(target=serve, args=(functools.partial(create_middle_tier_app, args.coalesce_window),
+                                                              workers, "127.0.0.1", MIDDLE_TIER_PORT))
+    middle_tier.start()
+    try:
+        await wait_for_port(MIDDLE_TIER_PORT)
+        while worker_count(middle_tier.pid) < workers:
+            await asyncio.sleep(0.1)
+        # Let the other workers finish binding the port, or the first one takes every connection
+        await asyncio.sleep(1)
+        levels = []
+        for sessions in args.sessions:
+            level = await run_level(pool, args.client_processes, sessions, args.duration, middle_tier.pid)
+            levels.append(level)
+            print(f"{workers:3d} workers {sessions:5d} sessions  {level['frames_per_second']:8.0f} frames/s  "
+                  f"p50 {level['p50_ms']:7.2f} ms  p95 {level['p95_ms']:7.2f} ms  cpu {level['cpu_cores']:5.2f} cores  errors {level['errors']}")
+        within_slo = [level["sessions"] for level in levels if level["p95_ms"] <= args.slo_ms and not level["errors"]]
+        return {"workers": workers, "capacity": max(within_slo, default=0), "levels": levels}
+    finally:
+        middle_tier.terminate()
+        middle_tier.join(30)
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--sessions", type=int, nargs="+", default=[50, 100, 200, 400])
+    parser.add_argument("--duration", type=float, default=10, help="Seconds per level")
+    parser.add_argument("--trace", help="JSONL conversation script of server events, a synthetic session is used by default")
+    parser.add_argument("--coalesce-window", type=float, default=0.05, help="Seconds the middle tier holds text deltas to merge them")
+    parser.add_argument("--slo-ms", type=float, default=50, help="p95 relay latency a level has to stay within")
+    parser.add_argument("--mock-workers", type=int, default=1, help="Processes of the mock realtime server")
+    parser.add_argument("--client-processes", type=int, default=1, help="Processes the clients are spread over")
+    parser.add_argument("--json", help="Write results to this file")
+    args = parser.parse_args()
+
+    print(f"{available_cores()} cores available")
+    mock = multiprocessing.Process(target=serve, args=(functools.partial(create_mock_app, args.trace, 1.0, 1, 0),
+                                                       args.mock_workers, "127.0.0.1", MOCK_PORT))
+    mock.start()
+    try:
+        await wait_for_port(MOCK_PORT)
+        results = []
+        with multiprocessing.Pool(args.client_processes) as pool:
+            for workers in args.workers:
+                results.append(await measure(workers, args, pool))
+        print()
+        baseline = results[0]["capacity"]
+        for result in results:
+            scaling = f" ({result['capacity'] / baseline:.1f}x)" if baseline else ""
+            print(f"{result['workers']:3d} workers: {result['capacity']} sessions within {args.slo_ms:g} ms p95{scaling}")
+        if args.json:
+            with open(args.json, "w") as f:
+                json.dump({"duration": args.duration, "slo_ms": args.slo_ms, "results": results}, f, indent=2)
+    finally:
+        mock.terminate()
+        mock.join(30)
+
+if __name__ == "__main__":
+    asyncio.run(main())
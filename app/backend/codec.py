@@ -0,0 +1,89 @@
+import json
+import logging
+from typing import Any, Optional
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgspec
+except ImportError:
+    msgspec = None
+
+logger = logging.getLogger("voicerag")
+
+class JsonCodec:
+    """JSON encoding for websocket frames. dumps returns str since aiohttp text frames are str."""
+    name: str = "json"
+
+    def loads(self, data: str | bytes) -> Any:
+        return json.loads(data)
+
+    def dumps(self, obj: Any) -> str:
+        return json.dumps(obj)
+
+    def event_type(self, data: str | bytes) -> Optional[str]:
+        """The top-level type of an event, if it can be read more cheaply than a full parse"""
+        return None
+
+    def text_delta(self, data: str | bytes) -> str:
+        """The text of a transcript/text delta event, from either its "delta" or "text" field"""
+        message = self.loads(data)
+        return message.get("delta") or message.get("text") or ""
+
+class OrjsonCodec(JsonCodec):
+    name = "orjson"
+
+    def loads(self, data: str | bytes) -> Any:
+        return orjson.loads(data)
+
+    def dumps(self, obj: Any) -> str:
+        return orjson.dumps(obj).decode("utf-8")
+
+if msgspec is not None:
+    class EventHeader(msgspec.Struct):
+        type: str
+
+    class TextDeltaEvent(msgspec.Struct):
+        type: str
+        delta: str = ""
+        text: str = ""
+
+class MsgspecCodec(JsonCodec):
+    name = "msgspec"
+
+    def __init__(self):
+        self._decoder = msgspec.json.Decoder()
+        self._encoder = msgspec.json.Encoder()
+        # Typed decoders skip every field they don't declare, which is most of the payload
+        self._header_decoder = msgspec.json.Decoder(EventHeader)
+        self._text_delta_decoder = msgspec.json.Decoder(TextDeltaEvent)
+
+    def loads(self, data: str | bytes) -> Any:
+        return self._decoder.decode(data)
+
+    def dumps(self, obj: Any) -> str:
+        return self._encoder.encode(obj).decode("utf-8")
+
+    def event_type(self, data: str | bytes) -> Optional[str]:
+        return self._header_decoder.decode(data).type
+
+    def text_delta(self, data: str | bytes) -> str:
+        event = self._text_delta_decoder.decode(data)
+        return event.delta or event.text
+
+CODECS = {"json": JsonCodec, "orjson": OrjsonCodec, "msgspec": MsgspecCodec}
+
+def available_codecs() -> list[str]:
+    return [name for name, module in (("orjson", orjson), ("msgspec", msgspec), ("json", json)) if module is not None]
+
+def get_codec(name: Optional[str] = None) -> JsonCodec:
+    """The named codec, or the fastest installed one. Falls back to the stdlib if the named codec is missing."""
+    if name is None:
+        name = available_codecs()[0]
+    elif name not in available_codecs():
+        logger.warning("JSON codec %s is not installed, falling back to the standard library", name)
+        name = "json"
+    return CODECS[name]()
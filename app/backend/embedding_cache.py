@@ -0,0 +1,141 @@
+import hashlib
+import logging
+import os
+import re
+from pathlib import Path
+from typing import Any, Optional
+
+import numpy as np
+
+from embeddings import Embedder
+
+logger = logging.getLogger("voicerag")
+
+def text_key(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+class EmbeddingCache:
+    """Persistent embeddings for one (model, dimensions), keyed by the SHA-256 of the embedded text.
+
+    Vectors are appended to a float32 matrix file that is memory-mapped for reads, and the sidecar keys file
+    holds one key per line in row order. Keys are written after their vectors, so a crash mid-write leaves at
+    most some unreferenced rows that the next write overwrites.
+    """
+
+    def __init__(self, path: str, model: str, dimensions: int):
+        self.model = model
+        self.dimensions = dimensions
+        self.directory = Path(path) / f"{re.sub(r'[^A-Za-z0-9_.-]', '_', model)}-{dimensions}"
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.vectors_file = self.directory / "vectors.f32"
+        self.keys_file = self.directory / "keys.txt"
+        self._compaction_marker = self.directory / "compacting"
+        self._finish_compaction()
+        self._rows: dict[str, int] = {}
+        if self.keys_file.exists():
+            with open(self.keys_file, encoding="ascii") as f:
+                for line in f:
+                    if line.endswith("\n"):
+                        self._rows[line[:-1]] = len(self._rows)
+        self._vectors: Optional[np.memmap] = None
+        self._used: set[str] = set()
+        self.hits = 0
+        self.misses = 0
+
+    def _finish_compaction(self):
+        """Swap in compacted files; the marker makes an interrupted swap complete on the next open"""
+        if not self._compaction_marker.exists():
+            return
+        for temp_file, target in ((self.keys_file.with_suffix(".tmp"), self.keys_file), (self.vectors_file.with_suffix(".tmp"), self.vectors_file)):
+            if temp_file.exists():
+                os.replace(temp_file, target)
+        self._compaction_marker.unlink()
+
+    def __len__(self) -> int:
+        return len(self._rows)
+
+    def _matrix(self) -> Optional[np.memmap]:
+        if self._vectors is None and self._rows:
+            self._vectors = np.memmap(self.vectors_file, dtype=np.float32, mode="r", shape=(len(self._rows), self.dimensions))
+        return self._vectors
+
+    def get_many(self, keys: list[str]) -> tuple[np.ndarray, list[int]]:
+        """Return a (len(keys), dimensions) matrix filled for cached keys, and the positions of the missing ones"""
+        result = np.zeros((len(keys), self.dimensions), dtype=np.float32)
+        rows = [self._rows.get(key) for key in keys]
+        missing = [i for i, row in enumerate(rows) if row is None]
+        found = [i for i, row in enumerate(rows) if row is not None]
+        if found:
+            result[found] = self._matrix()[[rows[i] for i in found]]
+            self._used.update(keys[i] for i in found)
+        self.hits += len(keys) - len(missing)
+        self.misses += len(missing)
+        return result, missing
+
+    def put_many(self, keys: list[str], vectors: np.ndarray):
+        new = {}
+        for key, vector in zip(keys, vectors):
+            if key not in self._rows and key not in new:
+                new[key] = vector
+        self._used.update(keys)
+        if not new:
+            return
+        with open(self.vectors_file, "ab") as f:
+            f.truncate(len(self._rows) * self.dimensions * 4)  # drop rows left by an interrupted write
+            np.asarray(list(new.values()), dtype=np.float32).tofile(f)
+        with open(self.keys_file, "a", encoding="ascii") as f:
+            f.write("".join(key + "\n" for key in new))
+        for key in new:
+            self._rows[key] = len(self._rows)
+        self._vectors = None
+
+    def compact(self, keep: Optional[set[str]] = None) -> int:
+        """Rewrite the cache with only the keys in keep (default: those used since it was opened), returns entries removed"""
+        keep = self._used if keep is None else keep
+        kept = [key for key in self._rows if key in keep]
+        removed = len(self._rows) - len(kept)
+        if removed == 0:
+            return 0
+        matrix = self._matrix()
+        rows = np.asarray([self._rows[key] for key in kept], dtype=np.int64)
+        temp_vectors = self.vectors_file.with_suffix(".tmp")
+        temp_keys = self.keys_file.with_suffix(".tmp")
+        (matrix[rows] if len(rows) else np.zeros((0, self.dimensions), dtype=np.float32)).tofile(temp_vectors)
+        with open(temp_keys, "w", encoding="ascii") as f:
+            f.write("".join(key + "\n" for key in kept))
+        self._vectors = None
+        del matrix
+        self._compaction_marker.touch()
+        self._finish_compaction()
+        self._rows = {key: i for i, key in enumerate(kept)}
+        logger.info("Compacted embedding cache %s: removed %d entries, %d left", self.directory, removed, len(kept))
+        return removed
+
+    def stats(self) -> dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups > 0 else 0,
+            "entries": len(self._rows),
+            "used": len(self._used),
+            "bytes": self.vectors_file.stat().st_size if self.vectors_file.exists() else 0
+        }
+
+class CachingEmbedder(Embedder):
+    """Embeds only texts that aren't already in the cache"""
+
+    def __init__(self, embedder: Embedder, cache: EmbeddingCache):
+        self.embedder = embedder
+        self.cache = cache
+        self.model = embedder.model
+        self.dimensions = embedder.dimensions
+
+    async def embed(self, texts: list[str]) -> np.ndarray:
+        keys = [text_key(text) for text in texts]
+        vectors, missing = self.cache.get_many(keys)
+        if missing:
+            embedded = await self.embedder.embed([texts[i] for i in missing])
+            vectors[missing] = embedded
+            self.cache.put_many([keys[i] for i in missing], embedded)
+        return vectors
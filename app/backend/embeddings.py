@@ -0,0 +1,95 @@
+import hashlib
+import logging
+import re
+from collections.abc import Awaitable, Callable
+from typing import Optional
+
+import aiohttp
+import numpy as np
+
+logger = logging.getLogger("voicerag")
+
+_TOKEN = re.compile(r"\w+")
+
+def normalize_rows(vectors: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    norms[norms == 0] = 1
+    return vectors / norms
+
+class Embedder:
+    """Turns a batch of texts into a (len(texts), dimensions) float32 matrix"""
+    model: str
+    dimensions: int
+
+    async def embed(self, texts: list[str]) -> np.ndarray:
+        raise NotImplementedError
+
+    async def embed_one(self, text: str) -> np.ndarray:
+        return (await self.embed([text]))[0]
+
+class HashingEmbedder(Embedder):
+    """Deterministic, dependency free embedder for offline use: hashes word unigrams/bigrams and character trigrams"""
+
+    def __init__(self, dimensions: int = 256):
+        self.model = "hashing"
+        self.dimensions = dimensions
+
+    def _features(self, text: str) -> list[str]:
+        words = _TOKEN.findall(text.casefold())
+        features = words + [f"{a} {b}" for a, b in zip(words, words[1:])]
+        for word in words:
+            padded = f"#{word}#"
+            features.extend(padded[i:i + 3] for i in range(len(padded) - 2))
+        return features
+
+    def embed_sync(self, texts: list[str]) -> np.ndarray:
+        vectors = np.zeros((len(texts), self.dimensions), dtype=np.float32)
+        for row, text in enumerate(texts):
+            for feature in self._features(text):
+                digest = hashlib.blake2b(feature.encode("utf-8"), digest_size=8).digest()
+                bucket = int.from_bytes(digest[:4], "little") % self.dimensions
+                vectors[row, bucket] += 1.0 if digest[4] & 1 else -1.0
+        return normalize_rows(vectors)
+
+    async def embed(self, texts: list[str]) -> np.ndarray:
+        return self.embed_sync(texts)
+
+class AzureOpenAIEmbedder(Embedder):
+    """Calls an Azure OpenAI embeddings deployment over REST"""
+    api_version: str = "2024-06-01"
+
+    def __init__(self, endpoint: str, deployment: str, model: str, dimensions: int,
+                 key: Optional[str] = None, token_provider: Optional[Callable[[], Awaitable[str]]] = None,
+                 session: Optional[aiohttp.ClientSession] = None):
+        # The realtime endpoint is configured as wss://, embeddings are served over https from the same resource
+        self.endpoint = re.sub(r"^wss://", "https://", endpoint.rstrip("/"))
+        self.deployment = deployment
+        self.model = model
+        self.dimensions = dimensions
+        self.key = key
+        self.token_provider = token_provider
+        self._session = session
+        self._owns_session = session is None
+
+    async def embed(self, texts: list[str]) -> np.ndarray:
+        if self._session is None:
+            self._session = aiohttp.ClientSession()
+        headers = {"api-key": self.key} if self.key is not None else {"Authorization": f"Bearer {await self.token_provider()}"}
+        url = f"{self.endpoint}/openai/deployments/{self.deployment}/embeddings"
+        async with self._session.post(url, params={"api-version": self.api_version}, headers=headers,
+                                      json={"input": texts, "dimensions": self.dimensions}) as response:
+            response.raise_for_status()
+            body = await response.json()
+        data = sorted(body["data"], key=lambda d: d["index"])
+        return normalize_rows(np.array([d["embedding"] for d in data], dtype=np.float32))
+
+    async def close(self):
+        if self._owns_session and self._session is not None:
+            await self._session.close()
+
+def create_embedder(model: str, dimensions: int, endpoint: Optional[str] = None, deployment: Optional[str] = None,
+                    key: Optional[str] = None, token_provider: Optional[Callable[[], Awaitable[str]]] = None) -> Embedder:
+    """Build the embedder for a model name, "hashing" selects the offline HashingEmbedder"""
+    if model == "hashing":
+        return HashingEmbedder(dimensions)
+    return AzureOpenAIEmbedder(endpoint, deployment, model, dimensions, key=key, token_provider=token_provider)
@@ -0,0 +1,296 @@
+import asyncio
+import hashlib
+import logging
+import os
+import re
+import time
+from collections.abc import Callable, Iterable, Iterator
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from pathlib import Path
+from typing import Optional
+
+import numpy as np
+
+from embeddings import Embedder
+
+try:
+    import pypdf
+except ImportError:
+    pypdf = None
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+logger = logging.getLogger("voicerag")
+
+# Same page length and overlap as the SplitSkill in setup_intvect.setup_index, measured in characters by default
+MAX_CHUNK_LENGTH = 2000
+CHUNK_OVERLAP = 500
+
+def extract_pages(path: str) -> Iterator[str]:
+    """Yield the text of a document one page at a time"""
+    if path.lower().endswith(".pdf"):
+        if pypdf is None:
+            raise RuntimeError("Reading PDFs requires pypdf, install it with: pip install pypdf")
+        for page in pypdf.PdfReader(path).pages:
+            yield page.extract_text() or ""
+    else:
+        with open(path, encoding="utf-8") as f:
+            yield f.read()
+
+_TOKEN = re.compile(r"\S+\s*")
+
+def iter_tokens(pages: Iterable[str]) -> Iterator[str]:
+    """Split text into whitespace-delimited tokens (with their trailing whitespace) so chunks never cut a word"""
+    for page in pages:
+        for match in _TOKEN.finditer(page):
+            yield match.group(0)
+        yield "\n"
+
+def chunk_tokens(tokens: Iterable[str], max_length: int = MAX_CHUNK_LENGTH, overlap: int = CHUNK_OVERLAP,
+                 length: Callable[[str], int] = len) -> Iterator[str]:
+    """Pack tokens into chunks of at most max_length, each starting with up to overlap of the previous chunk's end.
+
+    Works on a stream so a document is never held in memory as a whole. A single token longer than max_length
+    becomes a chunk of its own.
+    """
+    window: list[str] = []
+    window_length = 0
+    fresh = False  # whether the window holds anything not already emitted
+    for token in tokens:
+        token_length = length(token)
+        if window and window_length + token_length > max_length:
+            yield "".join(window).strip()
+            # Keep the tail of the chunk as the overlap for the next one
+            kept, kept_length = [], 0
+            for previous in reversed(window):
+                if kept_length + length(previous) > overlap:
+                    break
+                kept.append(previous)
+                kept_length += length(previous)
+            window, window_length = kept[::-1], kept_length
+            while window and window_length + token_length > max_length:
+                window_length -= length(window.pop(0))
+            fresh = False
+        window.append(token)
+        window_length += token_length
+        fresh = fresh or bool(token.strip())
+    if fresh:
+        yield "".join(window).strip()
+
+@lru_cache
+def length_function(tokenizer: Optional[str] = None) -> Callable[[str], int]:
+    """How chunk_tokens measures text: characters for None or "chars", or "tiktoken:<encoding>" (e.g.
+    tiktoken:cl100k_base) for tokens of that encoding, counted word by word so slightly over the whole text's count"""
+    if tokenizer in (None, "", "chars"):
+        return len
+    kind, _, encoding_name = tokenizer.partition(":")
+    if kind != "tiktoken" or not encoding_name:
+        raise ValueError(f"Unknown tokenizer: {tokenizer}")
+    if tiktoken is None:
+        raise RuntimeError("Counting tokens requires tiktoken, install it with: pip install tiktoken")
+    encoding = tiktoken.get_encoding(encoding_name)
+    return lambda text: len(encoding.encode_ordinary(text))
+
+def document_chunks(path: str, max_length: int = MAX_CHUNK_LENGTH, overlap: int = CHUNK_OVERLAP,
+                    tokenizer: Optional[str] = None) -> list[dict[str, str]]:
+    """Extract and chunk one file. Runs in a worker process, so it only takes and returns picklable values: the
+    tokenizer is named, see length_function"""
+    title = os.path.basename(path)
+    parent_id = hashlib.sha256(title.encode("utf-8")).hexdigest()[:32]
+    chunks = chunk_tokens(iter_tokens(extract_pages(path)), max_length, overlap, length_function(tokenizer))
+    return [{"chunk_id": f"{parent_id}_pages_{i}", "parent_id": parent_id, "title": title, "chunk": chunk}
+            for i, chunk in enumerate(chunks) if chunk]
+
+class IngestStats:
+    def __init__(self):
+        self.started_at = time.perf_counter()
+        self.files = 0
+        self.chunks = 0
+        self.characters = 0
+        self.embedded = 0
+        self.uploaded = 0
+        self.extract_seconds = 0.0
+        self.embed_seconds = 0.0
+        self.upload_seconds = 0.0
+
+    def snapshot(self) -> dict[str, float]:
+        elapsed = time.perf_counter() - self.started_at
+        return {
+            "files": self.files,
+            "chunks": self.chunks,
+            "characters": self.characters,
+            "embedded": self.embedded,
+            "uploaded": self.uploaded,
+            "extract_seconds": round(self.extract_seconds, 3),
+            "embed_seconds": round(self.embed_seconds, 3),
+            "upload_seconds": round(self.upload_seconds, 3),
+            "elapsed_seconds": round(elapsed, 3),
+            "chunks_per_second": round(self.chunks / elapsed, 1) if elapsed > 0 else 0
+        }
+
+class ChunkSink:
+    """Where embedded chunks go, one batch at a time"""
+
+    async def write(self, documents: list[dict[str, str]], embeddings: np.ndarray) -> None:
+        raise NotImplementedError
+
+    async def close(self) -> None:
+        pass
+
+class LocalIndexSink(ChunkSink):
+    """Collects batches and writes a LocalSearchBackend index directory on close"""
+
+    def __init__(self, path: str, model: str):
+        self.path = path
+        self.model = model
+        self.documents: list[dict[str, str]] = []
+        self.embeddings: list[np.ndarray] = []
+
+    async def write(self, documents: list[dict[str, str]], embeddings: np.ndarray) -> None:
+        self.documents.extend(documents)
+        self.embeddings.append(embeddings)
+
+    async def close(self) -> None:
+        from retrieval import write_local_index
+
+        if self.embeddings:
+            await asyncio.to_thread(write_local_index, self.path, self.documents, np.concatenate(self.embeddings), self.model)
+
+class AzureSearchSink(ChunkSink):
+    """Uploads batches to an Azure AI Search index with the fields created by setup_intvect.setup_index"""
+
+    def __init__(self, search_client, embedding_field: str = "text_vector"):
+        self.search_client = search_client
+        self.embedding_field = embedding_field
+
+    async def write(self, documents: list[dict[str, str]], embeddings: np.ndarray) -> None:
+        batch = [{**doc, self.embedding_field: vector.tolist()} for doc, vector in zip(documents, embeddings)]
+        results = await self.search_client.merge_or_upload_documents(batch)
+        failed = [r.key for r in results if not r.succeeded]
+        if failed:
+            raise RuntimeError(f"Failed to upload {len(failed)} chunks, first: {failed[0]}")
+
+    async def close(self) -> None:
+        await self.search_client.close()
+
+async def ingest(paths: list[str], embedder: Embedder, sink: ChunkSink, batch_size: int = 64,
+                 max_workers: Optional[int] = None, max_length: int = MAX_CHUNK_LENGTH, overlap: int = CHUNK_OVERLAP,
+                 tokenizer: Optional[str] = None) -> IngestStats:
+    """Extract and chunk files in a process pool, then embed and write the chunks in batches as files complete.
+    max_length and overlap are in characters, or in tokens of the named tokenizer (see length_function)"""
+    stats = IngestStats()
+    loop = asyncio.get_running_loop()
+    pending: list[dict[str, str]] = []
+
+    async def write_batch(batch: list[dict[str, str]]):
+        started_at = time.perf_counter()
+        embeddings = await embedder.embed([doc["chunk"] for doc in batch])
+        stats.embed_seconds += time.perf_counter() - started_at
+        stats.embedded += len(batch)
+        started_at = time.perf_counter()
+        await sink.write(batch, embeddings)
+        stats.upload_seconds += time.perf_counter() - started_at
+        stats.uploaded += len(batch)
+
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        extract_started_at = time.perf_counter()
+        jobs = [loop.run_in_executor(executor, document_chunks, path, max_length, overlap, tokenizer) for path in paths]
+        for job in asyncio.as_completed(jobs):
+            chunks = await job
+            stats.files += 1
+            stats.chunks += len(chunks)
+            stats.characters += sum(len(c["chunk"]) for c in chunks)
+            pending.extend(chunks)
+            while len(pending) >= batch_size:
+                batch, pending = pending[:batch_size], pending[batch_size:]
+                await write_batch(batch)
+        stats.extract_seconds = time.perf_counter() - extract_started_at - stats.embed_seconds - stats.upload_seconds
+    if pending:
+        await write_batch(pending)
+    started_at = time.perf_counter()
+    await sink.close()
+    stats.upload_seconds += time.perf_counter() - started_at
+    return stats
+
+if __name__ == "__main__":
+    import argparse
+    import json
+
+    from azure.core.credentials import AzureKeyCredential
+    from azure.identity.aio import AzureDeveloperCliCredential
+    from azure.search.documents.aio import SearchClient
+    from dotenv import load_dotenv
+
+    from auth import AsyncTokenManager
+    from embedding_cache import CachingEmbedder, EmbeddingCache
+    from embeddings import AzureOpenAIEmbedder, create_embedder
+
+    logging.basicConfig(level=logging.INFO)
+    load_dotenv()
+    parser = argparse.ArgumentParser(description="Chunk, embed and index documents without the Azure AI Search skillset")
+    parser.add_argument("paths", nargs="*", default=["../../data"], help="Files or directories to ingest")
+    parser.add_argument("--target", choices=["local", "azure"], default="local")
+    parser.add_argument("--out", default=os.environ.get("LOCAL_INDEX_DIR") or "local_index", help="Index directory for --target local")
+    parser.add_argument("--model", default=os.environ.get("AZURE_OPENAI_EMBEDDING_MODEL") or "hashing", help="Embedding model, or 'hashing' for offline use")
+    parser.add_argument("--dimensions", type=int, default=256)
+    parser.add_argument("--batch-size", type=int, default=64)
+    parser.add_argument("--workers", type=int, default=None, help="Extraction processes (default: one per core)")
+    parser.add_argument("--max-length", type=int, default=MAX_CHUNK_LENGTH)
+    parser.add_argument("--overlap", type=int, default=CHUNK_OVERLAP)
+    parser.add_argument("--tokenizer", default=os.environ.get("INGEST_TOKENIZER"),
+                        help="Measure --max-length and --overlap in tokens, e.g. tiktoken:cl100k_base (default: characters)")
+    parser.add_argument("--embedding-cache", default=os.environ.get("EMBEDDING_CACHE_DIR") or ".embedding_cache",
+                        help="Directory of cached embeddings, so unchanged chunks aren't embedded again ('' to disable)")
+    parser.add_argument("--compact-cache", action="store_true", help="Drop cached embeddings of chunks that no longer exist")
+    args = parser.parse_args()
+    # Fail on a bad tokenizer before starting the worker processes
+    length_function(args.tokenizer)
+
+    paths = []
+    for path in args.paths:
+        paths.extend(sorted(str(p) for p in Path(path).iterdir() if p.is_file()) if os.path.isdir(path) else [path])
+
+    async def main():
+        credential = None
+        token_manager = None
+        if not os.environ.get("AZURE_OPENAI_API_KEY") or not os.environ.get("AZURE_SEARCH_API_KEY"):
+            credential = AzureDeveloperCliCredential(tenant_id=os.environ.get("AZURE_TENANT_ID"), process_timeout=60)
+        if args.model != "hashing" and not os.environ.get("AZURE_OPENAI_API_KEY"):
+            token_manager = AsyncTokenManager(credential, "https://cognitiveservices.azure.com/.default")
+        embedder = create_embedder(args.model, args.dimensions,
+            endpoint=os.environ.get("AZURE_OPENAI_ENDPOINT"),
+            deployment=os.environ.get("AZURE_OPENAI_EMBEDDING_DEPLOYMENT"),
+            key=os.environ.get("AZURE_OPENAI_API_KEY"),
+            token_provider=token_manager.get_token if token_manager is not None else None)
+        model_embedder = embedder
+        cache = None
+        if args.embedding_cache:
+            cache = EmbeddingCache(args.embedding_cache, embedder.model, embedder.dimensions)
+            embedder = CachingEmbedder(embedder, cache)
+        if args.target == "azure":
+            search_key = os.environ.get("AZURE_SEARCH_API_KEY")
+            sink = AzureSearchSink(SearchClient(os.environ["AZURE_SEARCH_ENDPOINT"], os.environ["AZURE_SEARCH_INDEX"],
+                                                AzureKeyCredential(search_key) if search_key else credential))
+        else:
+            sink = LocalIndexSink(args.out, embedder.model)
+        try:
+            stats = await ingest(paths, embedder, sink, args.batch_size, args.workers, args.max_length, args.overlap,
+                                 args.tokenizer)
+        finally:
+            if isinstance(model_embedder, AzureOpenAIEmbedder):
+                await model_embedder.close()
+            if token_manager is not None:
+                await token_manager.close()
+            if credential is not None:
+                await credential.close()
+        result = stats.snapshot()
+        if cache is not None:
+            if args.compact_cache:
+                cache.compact()
+            result["embedding_cache"] = cache.stats()
+        print(json.dumps(result, indent=2))
+    asyncio.run(main())
@@ -0,0 +1,168 @@
+import math
+from bisect import bisect_left
+from collections.abc import Callable, Iterable
+from typing import Any, Optional
+
+from aiohttp import web
+
+# Metrics are updated from the event loop thread only, so they are plain counters without locks:
+# an update is a dict lookup and an add.
+
+LATENCY_BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _format_labels(names: tuple[str, ...], values: tuple[str, ...]) -> str:
+    if not names:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(str(value))}"' for name, value in zip(names, values)) + "}"
+
+class Metric:
+    kind = "untyped"
+
+    def __init__(self, name: str, help: str, labelnames: Iterable[str] = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+
+    def samples(self) -> Iterable[tuple[str, str, float]]:
+        """(name suffix, formatted labels, value) triples"""
+        raise NotImplementedError
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        lines.extend(f"{self.name}{suffix}{labels} {_format_value(value)}" for suffix, labels, value in self.samples())
+        return "\n".join(lines)
+
+class Counter(Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, help: str, labelnames: Iterable[str] = ()):
+        super().__init__(name, help, labelnames)
+        self._values: dict[tuple[str, ...], float] = {} if self.labelnames else {(): 0}
+
+    def inc(self, amount: float = 1, *labels: str):
+        self._values[labels] = self._values.get(labels, 0) + amount
+
+    def value(self, *labels: str) -> float:
+        return self._values.get(labels, 0)
+
+    def samples(self):
+        for labels, value in list(self._values.items()):
+            yield "_total", _format_labels(self.labelnames, labels), value
+
+class Gauge(Metric):
+    """A value that goes up and down, or is read from function when the metrics are collected"""
+    kind = "gauge"
+
+    def __init__(self, name: str, help: str, labelnames: Iterable[str] = (), function: Optional[Callable[[], float]] = None):
+        super().__init__(name, help, labelnames)
+        self.function = function
+        # Metrics without labels are exported from the start, as 0
+        self._values: dict[tuple[str, ...], float] = {} if self.labelnames or function is not None else {(): 0}
+
+    def set(self, value: float, *labels: str):
+        self._values[labels] = value
+
+    def inc(self, amount: float = 1, *labels: str):
+        self._values[labels] = self._values.get(labels, 0) + amount
+
+    def dec(self, amount: float = 1, *labels: str):
+        self._values[labels] = self._values.get(labels, 0) - amount
+
+    def value(self, *labels: str) -> float:
+        return self._values.get(labels, 0)
+
+    def samples(self):
+        if self.function is not None:
+            yield "", "", self.function()
+        for labels, value in list(self._values.items()):
+            yield "", _format_labels(self.labelnames, labels), value
+
+class HistogramSeries:
+    """The buckets of one label set, bind it once with Histogram.labels() on hot paths"""
+    __slots__ = ("buckets", "counts", "sum")
+
+    def __init__(self, buckets: tuple[float, ...]):
+        self.buckets = buckets
+        # One count per bucket, the last one for values above every bound
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, labelnames: Iterable[str] = (), buckets: Iterable[float] = LATENCY_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._series: dict[tuple[str, ...], HistogramSeries] = {}
+
+    def labels(self, *labels: str) -> HistogramSeries:
+        series = self._series.get(labels)
+        if series is None:
+            series = self._series[labels] = HistogramSeries(self.buckets)
+        return series
+
+    def observe(self, value: float, *labels: str):
+        self.labels(*labels).observe(value)
+
+    def count(self, *labels: str) -> int:
+        series = self._series.get(labels)
+        return sum(series.counts) if series else 0
+
+    def samples(self):
+        for labels, series in list(self._series.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (math.inf,), series.counts):
+                cumulative += count
+                yield "_bucket", _format_labels(self.labelnames + ("le",), labels + (_format_value(bound),)), cumulative
+            yield "_count", _format_labels(self.labelnames, labels), cumulative
+            yield "_sum", _format_labels(self.labelnames, labels), series.sum
+
+class Registry:
+    def __init__(self):
+        self.metrics: dict[str, Metric] = {}
+        self.snapshots: dict[str, tuple[str, Callable[[], dict[str, Any]]]] = {}
+
+    def register(self, metric: Metric) -> Metric:
+        # Re-registering a name returns the existing metric, so modules can be reloaded and tiers instantiated twice
+        return self.metrics.setdefault(metric.name, metric)
+
+    def counter(self, name: str, help: str, labelnames: Iterable[str] = ()) -> Counter:
+        return self.register(Counter(name, help, labelnames))
+
+    def gauge(self, name: str, help: str, labelnames: Iterable[str] = (), function: Optional[Callable[[], float]] = None) -> Gauge:
+        return self.register(Gauge(name, help, labelnames, function))
+
+    def histogram(self, name: str, help: str, labelnames: Iterable[str] = (), buckets: Iterable[float] = LATENCY_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, help, labelnames, buckets))
+
+    def register_snapshot(self, prefix: str, help: str, function: Callable[[], dict[str, Any]]):
+        """Export each numeric value of a stats() style dict as the gauge {prefix}_{key}"""
+        self.snapshots[prefix] = (help, function)
+
+    def render(self) -> str:
+        parts = [metric.render() for metric in self.metrics.values()]
+        for prefix, (help, function) in self.snapshots.items():
+            for key, value in function().items():
+                if isinstance(value, (int, float)) and not isinstance(value, bool):
+                    parts.append(f"# HELP {prefix}_{key} {help}\n# TYPE {prefix}_{key} gauge\n{prefix}_{key} {_format_value(value)}")
+        return "\n".join(parts) + "\n"
+
+REGISTRY = Registry()
+
+async def metrics_handler(_request: web.Request) -> web.Response:
+    return web.Response(text=REGISTRY.render(), content_type="text/plain", headers={"X-Content-Type-Options": "nosniff"},
+                        charset="utf-8")
@@ -0,0 +1,200 @@
+import json
+import logging
+import sqlite3
+import threading
+from datetime import datetime
+from pathlib import Path
+from typing import Optional
+
+from progress_tracker import DIFFICULTIES, ProgressStore, empty_summary
+
+logger = logging.getLogger("voicerag")
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    user_id TEXT PRIMARY KEY,
+    grade INTEGER,
+    classroom TEXT
+);
+CREATE INDEX IF NOT EXISTS users_grade ON users (grade, classroom);
+CREATE TABLE IF NOT EXISTS interactions (
+    id INTEGER PRIMARY KEY,
+    user_id TEXT NOT NULL,
+    timestamp TEXT NOT NULL,
+    question TEXT,
+    answer TEXT,
+    difficulty TEXT NOT NULL,
+    is_correct INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS interactions_user_time ON interactions (user_id, timestamp);
+CREATE INDEX IF NOT EXISTS interactions_time_difficulty ON interactions (timestamp, difficulty);
+-- Aggregates maintained on every insert, so summaries and cohort queries never scan interactions
+CREATE TABLE IF NOT EXISTS user_stats (
+    user_id TEXT NOT NULL,
+    difficulty TEXT NOT NULL,
+    total INTEGER NOT NULL,
+    correct INTEGER NOT NULL,
+    PRIMARY KEY (user_id, difficulty)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS daily_stats (
+    day TEXT NOT NULL,
+    user_id TEXT NOT NULL,
+    difficulty TEXT NOT NULL,
+    total INTEGER NOT NULL,
+    correct INTEGER NOT NULL,
+    PRIMARY KEY (day, user_id, difficulty)
+) WITHOUT ROWID;
+"""
+
+_UPSERT_STATS = """
+INSERT INTO {table} ({keys}, total, correct) VALUES ({placeholders}, 1, ?)
+ON CONFLICT DO UPDATE SET total = total + 1, correct = correct + excluded.correct
+"""
+
+class SqliteProgressStore(ProgressStore):
+    """Progress in a single SQLite database (WAL mode), with per-user and per-day aggregates and cohort queries.
+
+    Like every ProgressStore its methods block; call the cohort queries from a worker thread in async code.
+    """
+
+    def __init__(self, path: str = "progress.db"):
+        self.path = path
+        self._db = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+        self._db.row_factory = sqlite3.Row
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.executescript(_SCHEMA)
+        self._lock = threading.Lock()
+        self._upsert_user_stats = _UPSERT_STATS.format(table="user_stats", keys="user_id, difficulty", placeholders="?, ?")
+        self._upsert_daily_stats = _UPSERT_STATS.format(table="daily_stats", keys="day, user_id, difficulty", placeholders="?, ?, ?")
+
+    def load_summary(self, user_id: str) -> dict:
+        summary = empty_summary(user_id)
+        with self._lock:
+            rows = self._db.execute("SELECT difficulty, total, correct FROM user_stats WHERE user_id = ?", (user_id,)).fetchall()
+        for row in rows:
+            summary["total_questions"] += row["total"]
+            summary["correct_answers"] += row["correct"]
+            summary["difficulty_stats"][row["difficulty"]] = row["total"]
+            summary["correct_by_difficulty"][row["difficulty"]] = row["correct"]
+        return summary
+
+    def append(self, user_id: str, interactions: list[dict]):
+        with self._lock:
+            self._db.execute("BEGIN")
+            try:
+                for i in interactions:
+                    correct = 1 if i["is_correct"] else 0
+                    self._db.execute(
+                        "INSERT INTO interactions (user_id, timestamp, question, answer, difficulty, is_correct) VALUES (?, ?, ?, ?, ?, ?)",
+                        (user_id, i["timestamp"], i.get("question"), i.get("answer"), i["difficulty"], correct))
+                    self._db.execute(self._upsert_user_stats, (user_id, i["difficulty"], correct))
+                    self._db.execute(self._upsert_daily_stats, (i["timestamp"][:10], user_id, i["difficulty"], correct))
+                self._db.execute("COMMIT")
+            except BaseException:
+                self._db.execute("ROLLBACK")
+                raise
+
+    def recent(self, user_id: str, limit: int) -> list[dict]:
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT timestamp, question, answer, difficulty, is_correct FROM interactions "
+                "WHERE user_id = ? ORDER BY timestamp DESC, id DESC LIMIT ?", (user_id, limit)).fetchall()
+        return [{**dict(row), "is_correct": bool(row["is_correct"])} for row in reversed(rows)]
+
+    def set_user(self, user_id: str, grade: Optional[int] = None, classroom: Optional[str] = None):
+        with self._lock:
+            self._db.execute(
+                "INSERT INTO users (user_id, grade, classroom) VALUES (?, ?, ?) "
+                "ON CONFLICT DO UPDATE SET grade = coalesce(excluded.grade, grade), classroom = coalesce(excluded.classroom, classroom)",
+                (user_id, grade, classroom))
+
+    def _cohort_filter(self, grade: Optional[int], classroom: Optional[str], since: Optional[datetime], until: Optional[datetime]) -> tuple[str, list]:
+        clauses, params = [], []
+        if grade is not None:
+            clauses.append("u.grade = ?")
+            params.append(grade)
+        if classroom is not None:
+            clauses.append("u.classroom = ?")
+            params.append(classroom)
+        if since is not None:
+            clauses.append("d.day >= ?")
+            params.append(since.date().isoformat())
+        if until is not None:
+            clauses.append("d.day <= ?")
+            params.append(until.date().isoformat())
+        join = "JOIN users u ON u.user_id = d.user_id" if grade is not None or classroom is not None else ""
+        where = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+        return f"FROM daily_stats d {join} {where}", params
+
+    def accuracy_by_difficulty(self, grade: Optional[int] = None, classroom: Optional[str] = None,
+                               since: Optional[datetime] = None, until: Optional[datetime] = None) -> dict[str, dict]:
+        """Totals and accuracy per difficulty for a cohort, e.g. grade 5 since Monday. Day granularity."""
+        source, params = self._cohort_filter(grade, classroom, since, until)
+        with self._lock:
+            rows = self._db.execute(f"SELECT d.difficulty, sum(d.total) AS total, sum(d.correct) AS correct {source} GROUP BY d.difficulty", params).fetchall()
+        result = {d: {"total": 0, "correct": 0, "accuracy": 0} for d in DIFFICULTIES}
+        for row in rows:
+            result[row["difficulty"]] = {
+                "total": row["total"],
+                "correct": row["correct"],
+                "accuracy": row["correct"] / row["total"] * 100 if row["total"] else 0
+            }
+        return result
+
+    def user_summaries(self, grade: Optional[int] = None, classroom: Optional[str] = None,
+                       since: Optional[datetime] = None, until: Optional[datetime] = None) -> list[dict]:
+        """Per-student totals and accuracy for a cohort, most active students first"""
+        source, params = self._cohort_filter(grade, classroom, since, until)
+        with self._lock:
+            rows = self._db.execute(
+                f"SELECT d.user_id, sum(d.total) AS total, sum(d.correct) AS correct {source} "
+                "GROUP BY d.user_id ORDER BY total DESC", params).fetchall()
+        return [{
+            "user_id": row["user_id"],
+            "total_questions": row["total"],
+            "correct_answers": row["correct"],
+            "accuracy": row["correct"] / row["total"] * 100 if row["total"] else 0
+        } for row in rows]
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+def migrate_json_progress(storage_dir: str, store: SqliteProgressStore) -> int:
+    """Import per-user progress files (the original {user_id}.json format and {user_id}.jsonl logs) into SQLite"""
+    imported = 0
+    for path in sorted(Path(storage_dir).iterdir()):
+        if path.name.endswith(".summary.json") or (path.suffix == ".json" and path.with_suffix(".jsonl").exists()):
+            continue  # the log supersedes an original file left next to it
+        if path.suffix == ".jsonl":
+            with open(path) as f:
+                interactions = [json.loads(line) for line in f if line.strip()]
+        elif path.suffix == ".json":
+            with open(path) as f:
+                interactions = json.load(f).get("interactions", [])
+        else:
+            continue
+        user_id = path.stem
+        if store.load_summary(user_id)["total_questions"] > 0:
+            logger.info("Skipping %s, already imported", user_id)
+            continue
+        if interactions:
+            store.append(user_id, interactions)
+            store.set_user(user_id)
+        imported += len(interactions)
+        logger.info("Imported %d interactions for %s", len(interactions), user_id)
+    return imported
+
+if __name__ == "__main__":
+    import argparse
+
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Import per-user JSON progress files into a SQLite progress database")
+    parser.add_argument("storage_dir", nargs="?", default="progress_data")
+    parser.add_argument("database", nargs="?", default="progress.db")
+    args = parser.parse_args()
+    store = SqliteProgressStore(args.database)
+    total = migrate_json_progress(args.storage_dir, store)
+    store.close()
+    logger.info("Imported %d interactions into %s", total, args.database)
@@ -1,89 +1,412 @@
-from typing import Dict, List
+import asyncio
 import json
+import logging
+import os
+import re
+import threading
+from collections import OrderedDict, defaultdict, deque
 from datetime import datetime
 from pathlib import Path
-import os
+from typing import Optional
+
+logger = logging.getLogger("voicerag")
+
+# User ids name files in the progress store, so they are restricted to characters that can't leave its directory
+USER_ID_PATTERN = re.compile(r"^[A-Za-z0-9_-]{1,64}$")
+
+def is_valid_user_id(user_id: str) -> bool:
+    return USER_ID_PATTERN.match(user_id) is not None
+
+DIFFICULTIES = ("easy", "medium", "hard")
+
+def empty_summary(user_id: str) -> dict:
+    return {
+        "user_id": user_id,
+        "total_questions": 0,
+        "correct_answers": 0,
+        "difficulty_stats": {d: 0 for d in DIFFICULTIES},
+        "correct_by_difficulty": {d: 0 for d in DIFFICULTIES}
+    }
+
+def apply_interaction(summary: dict, interaction: dict):
+    """Fold one interaction into a summary's counters"""
+    difficulty = interaction["difficulty"]
+    summary["total_questions"] += 1
+    summary["difficulty_stats"][difficulty] = summary["difficulty_stats"].get(difficulty, 0) + 1
+    if interaction["is_correct"]:
+        summary["correct_answers"] += 1
+        summary["correct_by_difficulty"][difficulty] = summary["correct_by_difficulty"].get(difficulty, 0) + 1
+
+class ProgressStore:
+    """Durable storage behind ProgressTracker. Methods are blocking and are called from a worker thread."""
+
+    def load_summary(self, user_id: str) -> dict:
+        raise NotImplementedError
+
+    def append(self, user_id: str, interactions: list[dict]):
+        raise NotImplementedError
+
+    def recent(self, user_id: str, limit: int) -> list[dict]:
+        raise NotImplementedError
+
+    def compact(self, user_id: str):
+        """Checkpoint the counters so loading them doesn't replay the whole history"""
+        pass
+
+    def set_user(self, user_id: str, grade: Optional[int] = None, classroom: Optional[str] = None):
+        """Record cohort details for stores that support cohort queries"""
+        pass
+
+    def close(self):
+        pass
+
+class JsonlProgressStore(ProgressStore):
+    """Append-only {user_id}.jsonl interaction log per user, with counters checkpointed in {user_id}.summary.json.
+
+    The summary records how many bytes of the log it covers, so loading counters only replays the log written
+    since the last compaction. Compaction only rewrites the summary: the log keeps every interaction, as the
+    student's full history (progress_db.py imports it), so it grows by one line per answer and is never truncated.
+    Files in the original {user_id}.json format are converted on first access.
+    """
 
-class ProgressTracker:
     def __init__(self, storage_dir: str = "progress_data"):
         self.storage_dir = Path(storage_dir)
         self.storage_dir.mkdir(exist_ok=True)
-        
+
+    def _user_file(self, user_id: str, suffix: str) -> Path:
+        if not is_valid_user_id(user_id):
+            raise ValueError(f"Invalid user id {user_id!r}")
+        return self.storage_dir / f"{user_id}{suffix}"
+
+    def _log_file(self, user_id: str) -> Path:
+        return self._user_file(user_id, ".jsonl")
+
+    def _summary_file(self, user_id: str) -> Path:
+        return self._user_file(user_id, ".summary.json")
+
+    def _write_summary(self, user_id: str, summary: dict, log_offset: int):
+        summary_file = self._summary_file(user_id)
+        temp_file = summary_file.with_suffix(".tmp")
+        with open(temp_file, 'w') as f:
+            json.dump({**summary, "log_offset": log_offset}, f)
+        os.replace(temp_file, summary_file)
+
+    def _migrate_legacy(self, user_id: str):
+        legacy_file = self._user_file(user_id, ".json")
+        if not legacy_file.exists() or self._log_file(user_id).exists():
+            return
+        with open(legacy_file) as f:
+            data = json.load(f)
+        with open(self._log_file(user_id), 'w') as f:
+            for interaction in data.get("interactions", []):
+                f.write(json.dumps(interaction) + "\n")
+        summary = empty_summary(user_id)
+        for key in ("total_questions", "correct_answers", "difficulty_stats", "correct_by_difficulty"):
+            summary[key] = data[key]
+        self._write_summary(user_id, summary, self._log_file(user_id).stat().st_size)
+        legacy_file.rename(legacy_file.with_suffix(".json.migrated"))
+        logger.info("Migrated progress file for %s to the append-only format", user_id)
+
+    def _replay(self, user_id: str) -> tuple[dict, int]:
+        self._migrate_legacy(user_id)
+        summary, offset = empty_summary(user_id), 0
+        if self._summary_file(user_id).exists():
+            with open(self._summary_file(user_id)) as f:
+                summary = json.load(f)
+            offset = summary.pop("log_offset", 0)
+        log_file = self._log_file(user_id)
+        if log_file.exists():
+            with open(log_file, 'rb') as f:
+                f.seek(offset)
+                for line in f:
+                    if not line.endswith(b"\n"):
+                        break  # partially written line, picked up on the next replay
+                    apply_interaction(summary, json.loads(line))
+                    offset += len(line)
+        return summary, offset
+
+    def load_summary(self, user_id: str) -> dict:
+        return self._replay(user_id)[0]
+
+    def append(self, user_id: str, interactions: list[dict]):
+        self._migrate_legacy(user_id)
+        with open(self._log_file(user_id), 'a') as f:
+            f.write("".join(json.dumps(i) + "\n" for i in interactions))
+
+    def recent(self, user_id: str, limit: int) -> list[dict]:
+        self._migrate_legacy(user_id)
+        log_file = self._log_file(user_id)
+        if limit <= 0 or not log_file.exists():
+            return []
+        # Read backwards from the end of the log until we have enough complete lines
+        with open(log_file, 'rb') as f:
+            f.seek(0, os.SEEK_END)
+            position = f.tell()
+            data = b""
+            while position > 0 and data.count(b"\n") <= limit:
+                read_size = min(8192, position)
+                position -= read_size
+                f.seek(position)
+                data = f.read(read_size) + data
+        lines = [line for line in data.split(b"\n") if line]
+        if position > 0:
+            lines = lines[1:]  # may start mid-line
+        if not data.endswith(b"\n") and lines:
+            lines = lines[:-1]
+        return [json.loads(line) for line in lines[-limit:]]
+
+    def compact(self, user_id: str):
+        summary, offset = self._replay(user_id)
+        self._write_summary(user_id, summary, offset)
+
+class UserProgress:
+    """Hot counters and the most recent interactions for one user"""
+
+    __slots__ = ("total_questions", "correct_answers", "difficulty_stats", "correct_by_difficulty", "recent", "unflushed")
+
+    def __init__(self, summary: dict, recent: list[dict], recent_size: int):
+        self.total_questions: int = summary["total_questions"]
+        self.correct_answers: int = summary["correct_answers"]
+        self.difficulty_stats: dict[str, int] = dict(summary["difficulty_stats"])
+        self.correct_by_difficulty: dict[str, int] = dict(summary["correct_by_difficulty"])
+        self.recent: deque = deque(recent, maxlen=recent_size)
+        # Interactions not yet written to the store; the entry can't be evicted until they are
+        self.unflushed = 0
+
+    def apply(self, interaction: dict):
+        difficulty = interaction["difficulty"]
+        self.total_questions += 1
+        self.difficulty_stats[difficulty] = self.difficulty_stats.get(difficulty, 0) + 1
+        if interaction["is_correct"]:
+            self.correct_answers += 1
+            self.correct_by_difficulty[difficulty] = self.correct_by_difficulty.get(difficulty, 0) + 1
+        self.recent.append(interaction)
+
+class ProgressTracker:
+    """Tracks quiz results per user.
+
+    Counters and the last `recent_size` interactions of up to `max_users` recently active users are kept in memory,
+    so recording an interaction and polling progress are O(1) and never touch disk; interactions are queued and
+    written to the store in batches by a background writer, which periodically checkpoints the counters.
+    """
+
+    def __init__(self, storage_dir: str = "progress_data", store: Optional[ProgressStore] = None,
+                 flush_interval: float = 1.0, batch_size: int = 100, compact_every: int = 200,
+                 max_users: int = 10000, recent_size: int = 20):
+        self.store = store if store is not None else JsonlProgressStore(storage_dir)
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.compact_every = compact_every
+        self.max_users = max_users
+        self.recent_size = recent_size
+        self._users: OrderedDict[str, UserProgress] = OrderedDict()
+        self._loading: set[asyncio.Task] = set()
+        self._pending: list[tuple[str, dict]] = []
+        # Interactions handed to a write that hasn't landed yet, by id; only removed under _write_lock once written
+        self._in_flight: dict[int, tuple[str, dict]] = {}
+        self._appended_since_compaction: dict[str, int] = defaultdict(int)
+        self._writer: Optional[asyncio.Task] = None
+        self._wakeup: Optional[asyncio.Event] = None
+        self._closing = False
+        self._write_lock = threading.Lock()
+
+    def _user(self, user_id: str) -> UserProgress:
+        entry = self._users.get(user_id)
+        if entry is not None:
+            self._users.move_to_end(user_id)
+            return entry
+        entry = self._load_user(user_id)
+        self._users[user_id] = entry
+        self._evict()
+        return entry
+
+    def _load_user(self, user_id: str) -> UserProgress:
+        # Users are only evicted once their writes have landed, so the store is complete for anyone not in memory
+        return UserProgress(self.store.load_summary(user_id), self.store.recent(user_id, self.recent_size), self.recent_size)
+
+    async def load_user(self, user_id: str):
+        """Bring a user's progress into memory without blocking the event loop"""
+        if user_id not in self._users:
+            entry = await asyncio.to_thread(self._load_user, user_id)
+            if user_id not in self._users:
+                self._users[user_id] = entry
+                self._evict()
+
+    def record_interaction(self, user_id: str, question: str, answer: str, difficulty: str, is_correct: bool):
+        """save_interaction for the event loop: never blocks, loading users that aren't in memory in a worker thread first"""
+        if user_id in self._users:
+            self.save_interaction(user_id, question, answer, difficulty, is_correct)
+            return
+        task = asyncio.create_task(self._load_and_save(user_id, question, answer, difficulty, is_correct))
+        self._loading.add(task)
+        task.add_done_callback(self._loading.discard)
+
+    async def _load_and_save(self, user_id: str, question: str, answer: str, difficulty: str, is_correct: bool):
+        try:
+            await self.load_user(user_id)
+        except Exception as e:
+            logger.error("Loading progress for %s failed: %s", user_id, str(e))
+            return
+        self.save_interaction(user_id, question, answer, difficulty, is_correct)
+
+    def _evict(self):
+        """Drop least recently used users beyond max_users, skipping any with writes still in flight"""
+        excess = len(self._users) - self.max_users
+        if excess <= 0:
+            return
+        for user_id in list(self._users)[:-1]:
+            if excess <= 0:
+                break
+            if self._users[user_id].unflushed == 0:
+                del self._users[user_id]
+                excess -= 1
+
+    def _mark_written(self, batch: list[tuple[str, dict]]):
+        for user_id, _ in batch:
+            if user_id in self._users:
+                self._users[user_id].unflushed -= 1
+
     def save_interaction(self, user_id: str, question: str, answer: str, difficulty: str, is_correct: bool):
-        """Save a single interaction to the user's progress file"""
-        user_file = self.storage_dir / f"{user_id}.json"
-        
-        # Load existing data or create new
-        if user_file.exists():
-            with open(user_file, 'r') as f:
-                data = json.load(f)
-        else:
-            data = {
-                "user_id": user_id,
-                "total_questions": 0,
-                "correct_answers": 0,
-                "difficulty_stats": {"easy": 0, "medium": 0, "hard": 0},
-                "correct_by_difficulty": {"easy": 0, "medium": 0, "hard": 0},
-                "interactions": []
-            }
-        
-        # Update statistics
-        data["total_questions"] += 1
-        if is_correct:
-            data["correct_answers"] += 1
-            data["correct_by_difficulty"][difficulty] += 1
-        data["difficulty_stats"][difficulty] += 1
-        
-        # Add new interaction
-        data["interactions"].append({
+        """Record a single interaction, persisted asynchronously by the background writer"""
+        interaction = {
             "timestamp": datetime.now().isoformat(),
             "question": question,
             "answer": answer,
             "difficulty": difficulty,
             "is_correct": is_correct
-        })
-        
-        # Save updated data
-        with open(user_file, 'w') as f:
-            json.dump(data, f, indent=2)
-            
-    def get_progress(self, user_id: str) -> Dict:
+        }
+        entry = self._user(user_id)
+        entry.apply(interaction)
+        entry.unflushed += 1
+        self._pending.append((user_id, interaction))
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            # No event loop (scripts, migrations): write through
+            batch = self._take_in_flight()
+            self._finish_batch(batch, self._write_batch(batch))
+            return
+        self._ensure_writer()
+        if len(self._pending) >= self.batch_size:
+            self._wakeup.set()
+
+    def _ensure_writer(self):
+        if self._writer is None or self._writer.done():
+            self._wakeup = asyncio.Event()
+            self._writer = asyncio.create_task(self._write_loop())
+
+    def _take_in_flight(self) -> list[tuple[str, dict]]:
+        """Take the pending interactions for a write, they stay visible to get_recent_interactions until it lands"""
+        batch, self._pending = self._pending, []
+        self._in_flight.update((id(interaction), (user_id, interaction)) for user_id, interaction in batch)
+        return batch
+
+    def _finish_batch(self, batch: list[tuple[str, dict]], failed: set[str]):
+        """Mark what a write stored as written, queue the interactions of users it failed for again"""
+        self._mark_written([(user_id, interaction) for user_id, interaction in batch if user_id not in failed])
+        retry = [(user_id, interaction) for user_id, interaction in batch if user_id in failed]
+        for _, interaction in retry:
+            self._in_flight.pop(id(interaction), None)
+        # Ahead of anything recorded since, so each user's interactions stay in order
+        self._pending[:0] = retry
+
+    async def _write_pending(self) -> bool:
+        """Write the pending interactions, returns whether all of them were stored"""
+        batch = self._take_in_flight()
+        failed = await asyncio.to_thread(self._write_batch, batch)
+        self._finish_batch(batch, failed)
+        return not failed
+
+    def _write_batch(self, batch: list[tuple[str, dict]]) -> set[str]:
+        with self._write_lock:
+            return self._write_batch_locked(batch)
+
+    def _write_batch_locked(self, batch: list[tuple[str, dict]]) -> set[str]:
+        """Append a batch to the store, returns the users whose interactions couldn't be written"""
+        by_user: dict[str, list[dict]] = defaultdict(list)
+        for user_id, interaction in batch:
+            by_user[user_id].append(interaction)
+        failed = set()
+        for user_id, interactions in by_user.items():
+            try:
+                self.store.append(user_id, interactions)
+            except Exception as e:
+                logger.error("Writing progress for %s failed, will retry: %s", user_id, str(e))
+                failed.add(user_id)
+                continue
+            for interaction in interactions:
+                self._in_flight.pop(id(interaction), None)
+            self._appended_since_compaction[user_id] += len(interactions)
+            if self._appended_since_compaction[user_id] >= self.compact_every:
+                try:
+                    self.store.compact(user_id)
+                except Exception as e:
+                    logger.error("Compacting progress for %s failed: %s", user_id, str(e))
+                self._appended_since_compaction[user_id] = 0
+        return failed
+
+    async def _write_loop(self):
+        while not self._closing:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            if self._pending:
+                if not await self._write_pending() and not self._closing:
+                    # Don't retry a failing store as fast as interactions come in
+                    await asyncio.sleep(self.flush_interval)
+                self._evict()
+
+    async def register_user(self, user_id: str, grade: Optional[int] = None, classroom: Optional[str] = None):
+        await asyncio.to_thread(self.store.set_user, user_id, grade, classroom)
+
+    async def flush(self):
+        """Write everything recorded so far"""
+        if self._pending:
+            await self._write_pending()
+
+    async def close(self, _app=None):
+        if self._loading:
+            await asyncio.gather(*self._loading, return_exceptions=True)
+        if self._writer is not None:
+            # Let the writer finish the batch it's on rather than cancelling it halfway
+            self._closing = True
+            self._wakeup.set()
+            await self._writer
+            self._writer = None
+        await self.flush()
+        if self._pending:
+            logger.error("%d progress interactions could not be written", len(self._pending))
+        await asyncio.to_thread(self.store.close)
+
+    def get_progress(self, user_id: str) -> dict:
         """Get the user's progress statistics"""
-        user_file = self.storage_dir / f"{user_id}.json"
-        if not user_file.exists():
-            return {
-                "total_questions": 0,
-                "correct_answers": 0,
-                "accuracy": 0,
-                "difficulty_breakdown": {"easy": 0, "medium": 0, "hard": 0},
-                "accuracy_by_difficulty": {"easy": 0, "medium": 0, "hard": 0}
-            }
-            
-        with open(user_file, 'r') as f:
-            data = json.load(f)
-            
-        accuracy = (data["correct_answers"] / data["total_questions"] * 100) if data["total_questions"] > 0 else 0
+        data = self._user(user_id)
+        accuracy = (data.correct_answers / data.total_questions * 100) if data.total_questions > 0 else 0
         accuracy_by_difficulty = {}
-        for diff in ["easy", "medium", "hard"]:
-            total = data["difficulty_stats"][diff]
-            correct = data["correct_by_difficulty"][diff]
+        for diff in DIFFICULTIES:
+            total = data.difficulty_stats.get(diff, 0)
+            correct = data.correct_by_difficulty.get(diff, 0)
             accuracy_by_difficulty[diff] = (correct / total * 100) if total > 0 else 0
-            
+
         return {
-            "total_questions": data["total_questions"],
-            "correct_answers": data["correct_answers"],
+            "total_questions": data.total_questions,
+            "correct_answers": data.correct_answers,
             "accuracy": accuracy,
-            "difficulty_breakdown": data["difficulty_stats"],
+            "difficulty_breakdown": dict(data.difficulty_stats),
             "accuracy_by_difficulty": accuracy_by_difficulty
         }
 
-    def get_recent_interactions(self, user_id: str, limit: int = 10) -> List[Dict]:
+    def get_recent_interactions(self, user_id: str, limit: int = 10) -> list[dict]:
         """Get the user's most recent interactions"""
-        user_file = self.storage_dir / f"{user_id}.json"
-        if not user_file.exists():
-            return []
-            
-        with open(user_file, 'r') as f:
-            data = json.load(f)
-            
-        return data["interactions"][-limit:] 
\ No newline at end of file
+        entry = self._user(user_id)
+        if limit <= self.recent_size:
+            return list(entry.recent)[-limit:] if limit > 0 else []
+        # Under the write lock a write is either not started or done and out of _in_flight, so nothing is counted twice
+        with self._write_lock:
+            unwritten = list(self._in_flight.values()) + self._pending
+            pending = [interaction for pending_user, interaction in unwritten if pending_user == user_id]
+            if len(pending) >= limit:
+                return pending[-limit:]
+            return self.store.recent(user_id, limit - len(pending)) + pending
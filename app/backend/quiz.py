@@ -0,0 +1,56 @@
+import re
+from typing import Optional
+
+# The model reports each quiz question through this tool before asking it, so the expected answer is never spoken
+QUIZ_TOOL_SCHEMA = {
+    "type": "function",
+    "name": "record_quiz_question",
+    "description": "Record a question you are about to ask the student to check their understanding, with the answer you " + \
+                   "expect. Call it before asking the question, then ask only the question: never say the expected answer.",
+    "parameters": {
+        "type": "object",
+        "properties": {
+            "question": {
+                "type": "string",
+                "description": "The question, as you will ask it"
+            },
+            "answer": {
+                "type": "string",
+                "description": "The expected answer in a few words"
+            },
+            "difficulty": {
+                "type": "string",
+                "enum": ["easy", "medium", "hard"]
+            }
+        },
+        "required": ["question", "answer", "difficulty"],
+        "additionalProperties": False
+    }
+}
+
+def quiz_question(args: dict) -> Optional[dict[str, str]]:
+    """The question recorded by a record_quiz_question call, None if the arguments are incomplete"""
+    question = str(args.get("question") or "").strip()
+    answer = str(args.get("answer") or "").strip()
+    difficulty = str(args.get("difficulty") or "").strip().lower()
+    if not question or not answer or difficulty not in ("easy", "medium", "hard"):
+        return None
+    return {"question": question, "answer": answer, "difficulty": difficulty}
+
+_NUMBER_WORDS = {word: str(n) for n, word in enumerate(
+    "zero one two three four five six seven eight nine ten eleven twelve thirteen fourteen fifteen "
+    "sixteen seventeen eighteen nineteen twenty".split())}
+_IGNORED_WORDS = frozenset(["a", "an", "the", "is", "it", "its", "of"])
+_WORD = re.compile(r"\w+")
+
+def _answer_words(text: str) -> list[str]:
+    words = (_NUMBER_WORDS.get(w, w) for w in _WORD.findall(text.casefold()))
+    return [w for w in words if w not in _IGNORED_WORDS]
+
+def score_answer(expected: str, transcript: str) -> bool:
+    """Whether a spoken answer contains every significant word of the expected answer, spelled-out numbers included"""
+    expected_words = _answer_words(expected)
+    if not expected_words:
+        return False
+    spoken = set(_answer_words(transcript))
+    return all(w in spoken for w in expected_words)
@@ -1,19 +1,28 @@
 import re
 import logging
-from typing import Any
+from typing import Any, Optional
 
 from azure.core.credentials import AzureKeyCredential
 from azure.identity import DefaultAzureCredential
 from azure.search.documents.aio import SearchClient
-from azure.search.documents.models import VectorizableTextQuery
 
-from rtmt import RTMiddleTier, Tool, ToolResult, ToolResultDirection
+from auth import ManagedTokenCredential
+from metrics import REGISTRY
+from retrieval import AzureSearchBackend, RetrievalBackend
+from rtmt import RTMiddleTier, Tool, ToolResult, ToolResultDirection, current_session
+from search_cache import ChunkCache, IndexVersionTracking, SearchCache
+from semantic_cache import SemanticCache
 
 import aiohttp
+import asyncio
 import os
+import time
 
 logger = logging.getLogger(__name__)
 
+SEARCHES = REGISTRY.counter("ragtools_searches", "Knowledge base searches by where the results came from", ("source",))
+BACKEND_SECONDS = REGISTRY.histogram("ragtools_backend_seconds", "Retrieval backend call duration", ("operation", "outcome"))
+
 _search_tool_schema = {
     "type": "function",
     "name": "search",
@@ -56,46 +65,95 @@ _grounding_tool_schema = {
 }
 
 async def _search_tool(
-    search_client: SearchClient, 
-    semantic_configuration: str,
-    identifier_field: str,
-    content_field: str,
-    embedding_field: str,
-    use_vector_query: bool,
+    backend: RetrievalBackend,
+    cache: Optional[SearchCache],
+    semantic_cache: Optional[SemanticCache],
     args: Any) -> ToolResult:
     logger.info(f"Searching for '{args['query']}' in the knowledge base.")
-    vector_queries = []
-    if use_vector_query:
-        vector_queries.append(VectorizableTextQuery(text=args['query'], k_nearest_neighbors=50, fields=embedding_field))
-    
+    cache_params = {"top": 3, **backend.describe()}
+    _refresh_index_version(backend, [c for c in (cache, semantic_cache) if c is not None])
+    if cache is not None:
+        hits = await cache.get(args['query'], **cache_params)
+        if hits is not None:
+            logger.info(f"Search cache hit for '{args['query']}'")
+            SEARCHES.inc(1, "cache")
+            _remember_chunks(hits)
+            return ToolResult(_format_search_results(hits), ToolResultDirection.TO_SERVER)
+    query_vector = None
+    if semantic_cache is not None:
+        try:
+            hits, query_vector = await semantic_cache.lookup(args['query'])
+        except Exception as e:
+            logger.warning(f"Semantic cache lookup failed: {str(e)}")
+            hits = None
+        if hits is not None:
+            SEARCHES.inc(1, "semantic_cache")
+            if cache is not None:
+                await cache.set(args['query'], hits, **cache_params)
+            _remember_chunks(hits)
+            return ToolResult(_format_search_results(hits), ToolResultDirection.TO_SERVER)
+
+    SEARCHES.inc(1, "backend")
+    hits = None
+    started_at = time.perf_counter()
     try:
-        search_results = await search_client.search(
-            search_text=args['query'], 
-            top=3,
-            vector_queries=vector_queries,
-            select=f"{identifier_field}, {content_field}"
-        )
-        
-        result = ""
-        async for r in search_results:
-            content = r[content_field]
-            if len(content) > 200:
-                content = content[:200] + "..."
-                
-            result += f"[{r[identifier_field]}]: {content}\n-----\n"
-            logger.info(f"Found result: [{r[identifier_field]}]")
-        return ToolResult(result, ToolResultDirection.TO_SERVER)
+        try:
+            hits = await backend.search(args['query'], top=3)
+        finally:
+            BACKEND_SECONDS.observe(time.perf_counter() - started_at, "search", "ok" if hits is not None else "error")
+        for doc in hits:
+            logger.info(f"Found result: [{doc['chunk_id']}]")
+        if cache is not None:
+            await cache.set(args['query'], hits, **cache_params)
+        if semantic_cache is not None and query_vector is not None:
+            semantic_cache.add(query_vector, hits)
+        _remember_chunks(hits)
+        return ToolResult(_format_search_results(hits), ToolResultDirection.TO_SERVER)
     except Exception as e:
         logger.error(f"Search failed: {str(e)}")
         raise
 
+_index_checks: set[asyncio.Task] = set()
+
+def _refresh_index_version(backend: RetrievalBackend, caches: list[IndexVersionTracking]):
+    """Check the index version in a background task when a cache is due, searches don't wait for it"""
+    if _index_checks or not any(c.index_check_due() for c in caches):
+        return
+    task = asyncio.create_task(_check_index_version(backend, caches))
+    _index_checks.add(task)
+    task.add_done_callback(_index_checks.discard)
+
+async def _check_index_version(backend: RetrievalBackend, caches: list[IndexVersionTracking]):
+    try:
+        version = await backend.version()
+    except Exception as e:
+        logger.warning(f"Could not check search index version: {str(e)}")
+        return
+    for c in caches:
+        await c.observe_index_version(version)
+
+def _session_chunk_cache() -> Optional[ChunkCache]:
+    rt_session = current_session.get()
+    return rt_session.chunk_cache if rt_session is not None else None
+
+def _remember_chunks(hits: list[dict[str, str]]) -> None:
+    chunk_cache = _session_chunk_cache()
+    if chunk_cache is not None:
+        chunk_cache.add(hits)
+
+def _format_search_results(hits: list[dict[str, str]]) -> str:
+    result = ""
+    for doc in hits:
+        content = doc["chunk"]
+        if len(content) > 200:
+            content = content[:200] + "..."
+        result += f"[{doc['chunk_id']}]: {content}\n-----\n"
+    return result
+
 KEY_PATTERN = re.compile(r'^[a-zA-Z0-9_=\-]+$')
 
 async def _report_grounding_tool(
-    search_client: SearchClient, 
-    identifier_field: str, 
-    title_field: str, 
-    content_field: str, 
+    backend: RetrievalBackend,
     args: Any) -> ToolResult:
     sources = [s for s in args["sources"] if KEY_PATTERN.match(s)]
     if not sources:
@@ -103,24 +161,28 @@ async def _report_grounding_tool(
         return ToolResult({"sources": []}, ToolResultDirection.TO_CLIENT)
         
     logger.info(f"Grounding sources: {', '.join(sources)}")
-    
-    # Use OR to combine multiple source searches
-    search_text = " OR ".join(sources)
-    search_results = await search_client.search(
-        search_text=search_text,
-        search_fields=[identifier_field],
-        select=[identifier_field, title_field, content_field],
-        top=len(sources)
-    )
-    
-    docs = []
-    async for r in search_results:
-        logger.info(f"Found grounding document: {r[title_field]}")
-        docs.append({
-            "chunk_id": r[identifier_field],
-            "title": r.get(title_field, "Unknown"),
-            "chunk": r[content_field]
-        })
+    # Sources almost always come from the preceding search in this session, only fetch the ones we haven't seen
+    chunk_cache = _session_chunk_cache()
+    found = {}
+    if chunk_cache is not None:
+        for source in sources:
+            if (doc := chunk_cache.get(source)) is not None:
+                found[source] = doc
+    missing = [s for s in sources if s not in found]
+    if missing:
+        started_at = time.perf_counter()
+        try:
+            fetched = await backend.lookup(missing)
+        except Exception:
+            BACKEND_SECONDS.observe(time.perf_counter() - started_at, "lookup", "error")
+            raise
+        BACKEND_SECONDS.observe(time.perf_counter() - started_at, "lookup", "ok")
+        if chunk_cache is not None:
+            chunk_cache.add(fetched)
+        found.update((doc["chunk_id"], doc) for doc in fetched)
+    docs = [found[s] for s in dict.fromkeys(sources) if s in found]
+    for doc in docs:
+        logger.info(f"Found grounding document: {doc['title']}")
     
     return ToolResult({"sources": docs}, ToolResultDirection.TO_CLIENT)
 
@@ -132,11 +194,21 @@ def attach_rag_tools(rtmt: RTMiddleTier,
     content_field: str,
     embedding_field: str,
     title_field: str,
-    use_vector_query: bool
+    use_vector_query: bool,
+    search_cache: Optional[SearchCache] = None,
+    semantic_cache: Optional[SemanticCache] = None,
+    backend: Optional[RetrievalBackend] = None,
+    tool_timeout: Optional[float] = 10,
+    max_concurrent_calls: Optional[int] = None
     ) -> None:
-    if not isinstance(credentials, AzureKeyCredential):
-        credentials.get_token("https://search.azure.com/.default")
-    search_client = SearchClient(search_endpoint, search_index, credentials, user_agent="RTMiddleTier")
+    if backend is None:
+        if not isinstance(credentials, AzureKeyCredential):
+            # The async SearchClient needs an async credential, tokens are cached and refreshed in the background
+            credentials = ManagedTokenCredential(credentials)
+        search_client = SearchClient(search_endpoint, search_index, credentials, user_agent="RTMiddleTier")
+        backend = AzureSearchBackend(search_client, semantic_configuration, identifier_field, content_field, embedding_field, title_field, use_vector_query)
 
-    rtmt.tools["search"] = Tool(schema=_search_tool_schema, target=lambda args: _search_tool(search_client, semantic_configuration, identifier_field, content_field, embedding_field, use_vector_query, args))
-    rtmt.tools["report_grounding"] = Tool(schema=_grounding_tool_schema, target=lambda args: _report_grounding_tool(search_client, identifier_field, title_field, content_field, args))
+    rtmt.tools["search"] = Tool(schema=_search_tool_schema, target=lambda args: _search_tool(backend, search_cache, semantic_cache, args),
+        timeout=tool_timeout, max_concurrency=max_concurrent_calls)
+    rtmt.tools["report_grounding"] = Tool(schema=_grounding_tool_schema, target=lambda args: _report_grounding_tool(backend, args),
+        timeout=tool_timeout, max_concurrency=max_concurrent_calls)
@@ -0,0 +1,255 @@
+import json
+import logging
+import math
+import os
+import re
+from collections import Counter, defaultdict
+from collections.abc import Iterable
+from pathlib import Path
+from typing import Any, Optional
+
+import numpy as np
+from azure.core.exceptions import HttpResponseError
+from azure.search.documents.aio import SearchClient
+from azure.search.documents.models import VectorizableTextQuery
+
+from embeddings import AzureOpenAIEmbedder, Embedder, normalize_rows
+
+logger = logging.getLogger("voicerag")
+
+# Documents are passed around as plain dicts with these keys so they can be cached and sent to clients as-is
+# {"chunk_id": str, "title": str, "chunk": str}
+
+class RetrievalBackend:
+    """Answers the search and report_grounding tools"""
+
+    def describe(self) -> dict[str, Any]:
+        """Parameters that change results, used as part of the search cache key"""
+        raise NotImplementedError
+
+    async def search(self, query: str, top: int) -> list[dict[str, str]]:
+        raise NotImplementedError
+
+    async def lookup(self, chunk_ids: list[str]) -> list[dict[str, str]]:
+        raise NotImplementedError
+
+    async def version(self) -> Any:
+        """A value that changes whenever the indexed content changes"""
+        raise NotImplementedError
+
+    async def close(self) -> None:
+        pass
+
+class AzureSearchBackend(RetrievalBackend):
+    def __init__(self, search_client: SearchClient, semantic_configuration: str, identifier_field: str, content_field: str,
+                 embedding_field: str, title_field: str, use_vector_query: bool, k_nearest_neighbors: int = 50):
+        self.search_client = search_client
+        self.semantic_configuration = semantic_configuration
+        self.identifier_field = identifier_field
+        self.content_field = content_field
+        self.embedding_field = embedding_field
+        self.title_field = title_field
+        self.use_vector_query = use_vector_query
+        self.k_nearest_neighbors = k_nearest_neighbors
+        self.key_filterable = True
+
+    def describe(self) -> dict[str, Any]:
+        return {
+            "backend": "azure",
+            "k": self.k_nearest_neighbors,
+            "vector": self.use_vector_query,
+            "fields": [self.identifier_field, self.content_field, self.embedding_field, self.title_field]
+        }
+
+    def _to_document(self, r: dict) -> dict[str, str]:
+        return {"chunk_id": r[self.identifier_field], "title": r.get(self.title_field) or "Unknown", "chunk": r[self.content_field]}
+
+    async def search(self, query: str, top: int) -> list[dict[str, str]]:
+        vector_queries = []
+        if self.use_vector_query:
+            vector_queries.append(VectorizableTextQuery(text=query, k_nearest_neighbors=self.k_nearest_neighbors, fields=self.embedding_field))
+        search_results = await self.search_client.search(
+            search_text=query,
+            top=top,
+            vector_queries=vector_queries,
+            select=[self.identifier_field, self.title_field, self.content_field]
+        )
+        return [self._to_document(r) async for r in search_results]
+
+    async def lookup(self, chunk_ids: list[str]) -> list[dict[str, str]]:
+        select = [self.identifier_field, self.title_field, self.content_field]
+        if self.key_filterable:
+            try:
+                # A filter on the key field is an unscored batched key lookup
+                search_results = await self.search_client.search(
+                    search_text="*",
+                    filter=f"search.in({self.identifier_field}, '{','.join(chunk_ids)}', ',')",
+                    select=select,
+                    top=len(chunk_ids)
+                )
+                return [self._to_document(r) async for r in search_results]
+            except HttpResponseError as e:
+                logger.warning(f"Key lookup by filter failed, falling back to full-text search: {str(e)}")
+                self.key_filterable = False
+        # Indexes created without a filterable key: use OR to combine multiple source searches
+        search_results = await self.search_client.search(
+            search_text=" OR ".join(chunk_ids),
+            search_fields=[self.identifier_field],
+            select=select,
+            top=len(chunk_ids)
+        )
+        return [self._to_document(r) async for r in search_results]
+
+    async def version(self) -> Any:
+        return await self.search_client.get_document_count()
+
+    async def close(self) -> None:
+        await self.search_client.close()
+
+_TOKEN = re.compile(r"\w+")
+
+def tokenize(text: str) -> list[str]:
+    return _TOKEN.findall(text.casefold())
+
+class BM25Index:
+    """Inverted index with BM25 weights precomputed per posting, so scoring a query is a few vectorized adds"""
+
+    def __init__(self, texts: list[str], k1: float = 1.2, b: float = 0.75):
+        self.size = len(texts)
+        doc_terms = [Counter(tokenize(text)) for text in texts]
+        lengths = np.array([sum(terms.values()) for terms in doc_terms], dtype=np.float32)
+        average_length = float(lengths.mean()) if self.size > 0 else 0.0
+        postings: dict[str, list[tuple[int, int]]] = defaultdict(list)
+        for doc, terms in enumerate(doc_terms):
+            for term, tf in terms.items():
+                postings[term].append((doc, tf))
+        self.postings: dict[str, tuple[np.ndarray, np.ndarray]] = {}
+        for term, entries in postings.items():
+            docs = np.array([doc for doc, _ in entries], dtype=np.int32)
+            tf = np.array([tf for _, tf in entries], dtype=np.float32)
+            idf = math.log(1 + (self.size - len(entries) + 0.5) / (len(entries) + 0.5))
+            norm = k1 * (1 - b + b * lengths[docs] / average_length)
+            self.postings[term] = (docs, (idf * tf * (k1 + 1) / (tf + norm)).astype(np.float32))
+
+    def scores(self, query: str) -> np.ndarray:
+        scores = np.zeros(self.size, dtype=np.float32)
+        for term in set(tokenize(query)):
+            if term in self.postings:
+                docs, weights = self.postings[term]
+                scores[docs] += weights
+        return scores
+
+def _top_indices(scores: np.ndarray, k: int) -> np.ndarray:
+    k = min(k, len(scores))
+    if k == 0:
+        return np.empty(0, dtype=np.int64)
+    candidates = np.argpartition(-scores, k - 1)[:k]
+    return candidates[np.argsort(-scores[candidates], kind="stable")]
+
+class LocalSearchBackend(RetrievalBackend):
+    """In-process hybrid retrieval over an index directory written by write_local_index.
+
+    Dense scores come from a memory-mapped float32 embedding matrix, lexical scores from BM25,
+    and the two rankings are fused with reciprocal rank fusion like Azure AI Search hybrid queries.
+    """
+
+    def __init__(self, path: str, embedder: Optional[Embedder], use_vector_query: bool = True, k_nearest_neighbors: int = 50, rrf_k: int = 60,
+                 use_text_query: bool = True):
+        self.path = Path(path)
+        self.meta = read_local_index_meta(path)
+        with open(self.path / "chunks.jsonl", encoding="utf-8") as f:
+            self.documents: list[dict[str, str]] = [json.loads(line) for line in f]
+        self._positions = {doc["chunk_id"]: i for i, doc in enumerate(self.documents)}
+        self.embeddings = np.memmap(self.path / "embeddings.f32", dtype=np.float32, mode="r",
+                                    shape=(len(self.documents), self.meta["dimensions"])) if self.documents else None
+        self.bm25 = BM25Index([f"{doc['title']} {doc['chunk']}" for doc in self.documents])
+        self.embedder = embedder
+        self.use_vector_query = use_vector_query and embedder is not None
+        self.use_text_query = use_text_query or not self.use_vector_query
+        self.k_nearest_neighbors = k_nearest_neighbors
+        self.rrf_k = rrf_k
+        logger.info("Loaded local index from %s with %d chunks", path, len(self.documents))
+
+    def describe(self) -> dict[str, Any]:
+        return {"backend": "local", "path": str(self.path), "k": self.k_nearest_neighbors, "vector": self.use_vector_query, "text": self.use_text_query}
+
+    def rank(self, query: str, query_vector: Optional[np.ndarray], top: int) -> list[int]:
+        if not self.documents:
+            return []
+        fused: dict[int, float] = defaultdict(float)
+        if self.use_text_query:
+            lexical = self.bm25.scores(query)
+            for rank, doc in enumerate(_top_indices(lexical, self.k_nearest_neighbors)):
+                if lexical[doc] > 0:
+                    fused[int(doc)] += 1 / (self.rrf_k + rank + 1)
+        if query_vector is not None:
+            dense = self.embeddings @ query_vector
+            for rank, doc in enumerate(_top_indices(dense, self.k_nearest_neighbors)):
+                fused[int(doc)] += 1 / (self.rrf_k + rank + 1)
+        return sorted(fused, key=fused.__getitem__, reverse=True)[:top]
+
+    async def search(self, query: str, top: int) -> list[dict[str, str]]:
+        query_vector = await self.embedder.embed_one(query) if self.use_vector_query else None
+        return [self.documents[i] for i in self.rank(query, query_vector, top)]
+
+    async def lookup(self, chunk_ids: list[str]) -> list[dict[str, str]]:
+        return [self.documents[self._positions[c]] for c in chunk_ids if c in self._positions]
+
+    async def version(self) -> Any:
+        return (len(self.documents), os.stat(self.path / "chunks.jsonl").st_mtime_ns)
+
+def read_local_index_meta(path: str) -> dict[str, Any]:
+    with open(Path(path) / "meta.json", encoding="utf-8") as f:
+        return json.load(f)
+
+def write_local_index(path: str, documents: list[dict[str, str]], embeddings: np.ndarray, model: str) -> None:
+    """Write chunks and their embeddings in the layout LocalSearchBackend memory-maps"""
+    index_dir = Path(path)
+    index_dir.mkdir(parents=True, exist_ok=True)
+    embeddings = normalize_rows(np.asarray(embeddings, dtype=np.float32))
+    with open(index_dir / "chunks.jsonl", "w", encoding="utf-8") as f:
+        for doc in documents:
+            f.write(json.dumps({"chunk_id": doc["chunk_id"], "title": doc["title"], "chunk": doc["chunk"]}) + "\n")
+    embeddings.tofile(index_dir / "embeddings.f32")
+    with open(index_dir / "meta.json", "w", encoding="utf-8") as f:
+        json.dump({"model": model, "dimensions": int(embeddings.shape[1]), "count": len(documents)}, f)
+
+async def build_local_index(path: str, documents: Iterable[dict[str, str]], embedder: Embedder, batch_size: int = 64) -> None:
+    documents = list(documents)
+    batches = [await embedder.embed([doc["chunk"] for doc in documents[i:i + batch_size]])
+               for i in range(0, len(documents), batch_size)]
+    embeddings = np.concatenate(batches) if batches else np.zeros((0, embedder.dimensions), dtype=np.float32)
+    write_local_index(path, documents, embeddings, embedder.model)
+
+if __name__ == "__main__":
+    import argparse
+    import asyncio
+
+    from dotenv import load_dotenv
+
+    from embeddings import create_embedder
+
+    logging.basicConfig(level=logging.INFO)
+    load_dotenv()
+    parser = argparse.ArgumentParser(description="Build a local retrieval index from a JSONL file of chunks (chunk_id, title, chunk)")
+    parser.add_argument("chunks", help="JSONL file with one chunk per line")
+    parser.add_argument("--out", default="local_index", help="Index directory to write")
+    parser.add_argument("--model", default=os.environ.get("AZURE_OPENAI_EMBEDDING_MODEL") or "hashing", help="Embedding model, or 'hashing' for offline use")
+    parser.add_argument("--dimensions", type=int, default=256)
+    args = parser.parse_args()
+
+    with open(args.chunks, encoding="utf-8") as f:
+        chunks = [json.loads(line) for line in f if line.strip()]
+    embedder = create_embedder(args.model, args.dimensions,
+        endpoint=os.environ.get("AZURE_OPENAI_ENDPOINT"),
+        deployment=os.environ.get("AZURE_OPENAI_EMBEDDING_DEPLOYMENT"),
+        key=os.environ.get("AZURE_OPENAI_API_KEY"))
+
+    async def main():
+        try:
+            await build_local_index(args.out, chunks, embedder)
+        finally:
+            if isinstance(embedder, AzureOpenAIEmbedder):
+                await embedder.close()
+    asyncio.run(main())
+    logger.info("Wrote %d chunks to %s", len(chunks), args.out)
@@ -1,18 +1,31 @@
 import asyncio
 import json
 import logging
+import re
+import time
+import uuid
+from contextvars import ContextVar
 from enum import Enum
 from typing import Any, Callable, Optional
 
 import aiohttp
 from aiohttp import web
 from azure.core.credentials import AzureKeyCredential
-from azure.identity import DefaultAzureCredential, get_bearer_token_provider
-from progress_tracker import ProgressTracker
-import re
+from azure.identity import DefaultAzureCredential
+
+from admission import AdmissionController, AdmissionRejected, Ticket
+from auth import AsyncTokenManager
+from codec import JsonCodec, get_codec
+from metrics import REGISTRY
+from progress_tracker import ProgressTracker, is_valid_user_id
+from quiz import QUIZ_TOOL_SCHEMA, quiz_question, score_answer
+from search_cache import ChunkCache
+from send_buffer import SendBuffer
+from upstream import UpstreamStats, create_upstream_session
 
 logger = logging.getLogger("voicerag")
 
+
 class ToolResultDirection(Enum):
     TO_SERVER = 1
     TO_CLIENT = 2
@@ -33,19 +46,219 @@ class ToolResult:
 class Tool:
     target: Callable[..., ToolResult]
     schema: Any
+    timeout: Optional[float]
 
-    def __init__(self, target: Any, schema: Any):
+    def __init__(self, target: Any, schema: Any, timeout: Optional[float] = None, max_concurrency: Optional[int] = None):
         self.target = target
         self.schema = schema
+        self.timeout = timeout
+        # Shared by all sessions, so a burst of calls can't overwhelm the tool's backend
+        self._semaphore = asyncio.Semaphore(max_concurrency) if max_concurrency else None
+
+    async def run(self, args: Any) -> ToolResult:
+        if self._semaphore is None:
+            return await asyncio.wait_for(self.target(args), self.timeout)
+        async with self._semaphore:
+            return await asyncio.wait_for(self.target(args), self.timeout)
 
 class RTToolCall:
     tool_call_id: str
     previous_id: str
+    task: Optional[asyncio.Task] = None
 
     def __init__(self, tool_call_id: str, previous_id: str):
         self.tool_call_id = tool_call_id
         self.previous_id = previous_id
 
+class RTSession:
+    """State for a single client websocket connection"""
+    __slots__ = ("session_id", "user_id", "client_ws", "created_at", "last_activity", "tools_pending", "tool_tasks", "current_question",
+                 "next_question", "chunk_cache", "messages_to_client", "messages_to_server", "tool_calls", "response_started_at")
+
+    def __init__(self, client_ws: web.WebSocketResponse):
+        self.session_id = uuid.uuid4().hex
+        # Progress is only recorded for sessions that say which student they are
+        self.user_id: Optional[str] = None
+        self.client_ws = client_ws
+        self.created_at = time.monotonic()
+        self.last_activity = self.created_at
+        self.tools_pending: dict[str, RTToolCall] = {}
+        self.tool_tasks: set[asyncio.Task] = set()
+        # The quiz question the student's next utterance answers, and one recorded for the response still to come
+        self.current_question: Optional[dict[str, str]] = None
+        self.next_question: Optional[dict[str, str]] = None
+        self.chunk_cache = ChunkCache()
+        self.messages_to_client = 0
+        self.messages_to_server = 0
+        self.tool_calls = 0
+        # Set when a response starts, cleared by its first audio delta
+        self.response_started_at: Optional[float] = None
+
+    def touch(self):
+        self.last_activity = time.monotonic()
+
+    def spawn(self, coro) -> asyncio.Task:
+        """Run coro in the background, tied to this session's lifetime"""
+        task = asyncio.create_task(coro)
+        self.tool_tasks.add(task)
+        task.add_done_callback(self.tool_tasks.discard)
+        return task
+
+    def cancel_tasks(self):
+        for task in self.tool_tasks:
+            task.cancel()
+
+_EVENT_TYPE = re.compile(r'"type"\s*:\s*"([^"]+)"')
+
+def peek_event_type(data: str, prefix_length: int = 256) -> Optional[str]:
+    """Read the top-level "type" of a realtime event without parsing it, or None if it can't be found cheaply.
+
+    Realtime events put "type" first, so it is almost always within the first few bytes; a match preceded by
+    more than one "{" may belong to a nested object and is not trusted.
+    """
+    prefix = data[:prefix_length]
+    match = _EVENT_TYPE.search(prefix)
+    if match is None or prefix.count("{", 0, match.start()) != 1:
+        return None
+    return match.group(1)
+
+# Events the middle tier rewrites or consumes, anything else (notably the large audio deltas) is relayed verbatim
+CLIENT_EVENTS_TO_PROCESS = frozenset([
+    "session.created",
+    "conversation.item.created",
+    "response.function_call_arguments.delta",
+    "response.function_call_arguments.done",
+    "response.output_item.done",
+    "response.done",
+    "input_audio_buffer.transcript",
+    "conversation.item.input_audio_transcription.completed",
+    "response.text",
+    "response.text.delta",
+    "response.text.end",
+    "input_audio_buffer.speech_ended",
+    "response.audio_transcript.delta",
+    "response.content_part.added"
+])
+SERVER_EVENTS_TO_PROCESS = frozenset(["session.update"])
+
+def _is_audio_to_client(data: str) -> bool:
+    return peek_event_type(data) == "response.audio.delta"
+
+def _is_audio_to_server(data: str) -> bool:
+    return peek_event_type(data) == "input_audio_buffer.append"
+
+# Client events are counted by type only if they are known, so a client can't create unbounded label values
+KNOWN_SERVER_EVENTS = frozenset([
+    "session.update",
+    "input_audio_buffer.append",
+    "input_audio_buffer.commit",
+    "input_audio_buffer.clear",
+    "conversation.item.create",
+    "conversation.item.truncate",
+    "conversation.item.delete",
+    "response.create",
+    "response.cancel"
+])
+
+EVENTS = REGISTRY.counter("rtmt_events", "Realtime events received, by direction and type", ("direction", "type"))
+RELAY_SECONDS = REGISTRY.histogram("rtmt_relay_seconds", "Time to process and queue one realtime event for sending", ("direction",))
+RELAY_SECONDS_TO_CLIENT = RELAY_SECONDS.labels("to_client")
+RELAY_SECONDS_TO_SERVER = RELAY_SECONDS.labels("to_server")
+TOOL_SECONDS = REGISTRY.histogram("rtmt_tool_seconds", "Tool call duration, including waiting for a concurrency slot", ("tool", "outcome"))
+TOOL_CALLS_PENDING = REGISTRY.gauge("rtmt_tool_calls_pending", "Tool calls running")
+ACTIVE_SESSIONS = REGISTRY.gauge("rtmt_active_sessions", "Open client sessions")
+REJECTED_SESSIONS = REGISTRY.counter("rtmt_rejected_sessions", "Client connections rejected at capacity")
+TIME_TO_FIRST_AUDIO = REGISTRY.histogram("rtmt_time_to_first_audio_seconds", "Time from response.created to its first audio delta",
+                                         buckets=(0.05, 0.1, 0.2, 0.3, 0.5, 0.75, 1, 1.5, 2, 3, 5, 10))
+
+# The session being relayed, visible to tools invoked on its behalf
+current_session: ContextVar[Optional[RTSession]] = ContextVar("current_session", default=None)
+
+class SessionRegistry:
+    """Tracks open sessions and closes the ones that outlive max_lifetime or sit idle longer than idle_timeout"""
+
+    def __init__(self, max_sessions: int = 1000, max_lifetime: float = 3600, idle_timeout: float = 600, reap_interval: float = 30):
+        self.max_sessions = max_sessions
+        self.max_lifetime = max_lifetime
+        self.idle_timeout = idle_timeout
+        self.reap_interval = reap_interval
+        self.sessions: dict[str, RTSession] = {}
+        self._reaper: Optional[asyncio.Task] = None
+
+    def __len__(self) -> int:
+        return len(self.sessions)
+
+    def is_full(self) -> bool:
+        return len(self.sessions) >= self.max_sessions
+
+    def add(self, session: RTSession):
+        self.sessions[session.session_id] = session
+
+    def remove(self, session: RTSession):
+        self.sessions.pop(session.session_id, None)
+
+    def expired(self) -> list[RTSession]:
+        now = time.monotonic()
+        return [s for s in self.sessions.values()
+                if now - s.created_at > self.max_lifetime or now - s.last_activity > self.idle_timeout]
+
+    async def _reap(self):
+        while True:
+            await asyncio.sleep(self.reap_interval)
+            for session in self.expired():
+                logger.info("Closing expired session %s", session.session_id)
+                self.remove(session)
+                await session.client_ws.close()
+
+    async def start(self, _app=None):
+        self._reaper = asyncio.create_task(self._reap())
+
+    async def stop(self, _app=None):
+        if self._reaper is not None:
+            self._reaper.cancel()
+        for session in list(self.sessions.values()):
+            await session.client_ws.close()
+        self.sessions.clear()
+
+class HeldMessages:
+    """Reads a client's messages while its session waits for admission, keeping up to max_messages of them.
+    Input audio is not kept, the user hears nothing back until the session starts anyway.
+
+    Cancelling a pending receive breaks an aiohttp websocket, so after handover() the reader stops at the next
+    message instead and iterating yields the kept messages followed by that one."""
+
+    def __init__(self, ws: web.WebSocketResponse, max_messages: int):
+        self.ws = ws
+        self.max_messages = max_messages
+        self.messages: list[aiohttp.WSMessage] = []
+        self._handed_over = False
+        self.reader = asyncio.create_task(self._read())
+
+    async def _read(self):
+        async for msg in self.ws:
+            if self._handed_over:
+                self.messages.append(msg)
+                return
+            if (msg.type == aiohttp.WSMsgType.TEXT and len(self.messages) < self.max_messages
+                    and peek_event_type(msg.data) != "input_audio_buffer.append"):
+                self.messages.append(msg)
+
+    def handover(self):
+        self._handed_over = True
+
+    async def __aiter__(self):
+        i = 0
+        while True:
+            while i < len(self.messages):
+                yield self.messages[i]
+                i += 1
+            if self.reader.done():
+                return
+            await asyncio.wait((self.reader,))
+
+    def close(self):
+        self.reader.cancel()
+
 class RTMiddleTier:
     endpoint: str
     deployment: str
@@ -53,7 +266,7 @@ class RTMiddleTier:
     
     # Tools are server-side only for now, though the case could be made for client-side tools
     # in addition to server-side tools that are invisible to the client
-    tools: dict[str, Tool] = {}
+    tools: dict[str, Tool]
 
     # Server-enforced configuration, if set, these will override the client's configuration
     # Typically at least the model name and system message will be set by the server
@@ -64,12 +277,27 @@ class RTMiddleTier:
     disable_audio: Optional[bool] = None
     voice_choice: Optional[str] = None
     api_version: str = "2024-10-01-preview"
-    _tools_pending = {}
-    _token_provider = None
+    # Relay events the middle tier doesn't touch without parsing them
+    fast_path: bool = True
+    codec: JsonCodec = get_codec()
+    token_manager: Optional[AsyncTokenManager] = None
     progress_tracker: ProgressTracker = None
-
-    def __init__(self, endpoint: str, deployment: str, credentials: AzureKeyCredential | DefaultAzureCredential, voice_choice: Optional[str] = None):
+    # Caps upstream sessions, clients over the cap wait in a queue
+    admission: Optional[AdmissionController] = None
+    # Client messages kept while a session waits for admission, input audio isn't kept
+    max_held_messages: int = 64
+
+    def __init__(self, endpoint: str, deployment: str, credentials: AzureKeyCredential | DefaultAzureCredential, voice_choice: Optional[str] = None,
+                 sessions: Optional[SessionRegistry] = None, upstream_options: Optional[dict[str, Any]] = None,
+                 send_buffer_options: Optional[dict[str, Any]] = None):
         self.endpoint = endpoint
+        self.tools = {}
+        self.sessions = sessions if sessions is not None else SessionRegistry()
+        self.upstream_stats = UpstreamStats()
+        self.upstream_options = upstream_options or {}
+        # Limits of the per-direction send queues, see SendBuffer
+        self.send_buffer_options = send_buffer_options or {}
+        self._http: Optional[aiohttp.ClientSession] = None
         self.deployment = deployment
         self.voice_choice = voice_choice
         if voice_choice is not None:
@@ -77,16 +305,43 @@ class RTMiddleTier:
         if isinstance(credentials, AzureKeyCredential):
             self.key = credentials.key
         else:
-            self._token_provider = get_bearer_token_provider(credentials, "https://cognitiveservices.azure.com/.default")
-            self._token_provider() # Warm up during startup so we have a token cached when the first request arrives
+            self.token_manager = AsyncTokenManager(credentials, "https://cognitiveservices.azure.com/.default")
         self.progress_tracker = ProgressTracker()
 
-    async def _process_message_to_client(self, msg: str, client_ws: web.WebSocketResponse, server_ws: web.WebSocketResponse) -> Optional[str]:
-        message = json.loads(msg.data)
+    async def _process_message_to_client(self, msg: str, client_ws: web.WebSocketResponse, server_ws: web.WebSocketResponse, rt_session: RTSession) -> Optional[str]:
+        if self.fast_path:
+            event_type = peek_event_type(msg.data) or self.codec.event_type(msg.data)
+            if event_type is not None and event_type not in CLIENT_EVENTS_TO_PROCESS:
+                EVENTS.inc(1, "to_client", event_type)
+                if event_type == "response.audio.delta":
+                    if rt_session.response_started_at is not None:
+                        self._observe_first_audio(rt_session)
+                elif event_type == "response.created":
+                    rt_session.response_started_at = time.perf_counter()
+                return msg.data
+            if event_type == "response.audio_transcript.delta":
+                EVENTS.inc(1, "to_client", event_type)
+                # The most frequent event we rewrite, decoded without materializing the whole message
+                if text := self.codec.text_delta(msg.data):
+                    await self._send_json(client_ws, {
+                        "type": "response.text.delta",
+                        "delta": text
+                    })
+                return None
+
+        message = self.codec.loads(msg.data)
         updated_message = msg.data
         
         if message is not None:
+            EVENTS.inc(1, "to_client", message["type"])
             match message["type"]:
+                case "response.created":
+                    rt_session.response_started_at = time.perf_counter()
+
+                case "response.audio.delta":
+                    if rt_session.response_started_at is not None:
+                        self._observe_first_audio(rt_session)
+
                 case "session.created":
                     session = message["session"]
                     # Hide the instructions, tools and max tokens from clients, if we ever allow client-side 
@@ -96,34 +351,13 @@ class RTMiddleTier:
                     session["voice"] = self.voice_choice
                     session["tool_choice"] = "none"
                     session["max_response_output_tokens"] = None
-                    updated_message = json.dumps(message)
-
-                case "response.output_item.added":
-                    if "item" in message and message["item"]["type"] == "text":
-                        text = message["item"]["text"]
-                        question_match = re.search(r'QUESTION: (.*?)\s*ANSWER: (.*?)\s*DIFFICULTY: (.*?)(?:\s|$)', text)
-                        if question_match:
-                            question = question_match.group(1)
-                            answer = question_match.group(2)
-                            difficulty = question_match.group(3).lower()
-                            
-                            session_id = message.get("session_id")
-                            if session_id:
-                                self._current_questions[session_id] = {
-                                    "question": question,
-                                    "answer": answer,
-                                    "difficulty": difficulty
-                                }
-                                
-                            text = text.replace(question_match.group(0), question)
-                            message["item"]["text"] = text
-                            updated_message = json.dumps(message)
+                    updated_message = self.codec.dumps(message)
 
                 case "conversation.item.created":
                     if "item" in message and message["item"]["type"] == "function_call":
                         item = message["item"]
-                        if item["call_id"] not in self._tools_pending:
-                            self._tools_pending[item["call_id"]] = RTToolCall(item["call_id"], message["previous_item_id"])
+                        if item["call_id"] not in rt_session.tools_pending:
+                            rt_session.tools_pending[item["call_id"]] = RTToolCall(item["call_id"], message["previous_item_id"])
                         updated_message = None
                     elif "item" in message and message["item"]["type"] == "function_call_output":
                         updated_message = None
@@ -138,35 +372,20 @@ class RTMiddleTier:
                     if "item" in message and message["item"]["type"] == "function_call":
                         item = message["item"]
                         logger.info(f"Processing tool call: {item['name']}")
-                        tool_call = self._tools_pending[message["item"]["call_id"]]
-                        tool = self.tools[item["name"]]
-                        args = item["arguments"]
-                        result = await tool.target(json.loads(args))
-                        logger.info(f"Tool result direction: {result.destination}")
-                        await server_ws.send_json({
-                            "type": "conversation.item.create",
-                            "item": {
-                                "type": "function_call_output",
-                                "call_id": item["call_id"],
-                                "output": result.to_text() if result.destination == ToolResultDirection.TO_SERVER else ""
-                            }
-                        })
-                        if result.destination == ToolResultDirection.TO_CLIENT:
-                            logger.info("Sending tool result to client")
-                            await client_ws.send_json({
-                                "type": "extension.middle_tier_tool_response",
-                                "previous_item_id": tool_call.previous_id,
-                                "tool_name": item["name"],
-                                "tool_result": result.to_text()
-                            })
+                        tool_call = rt_session.tools_pending[message["item"]["call_id"]]
+                        rt_session.tool_calls += 1
+                        # Run the tool in the background so audio and other events keep flowing while it works,
+                        # multiple calls in one response run in parallel
+                        tool_call.task = rt_session.spawn(self._run_tool(item, tool_call, client_ws, server_ws))
                         updated_message = None
 
                 case "response.done":
-                    if len(self._tools_pending) > 0:
-                        self._tools_pending.clear()
-                        await server_ws.send_json({
-                            "type": "response.create"
-                        })
+                    if len(rt_session.tools_pending) > 0:
+                        tool_tasks = [t.task for t in rt_session.tools_pending.values() if t.task is not None]
+                        rt_session.tools_pending.clear()
+                        rt_session.spawn(self._continue_after_tools(tool_tasks, server_ws))
+                    else:
+                        self._observe_response_end(rt_session)
                     if "response" in message:
                         replace = False
                         for output in message["response"]["output"]:
@@ -174,7 +393,7 @@ class RTMiddleTier:
                                 replace = True
                         
                         # Add a newline after each complete response
-                        await client_ws.send_json({
+                        await self._send_json(client_ws, {
                             "type": "response.text.delta",
                             "delta": "\n\n"
                         })
@@ -184,19 +403,23 @@ class RTMiddleTier:
                                 output for output in message["response"]["output"]
                                 if output["type"] != "function_call"
                             ]
-                            updated_message = json.dumps(message)
+                            updated_message = self.codec.dumps(message)
 
                 case "input_audio_buffer.transcript":
+                    self._score_answer(rt_session, message.get("transcript", ""))
                     # Forward transcript messages to the client
-                    await client_ws.send_json({
+                    await self._send_json(client_ws, {
                         "type": "input_audio_buffer.transcript",
                         "transcript": message.get("transcript", "")
                     })
                     updated_message = None
 
+                case "conversation.item.input_audio_transcription.completed":
+                    self._score_answer(rt_session, message.get("transcript", ""))
+
                 case "response.text":
                     # Forward text messages to the client
-                    await client_ws.send_json({
+                    await self._send_json(client_ws, {
                         "type": "response.text.delta",
                         "delta": message.get("text", "")
                     })
@@ -204,7 +427,7 @@ class RTMiddleTier:
 
                 case "response.text.delta":
                     # Forward text delta messages to the client
-                    await client_ws.send_json({
+                    await self._send_json(client_ws, {
                         "type": "response.text.delta",
                         "delta": message.get("text", "")
                     })
@@ -212,7 +435,7 @@ class RTMiddleTier:
 
                 case "response.text.end":
                     # Forward text end messages to the client
-                    await client_ws.send_json({
+                    await self._send_json(client_ws, {
                         "type": "response.text.delta",
                         "delta": "\n"  # Add a newline at the end of the response
                     })
@@ -220,7 +443,7 @@ class RTMiddleTier:
 
                 case "input_audio_buffer.speech_ended":
                     # Forward speech ended messages to the client
-                    await client_ws.send_json({
+                    await self._send_json(client_ws, {
                         "type": "input_audio_buffer.speech_ended"
                     })
                     updated_message = None
@@ -229,14 +452,14 @@ class RTMiddleTier:
                     if "text" in message:
                         text = message["text"]
                         if text:
-                            await client_ws.send_json({
+                            await self._send_json(client_ws, {
                                 "type": "response.text.delta",
                                 "delta": text
                             })
                     elif "delta" in message:
                         text = message["delta"]
                         if text:
-                            await client_ws.send_json({
+                            await self._send_json(client_ws, {
                                 "type": "response.text.delta",
                                 "delta": text
                             })
@@ -246,7 +469,7 @@ class RTMiddleTier:
                     if "content" in message and isinstance(message["content"], list):
                         for content in message["content"]:
                             if content.get("type") == "text":
-                                await client_ws.send_json({
+                                await self._send_json(client_ws, {
                                     "type": "response.text.delta",
                                     "delta": content.get("text", "")
                                 })
@@ -254,10 +477,97 @@ class RTMiddleTier:
 
         return updated_message
 
+    def _observe_first_audio(self, rt_session: RTSession):
+        TIME_TO_FIRST_AUDIO.observe(time.perf_counter() - rt_session.response_started_at)
+        rt_session.response_started_at = None
+
+    def _observe_response_end(self, rt_session: RTSession):
+        if rt_session.next_question is not None:
+            # A question is recorded by a tool call, and asked in the response the model gives once the call is
+            # done; transcripts of what the student said before can still arrive while it streams, so the
+            # question only expects an answer once that response has ended
+            rt_session.current_question, rt_session.next_question = rt_session.next_question, None
+            logger.info("Quiz question asked in session %s (%s)", rt_session.session_id, rt_session.current_question["difficulty"])
+
+    def attach_quiz_tool(self):
+        """Let the model record the quiz questions it asks, so the student's answers are scored against them"""
+        self.tools["record_quiz_question"] = Tool(schema=QUIZ_TOOL_SCHEMA, target=self._record_quiz_question)
+
+    async def _record_quiz_question(self, args: Any) -> ToolResult:
+        rt_session = current_session.get()
+        question = quiz_question(args)
+        if rt_session is None or question is None:
+            return ToolResult("The question wasn't recorded, ask it anyway.", ToolResultDirection.TO_SERVER)
+        rt_session.next_question = question
+        return ToolResult("Recorded. Now ask the question, without saying the expected answer.", ToolResultDirection.TO_SERVER)
+
+    def _score_answer(self, rt_session: RTSession, transcript: str):
+        question = rt_session.current_question
+        if question is None or not transcript.strip():
+            return
+        rt_session.current_question = None
+        if rt_session.user_id is None:
+            return
+        self.progress_tracker.record_interaction(rt_session.user_id, question["question"], question["answer"],
+                                                 question["difficulty"], score_answer(question["answer"], transcript))
+
+    async def _send_json(self, ws: web.WebSocketResponse, data: dict[str, Any]):
+        await ws.send_json(data, dumps=self.codec.dumps)
+
+    async def _run_tool(self, item: dict[str, Any], tool_call: RTToolCall, client_ws: web.WebSocketResponse, server_ws: web.WebSocketResponse):
+        tool = self.tools[item["name"]]
+        TOOL_CALLS_PENDING.inc()
+        started_at = time.perf_counter()
+        outcome = "ok"
+        try:
+            result = await tool.run(self.codec.loads(item["arguments"]))
+        except asyncio.TimeoutError:
+            logger.warning(f"Tool call {item['name']} timed out after {tool.timeout}s")
+            outcome = "timeout"
+            result = ToolResult(f"The {item['name']} tool timed out, no results are available.", ToolResultDirection.TO_SERVER)
+        except Exception as e:
+            logger.error(f"Tool call {item['name']} failed: {str(e)}")
+            outcome = "error"
+            result = ToolResult(f"The {item['name']} tool failed, no results are available.", ToolResultDirection.TO_SERVER)
+        finally:
+            TOOL_CALLS_PENDING.dec()
+            TOOL_SECONDS.observe(time.perf_counter() - started_at, item["name"], outcome)
+        logger.info(f"Tool result direction: {result.destination}")
+        await self._send_json(server_ws, {
+            "type": "conversation.item.create",
+            "item": {
+                "type": "function_call_output",
+                "call_id": item["call_id"],
+                "output": result.to_text() if result.destination == ToolResultDirection.TO_SERVER else ""
+            }
+        })
+        if result.destination == ToolResultDirection.TO_CLIENT:
+            logger.info("Sending tool result to client")
+            await self._send_json(client_ws, {
+                "type": "extension.middle_tier_tool_response",
+                "previous_item_id": tool_call.previous_id,
+                "tool_name": item["name"],
+                "tool_result": result.to_text()
+            })
+
+    async def _continue_after_tools(self, tool_tasks: list[asyncio.Task], server_ws: web.WebSocketResponse):
+        # The model only continues once every tool output from the response has been sent
+        await asyncio.gather(*tool_tasks, return_exceptions=True)
+        await self._send_json(server_ws, {
+            "type": "response.create"
+        })
+
     async def _process_message_to_server(self, msg: str, ws: web.WebSocketResponse) -> Optional[str]:
-        message = json.loads(msg.data)
+        if self.fast_path:
+            event_type = peek_event_type(msg.data) or self.codec.event_type(msg.data)
+            if event_type is not None and event_type not in SERVER_EVENTS_TO_PROCESS:
+                EVENTS.inc(1, "to_server", event_type if event_type in KNOWN_SERVER_EVENTS else "other")
+                return msg.data
+
+        message = self.codec.loads(msg.data)
         updated_message = msg.data
         if message is not None:
+            EVENTS.inc(1, "to_server", message["type"] if message.get("type") in KNOWN_SERVER_EVENTS else "other")
             match message["type"]:
                 case "session.update":
                     session = message["session"]
@@ -273,61 +583,193 @@ class RTMiddleTier:
                         session["voice"] = self.voice_choice
                     session["tool_choice"] = "auto" if len(self.tools) > 0 else "none"
                     session["tools"] = [tool.schema for tool in self.tools.values()]
-                    updated_message = json.dumps(message)
+                    updated_message = self.codec.dumps(message)
 
         return updated_message
 
-    async def _forward_messages(self, ws: web.WebSocketResponse):
-        # Remove any trailing slashes and path components from the endpoint
-        base_url = self.endpoint.rstrip('/').split('/')[0] + '//' + self.endpoint.rstrip('/').split('/')[2]
+    async def _forward_messages(self, ws: web.WebSocketResponse, rt_session: RTSession, held_messages: Optional["HeldMessages"] = None):
+        current_session.set(rt_session)
+        session = self._upstream_session()
+        params = { "api-version": self.api_version, "deployment": self.deployment}
+        headers = {}
+        if "x-ms-client-request-id" in ws.headers:
+            headers["x-ms-client-request-id"] = ws.headers["x-ms-client-request-id"]
+        if self.key is not None:
+            headers = { "api-key": self.key }
+        else:
+            headers = { "Authorization": f"Bearer {await self.token_manager.get_token()}" }
         
-        async with aiohttp.ClientSession(base_url=base_url) as session:
-            params = { "api-version": self.api_version, "deployment": self.deployment}
-            headers = {}
-            if "x-ms-client-request-id" in ws.headers:
-                headers["x-ms-client-request-id"] = ws.headers["x-ms-client-request-id"]
-            if self.key is not None:
-                headers = { "api-key": self.key }
-            else:
-                headers = { "Authorization": f"Bearer {self._token_provider()}" }
-            
-            # Use the full path for the WebSocket connection
-            ws_path = "/openai/realtime"
-            async with session.ws_connect(ws_path, headers=headers, params=params) as target_ws:
-                async def from_client_to_server():
-                    async for msg in ws:
+        # Use the full path for the WebSocket connection
+        ws_path = "/openai/realtime"
+        connect_started_at = time.perf_counter()
+        try:
+            target_ws = await session.ws_connect(ws_path, headers=headers, params=params)
+        except Exception:
+            self.upstream_stats.session_failures += 1
+            raise
+        self.upstream_stats.observe_session_start(time.perf_counter() - connect_started_at)
+
+        async def close_slow_session():
+            await target_ws.close()
+            try:
+                await asyncio.wait_for(ws.close(code=aiohttp.WSCloseCode.TRY_AGAIN_LATER, message=b"Connection too slow"), 5)
+            except asyncio.TimeoutError:
+                pass
+        # Reading from one side never waits for the other side to accept frames, the queues between them are bounded
+        client_sender = SendBuffer(ws, "to_client", self.codec.dumps, _is_audio_to_client, close_slow_session, **self.send_buffer_options)
+        server_sender = SendBuffer(target_ws, "to_server", self.codec.dumps, _is_audio_to_server, close_slow_session, **self.send_buffer_options)
+        try:
+            async def from_client_to_server():
+                for messages in (ws,) if held_messages is None else (held_messages, ws):
+                    async for msg in messages:
                         if msg.type == aiohttp.WSMsgType.TEXT:
-                            new_msg = await self._process_message_to_server(msg, ws)
+                            started_at = time.perf_counter()
+                            rt_session.messages_to_server += 1
+                            rt_session.touch()
+                            new_msg = await self._process_message_to_server(msg, client_sender)
                             if new_msg is not None:
-                                await target_ws.send_str(new_msg)
+                                await server_sender.send_str(new_msg)
+                            RELAY_SECONDS_TO_SERVER.observe(time.perf_counter() - started_at)
                         else:
                             print("Error: unexpected message type:", msg.type)
+                
+                # Means it is gracefully closed by the client then time to close the target_ws
+                if target_ws:
+                    print("Closing OpenAI's realtime socket connection.")
+                    await target_ws.close()
                     
-                    # Means it is gracefully closed by the client then time to close the target_ws
-                    if target_ws:
-                        print("Closing OpenAI's realtime socket connection.")
-                        await target_ws.close()
-                        
-                async def from_server_to_client():
-                    async for msg in target_ws:
-                        if msg.type == aiohttp.WSMsgType.TEXT:
-                            new_msg = await self._process_message_to_client(msg, ws, target_ws)
-                            if new_msg is not None:
-                                await ws.send_str(new_msg)
-                        else:
-                            print("Error: unexpected message type:", msg.type)
-
-                try:
-                    await asyncio.gather(from_client_to_server(), from_server_to_client())
-                except ConnectionResetError:
-                    # Ignore the errors resulting from the client disconnecting the socket
-                    pass
+            async def from_server_to_client():
+                async for msg in target_ws:
+                    if msg.type == aiohttp.WSMsgType.TEXT:
+                        started_at = time.perf_counter()
+                        rt_session.messages_to_client += 1
+                        new_msg = await self._process_message_to_client(msg, client_sender, server_sender, rt_session)
+                        if new_msg is not None:
+                            await client_sender.send_str(new_msg)
+                        RELAY_SECONDS_TO_CLIENT.observe(time.perf_counter() - started_at)
+                    else:
+                        print("Error: unexpected message type:", msg.type)
+
+            readers = [asyncio.create_task(from_client_to_server()), asyncio.create_task(from_server_to_client())]
+            try:
+                # Either side going away, or a sender finding its socket gone, ends the session for both sides
+                await asyncio.wait(readers + [client_sender.writer, server_sender.writer], return_when=asyncio.FIRST_COMPLETED)
+            finally:
+                rt_session.cancel_tasks()
+                await client_sender.close(flush_timeout=2)
+                await server_sender.close()
+                await target_ws.close()
+                await ws.close()
+                # With both sockets closed the readers end on their own, cancelling a receive would break the socket
+                _, pending = await asyncio.wait(readers, timeout=5)
+                for task in pending:
+                    task.cancel()
+            for task in readers:
+                # Ignore the errors resulting from the client disconnecting the socket
+                if task.done() and not task.cancelled() and not isinstance(task.exception(), (ConnectionResetError, type(None))):
+                    raise task.exception()
+        finally:
+            await target_ws.close()
+
+    async def _wait_for_admission(self, ws: web.WebSocketResponse, ticket: Ticket) -> Optional[HeldMessages]:
+        """Wait for an upstream slot, sending the client its place in the queue. Returns the client's messages
+        received in the meantime, or None if the client left or gave up waiting"""
+        held = HeldMessages(ws, self.max_held_messages)
+
+        async def send_position(position: int, waiting: int):
+            await self._send_json(ws, {"type": "extension.queue_position", "position": position, "queue_length": waiting})
+
+        waiter = asyncio.create_task(self.admission.wait(ticket, send_position))
+        try:
+            await asyncio.wait((held.reader, waiter), return_when=asyncio.FIRST_COMPLETED)
+            if not waiter.done():
+                held.close()
+                return None
+            waiter.result()
+            held.handover()
+            await send_position(0, len(self.admission))
+            return held
+        except AdmissionRejected as e:
+            await ws.close(code=aiohttp.WSCloseCode.TRY_AGAIN_LATER, message=str(e).encode())
+            held.close()
+            return None
+        except ConnectionResetError:
+            held.close()
+            return None
+        finally:
+            waiter.cancel()
 
     async def _websocket_handler(self, request: web.Request):
         ws = web.WebSocketResponse()
         await ws.prepare(request)
-        await self._forward_messages(ws)
+        if self.sessions.is_full():
+            logger.warning("Rejecting connection, %d sessions already open", len(self.sessions))
+            REJECTED_SESSIONS.inc()
+            await ws.close(code=aiohttp.WSCloseCode.TRY_AGAIN_LATER, message=b"Server is at capacity")
+            return ws
+        user_id = request.query.get("user_id")
+        if user_id and not is_valid_user_id(user_id):
+            logger.warning("Rejecting connection with an invalid user_id")
+            await ws.close(code=aiohttp.WSCloseCode.POLICY_VIOLATION, message=b"Invalid user_id")
+            return ws
+        ticket = None
+        if self.admission is not None:
+            try:
+                ticket = await self.admission.request(request.query.get("classroom"))
+            except AdmissionRejected:
+                REJECTED_SESSIONS.inc()
+                await ws.close(code=aiohttp.WSCloseCode.TRY_AGAIN_LATER, message=b"Server is at capacity")
+                return ws
+        rt_session = RTSession(ws)
+        if user_id:
+            rt_session.user_id = user_id
+        if user_id and ("grade" in request.query or "classroom" in request.query):
+            grade = request.query.get("grade")
+            rt_session.spawn(self.progress_tracker.register_user(
+                rt_session.user_id, int(grade) if grade and grade.isdigit() else None, request.query.get("classroom")))
+        self.sessions.add(rt_session)
+        ACTIVE_SESSIONS.inc()
+        try:
+            held_messages = None
+            if ticket is not None and not ticket.admitted.done():
+                held_messages = await self._wait_for_admission(ws, ticket)
+                if held_messages is None:
+                    return ws
+            await self._forward_messages(ws, rt_session, held_messages)
+        finally:
+            if held_messages is not None:
+                held_messages.close()
+            if ticket is not None:
+                self.admission.release(ticket)
+            ACTIVE_SESSIONS.dec()
+            self.sessions.remove(rt_session)
         return ws
     
+    def _upstream_session(self) -> aiohttp.ClientSession:
+        if self._http is None:
+            # Remove any trailing slashes and path components from the endpoint
+            base_url = self.endpoint.rstrip('/').split('/')[0] + '//' + self.endpoint.rstrip('/').split('/')[2]
+            self._http = create_upstream_session(base_url, self.upstream_stats, **self.upstream_options)
+        return self._http
+
+    async def start_upstream(self, _app=None):
+        self._upstream_session()
+        if self.token_manager is not None:
+            # Warm up during startup so we have a token cached when the first request arrives
+            await self.token_manager.start()
+
+    async def close_upstream(self, _app=None):
+        if self._http is not None:
+            logger.info("Upstream connection stats: %s", self.upstream_stats.snapshot())
+            await self._http.close()
+            self._http = None
+        if self.token_manager is not None:
+            await self.token_manager.close()
+
     def attach_to_app(self, app, path):
         app.router.add_get(path, self._websocket_handler)
+        app.on_startup.append(self.start_upstream)
+        app.on_cleanup.append(self.close_upstream)
+        app.on_cleanup.append(self.progress_tracker.close)
+        app.on_startup.append(self.sessions.start)
+        app.on_shutdown.append(self.sessions.stop)
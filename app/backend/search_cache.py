@@ -0,0 +1,196 @@
+import asyncio
+import hashlib
+import json
+import logging
+import re
+import sqlite3
+import time
+from collections import OrderedDict
+from collections.abc import Callable
+from typing import Any, Optional
+
+logger = logging.getLogger("voicerag")
+
+_WHITESPACE = re.compile(r"\s+")
+_PUNCTUATION = re.compile(r"[^\w\s]")
+
+def normalize_query(query: str) -> str:
+    """Fold case, punctuation and whitespace so trivially different phrasings share a cache entry"""
+    query = _PUNCTUATION.sub(" ", query.casefold())
+    return _WHITESPACE.sub(" ", query).strip()
+
+def make_cache_key(query: str, **params: Any) -> str:
+    params_text = json.dumps(params, sort_keys=True, default=str)
+    return hashlib.sha1(f"{normalize_query(query)}\x00{params_text}".encode()).hexdigest()
+
+class CacheBackend:
+    """Storage interface used by SearchCache, calls to a blocking backend are made from a worker thread"""
+    blocking = False
+
+    def get(self, key: str) -> Optional[Any]:
+        raise NotImplementedError
+
+    def set(self, key: str, value: Any, ttl: float) -> None:
+        raise NotImplementedError
+
+    def clear(self) -> None:
+        raise NotImplementedError
+
+    def __len__(self) -> int:
+        raise NotImplementedError
+
+class InMemoryCacheBackend(CacheBackend):
+    def __init__(self, max_entries: int = 1024):
+        self.max_entries = max_entries
+        self._entries: OrderedDict[str, tuple[float, Any]] = OrderedDict()
+
+    def get(self, key: str) -> Optional[Any]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        expires_at, value = entry
+        if expires_at < time.monotonic():
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return value
+
+    def set(self, key: str, value: Any, ttl: float) -> None:
+        self._entries[key] = (time.monotonic() + ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def clear(self) -> None:
+        self._entries.clear()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+class SqliteCacheBackend(CacheBackend):
+    """Cache shared by every process on the host through a single SQLite file"""
+    blocking = True
+
+    def __init__(self, path: str, max_entries: int = 10000):
+        self.path = path
+        self.max_entries = max_entries
+        self._db = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS search_cache ("
+            "key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL NOT NULL, accessed_at REAL NOT NULL)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS search_cache_accessed ON search_cache (accessed_at)")
+
+    def get(self, key: str) -> Optional[Any]:
+        now = time.time()
+        row = self._db.execute("SELECT value, expires_at FROM search_cache WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        if row[1] < now:
+            self._db.execute("DELETE FROM search_cache WHERE key = ?", (key,))
+            return None
+        self._db.execute("UPDATE search_cache SET accessed_at = ? WHERE key = ?", (now, key))
+        return json.loads(row[0])
+
+    def set(self, key: str, value: Any, ttl: float) -> None:
+        now = time.time()
+        self._db.execute(
+            "INSERT OR REPLACE INTO search_cache (key, value, expires_at, accessed_at) VALUES (?, ?, ?, ?)",
+            (key, json.dumps(value), now + ttl, now))
+        # Evict least recently used rows beyond the bound
+        self._db.execute(
+            "DELETE FROM search_cache WHERE key IN ("
+            "SELECT key FROM search_cache ORDER BY accessed_at DESC LIMIT -1 OFFSET ?)", (self.max_entries,))
+
+    def clear(self) -> None:
+        self._db.execute("DELETE FROM search_cache")
+
+    def __len__(self) -> int:
+        return self._db.execute("SELECT COUNT(*) FROM search_cache").fetchone()[0]
+
+class IndexVersionTracking:
+    """Invalidates a cache whenever the observed version of the search index (e.g. its document count) changes"""
+    index_check_interval: float = 300
+    _index_version: Optional[Any] = None
+    _index_checked_at: float = 0.0
+
+    async def invalidate(self) -> None:
+        raise NotImplementedError
+
+    def index_check_due(self) -> bool:
+        return time.monotonic() - self._index_checked_at >= self.index_check_interval
+
+    async def observe_index_version(self, version: Any) -> bool:
+        self._index_checked_at = time.monotonic()
+        changed = self._index_version is not None and version != self._index_version
+        if changed:
+            logger.info("Search index changed (%s -> %s)", self._index_version, version)
+            await self.invalidate()
+        self._index_version = version
+        return changed
+
+class SearchCache(IndexVersionTracking):
+    """TTL cache for search results keyed on the normalized query and the search parameters"""
+
+    def __init__(self, backend: Optional[CacheBackend] = None, ttl: float = 600, index_check_interval: float = 300):
+        self.backend = backend if backend is not None else InMemoryCacheBackend()
+        self.ttl = ttl
+        self.index_check_interval = index_check_interval
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    async def _backend_call(self, method: Callable, *args):
+        if self.backend.blocking:
+            return await asyncio.to_thread(method, *args)
+        return method(*args)
+
+    async def get(self, query: str, **params: Any) -> Optional[Any]:
+        value = await self._backend_call(self.backend.get, make_cache_key(query, **params))
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    async def set(self, query: str, value: Any, **params: Any) -> None:
+        await self._backend_call(self.backend.set, make_cache_key(query, **params), value, self.ttl)
+
+    async def invalidate(self) -> None:
+        await self._backend_call(self.backend.clear)
+        self.invalidations += 1
+        logger.info("Search cache invalidated")
+
+    def stats(self) -> dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups > 0 else 0,
+            "invalidations": self.invalidations,
+            "entries": len(self.backend)
+        }
+
+class ChunkCache:
+    """Bounded LRU map of chunk_id to document, kept per session so grounding can reuse recent search results"""
+
+    def __init__(self, max_entries: int = 256):
+        self.max_entries = max_entries
+        self._docs: OrderedDict[str, dict[str, str]] = OrderedDict()
+
+    def add(self, docs: list[dict[str, str]]) -> None:
+        for doc in docs:
+            self._docs[doc["chunk_id"]] = doc
+            self._docs.move_to_end(doc["chunk_id"])
+        while len(self._docs) > self.max_entries:
+            self._docs.popitem(last=False)
+
+    def get(self, chunk_id: str) -> Optional[dict[str, str]]:
+        doc = self._docs.get(chunk_id)
+        if doc is not None:
+            self._docs.move_to_end(chunk_id)
+        return doc
+
+    def __len__(self) -> int:
+        return len(self._docs)
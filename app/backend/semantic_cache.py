@@ -0,0 +1,80 @@
+import logging
+import time
+from typing import Any, Optional
+
+import numpy as np
+
+from embeddings import Embedder
+from search_cache import IndexVersionTracking
+
+logger = logging.getLogger("voicerag")
+
+class SemanticCache(IndexVersionTracking):
+    """Answers near-duplicate queries from earlier results when their embeddings are close enough.
+
+    Embeddings live in a preallocated (capacity, dimensions) float32 matrix so a lookup is a single
+    matrix-vector product; when full, the least recently used slot is overwritten.
+    """
+
+    def __init__(self, embedder: Embedder, capacity: int = 512, threshold: float = 0.92, ttl: float = 600, index_check_interval: float = 300):
+        self.embedder = embedder
+        self.capacity = capacity
+        self.threshold = threshold
+        self.ttl = ttl
+        self.index_check_interval = index_check_interval
+        self._vectors = np.zeros((capacity, embedder.dimensions), dtype=np.float32)
+        self._expires_at = np.zeros(capacity, dtype=np.float64)
+        self._last_used = np.zeros(capacity, dtype=np.float64)
+        self._values: list[Any] = [None] * capacity
+        self._size = 0
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    async def lookup(self, query: str) -> tuple[Optional[Any], np.ndarray]:
+        """Return the cached value for the closest previous query (or None) along with the query embedding,
+        so a miss can be stored later without embedding the query twice"""
+        vector = await self.embedder.embed_one(query)
+        if self._size > 0:
+            now = time.monotonic()
+            scores = self._vectors[:self._size] @ vector
+            scores[self._expires_at[:self._size] < now] = -1
+            best = int(np.argmax(scores))
+            if scores[best] >= self.threshold:
+                self._last_used[best] = now
+                self.hits += 1
+                logger.info(f"Semantic cache hit for '{query}' (similarity {scores[best]:.3f})")
+                return self._values[best], vector
+        self.misses += 1
+        return None, vector
+
+    def add(self, vector: np.ndarray, value: Any) -> None:
+        now = time.monotonic()
+        if self._size < self.capacity:
+            slot = self._size
+            self._size += 1
+        else:
+            # Expired entries have the oldest effective use, so prefer them before live LRU entries
+            usage = np.where(self._expires_at < now, -np.inf, self._last_used)
+            slot = int(np.argmin(usage))
+        self._vectors[slot] = vector
+        self._expires_at[slot] = now + self.ttl
+        self._last_used[slot] = now
+        self._values[slot] = value
+
+    async def invalidate(self) -> None:
+        self._values = [None] * self.capacity
+        self._size = 0
+        self.invalidations += 1
+        logger.info("Semantic cache invalidated")
+
+    def stats(self) -> dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups > 0 else 0,
+            "invalidations": self.invalidations,
+            "entries": self._size,
+            "memory_bytes": self._vectors.nbytes
+        }
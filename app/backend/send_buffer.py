@@ -0,0 +1,177 @@
+import asyncio
+import logging
+import time
+from collections import deque
+from collections.abc import Awaitable, Callable
+from typing import Any, Optional
+
+from metrics import REGISTRY
+
+logger = logging.getLogger("voicerag")
+
+# Synthesized transcript deltas, coalesced before they are queued and merged while they wait in the queue
+TEXT_DELTA_EVENT = "response.text.delta"
+
+DROPPED_FRAMES = REGISTRY.counter("rtmt_dropped_frames", "Audio frames dropped because the receiving side fell behind", ("direction",))
+MERGED_FRAMES = REGISTRY.counter("rtmt_merged_frames", "Text deltas merged into another frame instead of sent on their own", ("direction",))
+SLOW_CONSUMERS = REGISTRY.counter("rtmt_slow_consumers", "Sessions closed because the receiving side could not keep up", ("direction",))
+QUEUE_SECONDS = REGISTRY.histogram("rtmt_send_queue_seconds", "Time frames wait in the send queue", ("direction",))
+
+class SendBuffer:
+    """Bounded send queue for one direction of the relay, so a slow receiver never blocks reading from the other side.
+
+    Frames are queued and written by a background task. While frames wait, text deltas are merged into the one
+    already queued; audio (is_audio) that has waited longer than max_audio_delay, or that keeps the queue over
+    max_bytes, is dropped oldest first. If the queue is still over max_bytes or its oldest frame has waited longer
+    than max_delay, the receiver is considered hopeless: the queue is discarded and on_slow_consumer is called.
+
+    With a coalesce_window, a text delta is also held back for up to that many seconds (or until it reaches
+    coalesce_max_chars) so the deltas that follow go out in the same frame. Audio may overtake held text, any
+    other frame sends it first.
+    """
+
+    def __init__(self, ws, direction: str, dumps: Callable[[Any], str], is_audio: Callable[[str], bool],
+                 on_slow_consumer: Optional[Callable[[], Awaitable[None]]] = None,
+                 max_bytes: int = 2 * 1024 * 1024, max_audio_delay: float = 5, max_delay: float = 15,
+                 coalesce_window: float = 0, coalesce_max_chars: int = 200):
+        self.ws = ws
+        self.direction = direction
+        self.dumps = dumps
+        self.is_audio = is_audio
+        self.on_slow_consumer = on_slow_consumer
+        self.max_bytes = max_bytes
+        self.max_audio_delay = max_audio_delay
+        self.max_delay = max_delay
+        self.coalesce_window = coalesce_window
+        self.coalesce_max_chars = coalesce_max_chars
+        self.closed = False
+        self.bytes = 0
+        # [enqueued_at, str or text delta dict, size]
+        self._frames: deque[list] = deque()
+        self._held: Optional[dict[str, str]] = None
+        self._held_timer: Optional[asyncio.TimerHandle] = None
+        self._next_relief = 0.0
+        self._wakeup = asyncio.Event()
+        self._idle = asyncio.Event()
+        self._idle.set()
+        self._queue_seconds = QUEUE_SECONDS.labels(direction)
+        self._closing: Optional[asyncio.Task] = None
+        # Only ends when the buffer is closed or the socket is gone
+        self.writer = asyncio.create_task(self._write())
+
+    async def send_str(self, data: str):
+        if self._held is not None and not self.is_audio(data):
+            self._release_text()
+        self._append(data, len(data))
+
+    async def send_json(self, data: dict[str, Any], dumps: Optional[Callable[[Any], str]] = None):
+        if data.get("type") != TEXT_DELTA_EVENT:
+            self._release_text()
+            text = (dumps or self.dumps)(data)
+            self._append(text, len(text))
+            return
+        delta = data.get("delta", "")
+        if self._held is not None:
+            self._held["delta"] += delta
+            MERGED_FRAMES.inc(1, self.direction)
+            if len(self._held["delta"]) >= self.coalesce_max_chars:
+                self._release_text()
+            return
+        frames = self._frames
+        if frames and frames[-1][1].__class__ is dict:
+            frames[-1][1]["delta"] += delta
+            frames[-1][2] += len(delta)
+            self.bytes += len(delta)
+            MERGED_FRAMES.inc(1, self.direction)
+            return
+        if self.coalesce_window > 0 and len(delta) < self.coalesce_max_chars and not self.closed:
+            self._held = {"type": TEXT_DELTA_EVENT, "delta": delta}
+            self._held_timer = asyncio.get_running_loop().call_later(self.coalesce_window, self._release_text)
+            return
+        self._append({"type": TEXT_DELTA_EVENT, "delta": delta}, len(delta) + 40)
+
+    def _release_text(self):
+        held = self._held
+        if held is None:
+            return
+        self._held = None
+        self._held_timer.cancel()
+        self._append(held, len(held["delta"]) + 40)
+
+    def _append(self, item: str | dict, size: int):
+        if self.closed:
+            return
+        now = time.monotonic()
+        frames = self._frames
+        if not frames:
+            self._idle.clear()
+            self._wakeup.set()
+        frames.append([now, item, size])
+        self.bytes += size
+        if self.bytes > self.max_bytes or (now - frames[0][0] > self.max_audio_delay and now >= self._next_relief):
+            self._relieve(now)
+
+    def _relieve(self, now: float):
+        low_water = self.max_bytes * 3 // 4
+        kept = deque()
+        dropped = 0
+        for frame in self._frames:
+            if (frame[1].__class__ is str and (self.bytes > low_water or now - frame[0] > self.max_audio_delay)
+                    and self.is_audio(frame[1])):
+                self.bytes -= frame[2]
+                dropped += 1
+            else:
+                kept.append(frame)
+        self._frames = kept
+        # Scanning the queue is linear, so an old frame that can't be dropped only triggers it a few times a second
+        self._next_relief = now + 0.25
+        if dropped:
+            DROPPED_FRAMES.inc(dropped, self.direction)
+            logger.debug("Dropped %d stale %s frames", dropped, self.direction)
+        if self.bytes > self.max_bytes or (kept and now - kept[0][0] > self.max_delay):
+            self._give_up()
+
+    def _give_up(self):
+        logger.warning("Closing session, %s receiver fell behind by %d bytes", self.direction, self.bytes)
+        SLOW_CONSUMERS.inc(1, self.direction)
+        self._discard()
+        if self.on_slow_consumer is not None:
+            self._closing = asyncio.create_task(self.on_slow_consumer())
+
+    def _discard(self):
+        self.closed = True
+        if self._held is not None:
+            self._held = None
+            self._held_timer.cancel()
+        self._frames.clear()
+        self.bytes = 0
+        self._idle.set()
+
+    async def _write(self):
+        try:
+            while True:
+                if not self._frames:
+                    self._idle.set()
+                    self._wakeup.clear()
+                    await self._wakeup.wait()
+                    continue
+                enqueued_at, item, size = self._frames.popleft()
+                self.bytes -= size
+                self._queue_seconds.observe(time.monotonic() - enqueued_at)
+                await self.ws.send_str(item if item.__class__ is str else self.dumps(item))
+        except ConnectionResetError:
+            # The receiver is gone, the relay ends the session when this task ends
+            self._discard()
+
+    async def close(self, flush_timeout: float = 0):
+        """Stop sending, after waiting up to flush_timeout seconds for queued frames to go out"""
+        self._release_text()
+        if flush_timeout > 0 and not self.closed:
+            try:
+                await asyncio.wait_for(self._idle.wait(), flush_timeout)
+            except asyncio.TimeoutError:
+                pass
+        self._discard()
+        self.writer.cancel()
+        if self._closing is not None:
+            await self._closing
@@ -0,0 +1,150 @@
+"""Production launcher: runs the app in several worker processes that share one port, so relaying and JSON work
+for hundreds of sockets is spread over every core instead of saturating one.
+
+    python serve.py [--workers 4] [--host 0.0.0.0] [--port 8000] [--state-dir state] [--metrics-port 9100]
+
+Every worker binds the port with SO_REUSEPORT and the kernel spreads new connections across them. A session
+stays in the worker that accepted it. State the workers have to agree on lives in SQLite files in --state-dir,
+unless the environment already points it somewhere else:
+
+* the search cache (AZURE_SEARCH_CACHE_PATH)
+* upstream session slots for admission control (RTMT_ADMISSION_DB), so RTMT_MAX_UPSTREAM_SESSIONS caps the
+  sessions of all workers together
+* the student progress store, when PROGRESS_STORE=sqlite (PROGRESS_DB_PATH); each worker still keeps its own
+  in-memory progress counters for recently active students, so only the stored progress is shared
+
+Metrics are kept per worker. With --metrics-port, worker i serves /metrics on metrics port + i, so each worker
+can be scraped on its own; with RTMT_METRICS_ENABLED=true, /metrics on the main port answers for whichever worker
+took the request.
+A worker that exits unexpectedly is restarted.
+"""
+import argparse
+import logging
+import multiprocessing
+import os
+import signal
+import socket
+import time
+from collections.abc import Awaitable, Callable
+from multiprocessing.connection import wait
+from pathlib import Path
+
+from aiohttp import web
+from dotenv import load_dotenv
+
+from app import create_app
+from metrics import metrics_handler
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger("voicerag")
+
+AppFactory = Callable[[], Awaitable[web.Application]]
+
+def available_cores() -> int:
+    """Cores this process may run on; sched_getaffinity is Linux only"""
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+def shared_state_defaults(state_dir: str) -> dict[str, str]:
+    """Environment for the state workers share, set for every worker unless already configured"""
+    Path(state_dir).mkdir(parents=True, exist_ok=True)
+    defaults = {
+        "AZURE_SEARCH_CACHE_PATH": os.path.join(state_dir, "search_cache.db"),
+        "RTMT_ADMISSION_DB": os.path.join(state_dir, "admission.db")
+    }
+    if os.environ.get("PROGRESS_STORE") == "sqlite":
+        defaults["PROGRESS_DB_PATH"] = os.path.join(state_dir, "progress.db")
+    return {name: value for name, value in defaults.items() if not os.environ.get(name)}
+
+async def _worker_app(create_app: AppFactory, index: int, host: str, metrics_port: int) -> web.Application:
+    app = await create_app()
+    if metrics_port:
+        metrics_app = web.Application()
+        metrics_app.router.add_get("/metrics", metrics_handler)
+        metrics_runner = web.AppRunner(metrics_app, access_log=None)
+
+        async def start_metrics(_app):
+            await metrics_runner.setup()
+            await web.TCPSite(metrics_runner, host, metrics_port + index).start()
+
+        async def stop_metrics(_app):
+            await metrics_runner.cleanup()
+        app.on_startup.append(start_metrics)
+        app.on_cleanup.append(stop_metrics)
+    return app
+
+def run_worker(create_app: AppFactory, index: int, host: str, port: int, metrics_port: int = 0):
+    # Forked workers inherit the supervisor's handlers until run_app installs its own
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    logger.info("Worker %d (pid %d) serving on %s:%d", index, os.getpid(), host, port)
+    web.run_app(_worker_app(create_app, index, host, metrics_port), host=host, port=port, reuse_port=True, print=None)
+
+def serve(create_app: AppFactory, workers: int, host: str, port: int, metrics_port: int = 0):
+    """Run workers until SIGINT or SIGTERM, restarting any that exit on their own"""
+    if workers > 1 and not hasattr(socket, "SO_REUSEPORT"):
+        raise SystemExit("Several workers need SO_REUSEPORT, which this platform doesn't have, use --workers 1")
+    stopping = False
+
+    def stop(_signum, _frame):
+        nonlocal stopping
+        stopping = True
+
+    def start(index: int) -> multiprocessing.Process:
+        process = multiprocessing.Process(target=run_worker, args=(create_app, index, host, port, metrics_port),
+                                          name=f"worker-{index}")
+        process.start()
+        return process
+
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+    processes = {index: start(index) for index in range(workers)}
+    restarted_at = {}
+    while not stopping:
+        wait([p.sentinel for p in processes.values()], timeout=1)
+        for index, process in list(processes.items()):
+            if process.is_alive() or stopping:
+                continue
+            # Back off if the worker keeps dying, e.g. on a configuration error
+            if time.monotonic() - restarted_at.get(index, 0) < 5:
+                time.sleep(1)
+            logger.warning("Worker %d exited with code %s, restarting it", index, process.exitcode)
+            restarted_at[index] = time.monotonic()
+            processes[index] = start(index)
+    for process in processes.values():
+        process.terminate()
+    for process in processes.values():
+        process.join(30)
+        if process.is_alive():
+            process.kill()
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--workers", type=int, default=os.environ.get("RTMT_WORKERS") or None,
+                        help="Worker processes (default one per available core)")
+    parser.add_argument("--host", default=os.environ.get("RTMT_HOST") or "localhost")
+    parser.add_argument("--port", type=int, default=int(os.environ.get("RTMT_PORT") or 8765))
+    parser.add_argument("--state-dir", default=os.environ.get("RTMT_STATE_DIR") or "state",
+                        help="Directory for the SQLite files the workers share")
+    parser.add_argument("--metrics-port", type=int, default=int(os.environ.get("RTMT_METRICS_PORT") or 0),
+                        help="First of the per-worker metrics ports, 0 to not serve them")
+    args = parser.parse_args()
+    if args.workers is None:
+        args.workers = available_cores()
+
+    if not os.environ.get("RUNNING_IN_PRODUCTION"):
+        # Read .env here so the shared state defaults don't override it in the workers
+        load_dotenv()
+    if args.workers > 1:
+        for name, value in shared_state_defaults(args.state_dir).items():
+            logger.info("Sharing state between workers: %s=%s", name, value)
+            os.environ[name] = value
+        if os.environ.get("PROGRESS_STORE") != "sqlite":
+            logger.warning("Stored progress is only shared between workers with PROGRESS_STORE=sqlite")
+
+    logger.info("Starting %d workers on %s:%d", args.workers, args.host, args.port)
+    serve(create_app, args.workers, args.host, args.port, args.metrics_port)
+
+if __name__ == "__main__":
+    main()
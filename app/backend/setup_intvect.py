@@ -1,7 +1,9 @@
+import hashlib
 import json
 import logging
 import os
 import subprocess
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 from azure.core.exceptions import ResourceExistsError
 from azure.identity import AzureDeveloperCliCredential
@@ -15,7 +17,10 @@ from azure.search.documents.indexes.models import (
     HnswParameters,
     IndexProjectionMode,
     InputFieldMappingEntry,
+    NativeBlobSoftDeleteDeletionDetectionPolicy,
     OutputFieldMappingEntry,
+    ScalarQuantizationCompressionConfiguration,
+    ScalarQuantizationParameters,
     SearchableField,
     SearchField,
     SearchFieldDataType,
@@ -59,21 +64,49 @@ def load_azd_env():
     load_dotenv(env_file_path, override=True)
 
 
-def setup_index(azure_credential, index_name, azure_search_endpoint, azure_storage_connection_string, azure_storage_container, azure_openai_embedding_endpoint, azure_openai_embedding_deployment, azure_openai_embedding_model, azure_openai_embeddings_dimensions):
+def vector_compression(kind, rerank_with_original_vectors=True, oversampling=None):
+    """Compression configuration for the text_vector field: None or "scalar" (int8).
+
+    Binary quantization isn't offered: the pinned azure-search-documents (11.6.0b4) has no model for it.
+    """
+    if kind in (None, "", "none"):
+        return None
+    if kind == "scalar":
+        return ScalarQuantizationCompressionConfiguration(
+            name="compression",
+            rerank_with_original_vectors=rerank_with_original_vectors,
+            default_oversampling=oversampling,
+            parameters=ScalarQuantizationParameters(quantized_data_type="int8"))
+    raise ValueError(f"Unknown vector compression: {kind}")
+
+def setup_index(azure_credential, index_name, azure_search_endpoint, azure_storage_connection_string, azure_storage_container, azure_openai_embedding_endpoint, azure_openai_embedding_deployment, azure_openai_embedding_model, azure_openai_embeddings_dimensions,
+                hnsw_parameters=None, compression=None):
+    """Create the data source, index, skillset and indexer if they don't exist.
+
+    azure_openai_embeddings_dimensions below the model's native size stores shortened (Matryoshka) embeddings, which
+    text-embedding-3 models support. Changing the vector settings of an existing index requires deleting it first.
+    """
+    hnsw_parameters = hnsw_parameters or HnswParameters(metric=VectorSearchAlgorithmMetric.COSINE)
     index_client = SearchIndexClient(azure_search_endpoint, azure_credential)
     indexer_client = SearchIndexerClient(azure_search_endpoint, azure_credential)
 
-    data_source_connections = indexer_client.get_data_source_connections()
-    if index_name in [ds.name for ds in data_source_connections]:
-        logger.info(f"Data source connection {index_name} already exists, not re-creating")
-    else:
+    # Blobs deleted by upload_documents stay soft-deleted for the storage account's retention period, the indexer
+    # picks them up through this policy and removes their chunks from the index
+    data_source_connection = SearchIndexerDataSourceConnection(
+        name=index_name,
+        type=SearchIndexerDataSourceType.AZURE_BLOB,
+        connection_string=azure_storage_connection_string,
+        container=SearchIndexerDataContainer(name=azure_storage_container),
+        data_deletion_detection_policy=NativeBlobSoftDeleteDeletionDetectionPolicy())
+    data_source_connections = {ds.name: ds for ds in indexer_client.get_data_source_connections()}
+    if index_name not in data_source_connections:
         logger.info(f"Creating data source connection: {index_name}")
-        indexer_client.create_data_source_connection(
-            data_source_connection=SearchIndexerDataSourceConnection(
-                name=index_name, 
-                type=SearchIndexerDataSourceType.AZURE_BLOB,
-                connection_string=azure_storage_connection_string,
-                container=SearchIndexerDataContainer(name=azure_storage_container)))
+        indexer_client.create_data_source_connection(data_source_connection=data_source_connection)
+    elif data_source_connections[index_name].data_deletion_detection_policy is None:
+        logger.info(f"Adding deletion detection to data source connection: {index_name}")
+        indexer_client.create_or_update_data_source_connection(data_source_connection)
+    else:
+        logger.info(f"Data source connection {index_name} already exists, not re-creating")
 
     index_names = [index.name for index in index_client.list_indexes()]
     if index_name in index_names:
@@ -84,22 +117,23 @@ def setup_index(azure_credential, index_name, azure_search_endpoint, azure_stora
             SearchIndex(
                 name=index_name,
                 fields=[
-                    SearchableField(name="chunk_id", key=True, analyzer_name="keyword", sortable=True),
+                    SearchableField(name="chunk_id", key=True, analyzer_name="keyword", sortable=True, filterable=True),
                     SimpleField(name="parent_id", type=SearchFieldDataType.String, filterable=True),
                     SearchableField(name="title"),
                     SearchableField(name="chunk"),
                     SearchField(
                         name="text_vector", 
                         type=SearchFieldDataType.Collection(SearchFieldDataType.Single),
-                        vector_search_dimensions=EMBEDDINGS_DIMENSIONS,
+                        vector_search_dimensions=azure_openai_embeddings_dimensions,
                         vector_search_profile_name="vp",
                         stored=True,
                         hidden=False)
                 ],
                 vector_search=VectorSearch(
                     algorithms=[
-                        HnswAlgorithmConfiguration(name="algo", parameters=HnswParameters(metric=VectorSearchAlgorithmMetric.COSINE))
+                        HnswAlgorithmConfiguration(name="algo", parameters=hnsw_parameters)
                     ],
+                    compressions=[compression] if compression is not None else None,
                     vectorizers=[
                         AzureOpenAIVectorizer(
                             name="openai_vectorizer",
@@ -111,7 +145,7 @@ def setup_index(azure_credential, index_name, azure_search_endpoint, azure_stora
                         )
                     ],
                     profiles=[
-                        VectorSearchProfile(name="vp", algorithm_configuration_name="algo", vectorizer="openai_vectorizer")
+                        VectorSearchProfile(name="vp", algorithm_configuration_name="algo", vectorizer="openai_vectorizer", compression_configuration_name=compression.name if compression is not None else None)
                     ]
                 ),
                 semantic_search=SemanticSearch(
@@ -184,29 +218,62 @@ def setup_index(azure_credential, index_name, azure_search_endpoint, azure_stora
             )
         )
 
-def upload_documents(azure_credential, indexer_name, azure_search_endpoint, azure_storage_endpoint, azure_storage_container):
+CONTENT_HASH_METADATA = "content_sha256"
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+def upload_documents(azure_credential, indexer_name, azure_search_endpoint, azure_storage_endpoint, azure_storage_container, data_dir="data", max_workers=8, delete_removed=False):
+    """Sync the files in data_dir to the blob storage container.
+
+    Blobs carry the SHA-256 of their content as metadata, so only new or changed files are uploaded, in parallel;
+    large files go up as concurrent 4 MiB blocks. With delete_removed, blobs without a matching local file are deleted.
+    """
     indexer_client = SearchIndexerClient(azure_search_endpoint, azure_credential)
-    # Upload the documents in /data folder to the blob storage container
     blob_client = BlobServiceClient(
         account_url=azure_storage_endpoint, credential=azure_credential,
-        max_single_put_size=4 * 1024 * 1024
+        max_single_put_size=4 * 1024 * 1024,
+        max_block_size=4 * 1024 * 1024
     )
     container_client = blob_client.get_container_client(azure_storage_container)
     if not container_client.exists():
         container_client.create_container()
-    existing_blobs = [blob.name for blob in container_client.list_blobs()]
+    # A single paged listing gives us every blob's stored hash
+    existing_hashes = {blob.name: (blob.metadata or {}).get(CONTENT_HASH_METADATA) for blob in container_client.list_blobs(include=["metadata"])}
 
-    # Open each file in /data folder
-    for file in os.scandir("data"):
-        with open(file.path, "rb") as opened_file:
-            filename = os.path.basename(file.path)
-            # Check if blob already exists
-            if filename in existing_blobs:
-                logger.info("Blob already exists, skipping file: %s", filename)
-            else:
-                logger.info("Uploading blob for file: %s", filename)
-                blob_client = container_client.upload_blob(filename, opened_file, overwrite=True)
+    files = {entry.name: entry.path for entry in os.scandir(data_dir) if entry.is_file()}
 
+    def upload(filename, path, content_hash):
+        with open(path, "rb") as opened_file:
+            container_client.upload_blob(filename, opened_file, overwrite=True, metadata={CONTENT_HASH_METADATA: content_hash}, max_concurrency=4)
+        return filename
+
+    changed = 0
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        hashes = dict(zip(files, executor.map(file_sha256, files.values())))
+        uploads = []
+        for filename, path in files.items():
+            if existing_hashes.get(filename) == hashes[filename]:
+                continue
+            logger.info("%s blob for file: %s", "Updating" if filename in existing_hashes else "Uploading", filename)
+            uploads.append(executor.submit(upload, filename, path, hashes[filename]))
+        deletions = []
+        if delete_removed:
+            for filename in existing_hashes.keys() - files.keys():
+                logger.info("Deleting blob without a local file: %s", filename)
+                deletions.append(executor.submit(container_client.delete_blob, filename))
+        for future in as_completed(uploads + deletions):
+            future.result()
+            changed += 1
+    logger.info("Blob sync done: %d files, %d uploaded or deleted, %d unchanged", len(files), changed, len(files) - len(uploads))
+
+    if changed == 0:
+        logger.info("No changes in %s, not starting the indexer", data_dir)
+        return
     # Start the indexer
     try:
         indexer_client.run_indexer(indexer_name)
@@ -235,7 +302,7 @@ if __name__ == "__main__":
     AZURE_OPENAI_EMBEDDING_ENDPOINT = os.environ["AZURE_OPENAI_ENDPOINT"]
     AZURE_OPENAI_EMBEDDING_DEPLOYMENT = os.environ["AZURE_OPENAI_EMBEDDING_DEPLOYMENT"]
     AZURE_OPENAI_EMBEDDING_MODEL = os.environ["AZURE_OPENAI_EMBEDDING_MODEL"]
-    EMBEDDINGS_DIMENSIONS = 3072
+    EMBEDDINGS_DIMENSIONS = int(os.environ.get("AZURE_SEARCH_VECTOR_DIMENSIONS") or 3072)
     AZURE_SEARCH_ENDPOINT = os.environ["AZURE_SEARCH_ENDPOINT"]
     AZURE_STORAGE_ENDPOINT = os.environ["AZURE_STORAGE_ENDPOINT"]
     AZURE_STORAGE_CONNECTION_STRING = os.environ["AZURE_STORAGE_CONNECTION_STRING"]
@@ -251,10 +318,21 @@ if __name__ == "__main__":
         azure_openai_embedding_endpoint=AZURE_OPENAI_EMBEDDING_ENDPOINT,
         azure_openai_embedding_deployment=AZURE_OPENAI_EMBEDDING_DEPLOYMENT,
         azure_openai_embedding_model=AZURE_OPENAI_EMBEDDING_MODEL,
-        azure_openai_embeddings_dimensions=EMBEDDINGS_DIMENSIONS)
+        azure_openai_embeddings_dimensions=EMBEDDINGS_DIMENSIONS,
+        hnsw_parameters=HnswParameters(
+            m=int(os.environ.get("AZURE_SEARCH_HNSW_M") or 4),
+            ef_construction=int(os.environ.get("AZURE_SEARCH_HNSW_EF_CONSTRUCTION") or 400),
+            ef_search=int(os.environ.get("AZURE_SEARCH_HNSW_EF_SEARCH") or 500),
+            metric=VectorSearchAlgorithmMetric.COSINE),
+        compression=vector_compression(
+            os.environ.get("AZURE_SEARCH_VECTOR_COMPRESSION"),
+            rerank_with_original_vectors=os.environ.get("AZURE_SEARCH_VECTOR_RERANK", "true") == "true",
+            oversampling=float(os.environ["AZURE_SEARCH_VECTOR_OVERSAMPLING"]) if os.environ.get("AZURE_SEARCH_VECTOR_OVERSAMPLING") else None))
 
     upload_documents(azure_credential,
         indexer_name=AZURE_SEARCH_INDEX,
         azure_search_endpoint=AZURE_SEARCH_ENDPOINT,
         azure_storage_endpoint=AZURE_STORAGE_ENDPOINT,
-        azure_storage_container=AZURE_STORAGE_CONTAINER)
\ No newline at end of file
+        azure_storage_container=AZURE_STORAGE_CONTAINER,
+        max_workers=int(os.environ.get("AZURE_STORAGE_UPLOAD_WORKERS") or 8),
+        delete_removed=os.environ.get("AZURE_STORAGE_SYNC_DELETE") == "true")
\ No newline at end of file
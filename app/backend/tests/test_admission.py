@@ -0,0 +1,64 @@
+import asyncio
+import sqlite3
+import sys
+import threading
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from admission import AdmissionController, SqliteSlotStore  # noqa: E402
+
+
+def test_shared_slots_are_taken_off_the_event_loop(tmp_path):
+    class RecordingStore(SqliteSlotStore):
+        threads = set()
+
+        def acquire(self, *args):
+            self.threads.add(threading.get_ident())
+            return super().acquire(*args)
+
+    async def run():
+        path = str(tmp_path / "slots.db")
+        first = AdmissionController(1, slots=RecordingStore(path, poll_interval=0.05))
+        second = AdmissionController(1, slots=RecordingStore(path, poll_interval=0.05))
+        admitted = await first.request()
+        waiting = await second.request()
+        assert admitted.admitted.done() and not waiting.admitted.done()
+        first.release(admitted)
+        await asyncio.wait_for(second.wait(waiting), 2)
+        second.release(waiting)
+        await first.close()
+        await second.close()
+
+    asyncio.run(run())
+    assert RecordingStore.threads and threading.get_ident() not in RecordingStore.threads
+
+
+def test_slots_that_fail_to_be_given_back_are_retried(tmp_path):
+    class LockedOnceStore(SqliteSlotStore):
+        failures = 1
+
+        def release(self, *args):
+            if self.failures:
+                self.failures -= 1
+                raise sqlite3.OperationalError("database is locked")
+            super().release(*args)
+
+    async def run():
+        path = str(tmp_path / "slots.db")
+        controller = AdmissionController(2, slots=LockedOnceStore(path, poll_interval=0.05))
+        controller.release_retry_interval = 0.05
+        first = await controller.request()
+        second = await controller.request()
+        controller.release(first)
+        controller.release(second)
+        await controller._dispatch()
+        assert controller.slots.count() == 1
+        for _ in range(40):
+            if controller.slots.count() == 0:
+                break
+            await asyncio.sleep(0.05)
+        assert controller.slots.count() == 0
+        await controller.close()
+
+    asyncio.run(run())
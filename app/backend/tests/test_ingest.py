@@ -0,0 +1,37 @@
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import ingest  # noqa: E402
+
+
+class FakeEncoding:
+    """Two characters per token"""
+
+    def encode_ordinary(self, text):
+        return [text[i:i + 2] for i in range(0, len(text), 2)]
+
+class FakeTiktoken:
+    @staticmethod
+    def get_encoding(name):
+        assert name == "fake"
+        return FakeEncoding()
+
+def test_chunks_are_measured_with_the_named_tokenizer(tmp_path, monkeypatch):
+    monkeypatch.setattr(ingest, "tiktoken", FakeTiktoken)
+    ingest.length_function.cache_clear()
+    document = tmp_path / "doc.txt"
+    document.write_text(" ".join(["word"] * 40), encoding="utf-8")
+
+    by_characters = ingest.document_chunks(str(document), max_length=50, overlap=0)
+    by_tokens = ingest.document_chunks(str(document), max_length=50, overlap=0, tokenizer="tiktoken:fake")
+    # "word " is 5 characters or 3 tokens
+    assert [len(c["chunk"].split()) for c in by_characters] == [10, 10, 10, 10]
+    assert [len(c["chunk"].split()) for c in by_tokens] == [16, 16, 8]
+
+def test_unknown_tokenizer_is_rejected():
+    with pytest.raises(ValueError):
+        ingest.length_function("sentencepiece:model")
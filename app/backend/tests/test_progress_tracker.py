@@ -0,0 +1,60 @@
+import asyncio
+import sys
+import time
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from progress_tracker import JsonlProgressStore, ProgressTracker  # noqa: E402
+
+
+def test_user_id_cannot_leave_storage_dir(tmp_path):
+    store = JsonlProgressStore(str(tmp_path / "progress"))
+    with pytest.raises(ValueError):
+        store.append("../escaped", [{"timestamp": "2024-01-01T00:00:00", "difficulty": "easy", "is_correct": True}])
+    assert not (tmp_path / "escaped.jsonl").exists()
+
+class FlakyStore(JsonlProgressStore):
+    """Fails the first `failures` appends"""
+
+    def __init__(self, storage_dir: str, failures: int):
+        super().__init__(storage_dir)
+        self.failures = failures
+
+    def append(self, user_id, interactions):
+        if self.failures:
+            self.failures -= 1
+            raise OSError("disk full")
+        super().append(user_id, interactions)
+
+def test_failed_writes_are_retried(tmp_path):
+    async def run():
+        tracker = ProgressTracker(store=FlakyStore(str(tmp_path), failures=1), flush_interval=0.01, recent_size=2)
+        for i in range(3):
+            tracker.save_interaction("student", f"q{i}", "a", "easy", True)
+        await asyncio.sleep(0.1)
+        await tracker.close()
+
+    asyncio.run(run())
+    stored = JsonlProgressStore(str(tmp_path))
+    assert [interaction["question"] for interaction in stored.recent("student", 10)] == ["q0", "q1", "q2"]
+
+def test_recent_interactions_include_writes_in_flight(tmp_path):
+    class SlowStore(JsonlProgressStore):
+        def append(self, user_id, interactions):
+            time.sleep(0.2)
+            super().append(user_id, interactions)
+
+    async def run():
+        tracker = ProgressTracker(store=SlowStore(str(tmp_path)), flush_interval=0.01, recent_size=2)
+        for i in range(3):
+            tracker.save_interaction("student", f"q{i}", "a", "easy", True)
+        await asyncio.sleep(0.1)
+        assert tracker._in_flight
+        questions = [interaction["question"] for interaction in tracker.get_recent_interactions("student", 5)]
+        await tracker.close()
+        return questions
+
+    assert asyncio.run(run()) == ["q0", "q1", "q2"]
@@ -0,0 +1,18 @@
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from quiz import quiz_question, score_answer  # noqa: E402
+
+
+def test_quiz_question_needs_every_field():
+    assert quiz_question({"question": " Why? ", "answer": "because", "difficulty": "Hard"}) == {
+        "question": "Why?", "answer": "because", "difficulty": "hard"}
+    assert quiz_question({"question": "Why?", "answer": "", "difficulty": "easy"}) is None
+    assert quiz_question({"question": "Why?", "answer": "because", "difficulty": "impossible"}) is None
+
+def test_spoken_answers_are_scored_by_significant_words():
+    assert score_answer("sunlight, water and air", "Um, it's air and sunlight and water!")
+    assert not score_answer("sunlight, water and air", "sunlight and meat")
+    assert score_answer("4", "it is four")
@@ -0,0 +1,141 @@
+import asyncio
+import json
+import sys
+from pathlib import Path
+
+import aiohttp
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+from azure.core.credentials import AzureKeyCredential
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from rtmt import RTMiddleTier, RTSession  # noqa: E402
+
+
+async def _relay(upstream_handler, client_session, configure=None, **query):
+    """Runs the middle tier in front of a mock realtime server and hands a connected client to client_session"""
+    upstream = web.Application()
+    upstream.router.add_get("/openai/realtime", upstream_handler)
+    async with TestServer(upstream) as upstream_server:
+        app = web.Application()
+        middle_tier = RTMiddleTier(str(upstream_server.make_url("")), "test", AzureKeyCredential("test"))
+        if configure is not None:
+            configure(middle_tier)
+        middle_tier.attach_to_app(app, "/realtime")
+        async with TestServer(app) as server, aiohttp.ClientSession() as http:
+            async with http.ws_connect(server.make_url("/realtime").with_query(query)) as ws:
+                return await client_session(ws)
+
+def test_upstream_close_closes_client():
+    async def upstream(request):
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+        await ws.send_str(json.dumps({"type": "session.created", "session": {}}))
+        await ws.close()
+        return ws
+
+    async def client(ws):
+        await ws.send_str(json.dumps({"type": "input_audio_buffer.append", "audio": "AA"}))
+        first = await asyncio.wait_for(ws.receive(), 2)
+        closing = await asyncio.wait_for(ws.receive(), 2)
+        return json.loads(first.data)["type"], closing.type, ws.close_code
+
+    event_type, closing_type, close_code = asyncio.run(_relay(upstream, client))
+    assert event_type == "session.created"
+    assert closing_type in (aiohttp.WSMsgType.CLOSE, aiohttp.WSMsgType.CLOSED)
+    assert close_code == aiohttp.WSCloseCode.OK
+
+def test_client_close_closes_upstream():
+    async def run():
+        closed = asyncio.Event()
+
+        async def upstream(request):
+            ws = web.WebSocketResponse()
+            await ws.prepare(request)
+            async for _ in ws:
+                pass
+            closed.set()
+            return ws
+
+        async def client(ws):
+            await ws.send_str(json.dumps({"type": "input_audio_buffer.append", "audio": "AA"}))
+            await ws.close()
+            await asyncio.wait_for(closed.wait(), 2)
+
+        await _relay(upstream, client)
+
+    asyncio.run(run())
+
+def test_invalid_user_id_is_rejected():
+    async def upstream(request):
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+        await ws.send_str(json.dumps({"type": "session.created", "session": {}}))
+        async for _ in ws:
+            pass
+        return ws
+
+    async def client(ws):
+        await asyncio.wait_for(ws.receive(), 2)
+        return ws.close_code
+
+    assert asyncio.run(_relay(upstream, client, user_id="../escaped")) == aiohttp.WSCloseCode.POLICY_VIOLATION
+
+def test_quiz_answers_are_scored_against_the_recorded_question():
+    question = {"question": "What do plants need?", "answer": "sunlight and water", "difficulty": "easy"}
+    call = {"type": "function_call", "name": "record_quiz_question", "call_id": "call", "arguments": json.dumps(question)}
+
+    async def upstream(request):
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+        await ws.send_str(json.dumps({"type": "conversation.item.created", "previous_item_id": "item", "item": call}))
+        await ws.send_str(json.dumps({"type": "response.output_item.done", "item": call}))
+        await ws.send_str(json.dumps({"type": "response.done", "response": {"output": [call]}}))
+        async for msg in ws:
+            event = json.loads(msg.data)
+            if event["type"] == "conversation.item.create":
+                assert event["item"]["call_id"] == "call"
+            elif event["type"] == "response.create":
+                # The response asking the question, then the student's answer
+                await ws.send_str(json.dumps({"type": "response.done", "response": {"output": []}}))
+                await ws.send_str(json.dumps({"type": "conversation.item.input_audio_transcription.completed",
+                                              "transcript": "Sunlight and water!"}))
+        return ws
+
+    class Tracker:
+        def __init__(self):
+            self.recorded = asyncio.Event()
+
+        def record_interaction(self, *args):
+            self.args = args
+            self.recorded.set()
+
+        async def close(self, _app=None):
+            pass
+
+    async def run():
+        tracker = Tracker()
+
+        async def client(ws):
+            await asyncio.wait_for(tracker.recorded.wait(), 2)
+
+        def configure(middle_tier):
+            middle_tier.progress_tracker = tracker
+            middle_tier.attach_quiz_tool()
+        await _relay(upstream, client, configure, user_id="student")
+        return tracker.args
+
+    assert asyncio.run(run()) == ("student", "What do plants need?", "sunlight and water", "easy", True)
+
+def test_progress_is_not_recorded_without_a_user_id():
+    class Tracker:
+        def record_interaction(self, *args):
+            raise AssertionError("recorded without a user_id")
+
+    middle_tier = RTMiddleTier("http://localhost", "test", AzureKeyCredential("test"))
+    middle_tier.progress_tracker = Tracker()
+    rt_session = RTSession(None)
+    rt_session.current_question = {"question": "Why?", "answer": "because", "difficulty": "easy"}
+    middle_tier._score_answer(rt_session, "because")
+    assert rt_session.current_question is None
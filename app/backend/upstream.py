@@ -0,0 +1,75 @@
+import logging
+import time
+from types import SimpleNamespace
+from typing import Any
+
+import aiohttp
+
+logger = logging.getLogger("voicerag")
+
+class UpstreamStats:
+    """Connection setup metrics for the realtime API, fed by aiohttp client tracing"""
+
+    def __init__(self):
+        self.sessions_started = 0
+        self.session_failures = 0
+        self.session_start_seconds_total = 0.0
+        self.session_start_seconds_max = 0.0
+        self.connections_created = 0
+        self.connection_create_seconds_total = 0.0
+        self.connections_reused = 0
+        self.dns_resolutions = 0
+        self.dns_resolve_seconds_total = 0.0
+        self.dns_cache_hits = 0
+
+    def observe_session_start(self, seconds: float):
+        self.sessions_started += 1
+        self.session_start_seconds_total += seconds
+        self.session_start_seconds_max = max(self.session_start_seconds_max, seconds)
+
+    def snapshot(self) -> dict[str, Any]:
+        return {
+            **vars(self),
+            "session_start_seconds_avg": self.session_start_seconds_total / self.sessions_started if self.sessions_started else 0
+        }
+
+    def trace_config(self) -> aiohttp.TraceConfig:
+        trace_config = aiohttp.TraceConfig()
+
+        async def on_connection_create_start(session, context: SimpleNamespace, params):
+            context.connection_started_at = time.perf_counter()
+
+        async def on_connection_create_end(session, context: SimpleNamespace, params):
+            self.connections_created += 1
+            self.connection_create_seconds_total += time.perf_counter() - context.connection_started_at
+
+        async def on_connection_reuseconn(session, context, params):
+            self.connections_reused += 1
+
+        async def on_dns_resolvehost_start(session, context: SimpleNamespace, params):
+            context.dns_started_at = time.perf_counter()
+
+        async def on_dns_resolvehost_end(session, context: SimpleNamespace, params):
+            self.dns_resolutions += 1
+            self.dns_resolve_seconds_total += time.perf_counter() - context.dns_started_at
+
+        async def on_dns_cache_hit(session, context, params):
+            self.dns_cache_hits += 1
+
+        trace_config.on_connection_create_start.append(on_connection_create_start)
+        trace_config.on_connection_create_end.append(on_connection_create_end)
+        trace_config.on_connection_reuseconn.append(on_connection_reuseconn)
+        trace_config.on_dns_resolvehost_start.append(on_dns_resolvehost_start)
+        trace_config.on_dns_resolvehost_end.append(on_dns_resolvehost_end)
+        trace_config.on_dns_cache_hit.append(on_dns_cache_hit)
+        return trace_config
+
+def create_upstream_session(base_url: str, stats: UpstreamStats, connection_limit: int = 0, dns_cache_ttl: int = 300,
+                            keepalive_timeout: float = 30) -> aiohttp.ClientSession:
+    """One session for the lifetime of the app, so DNS lookups, TLS contexts and idle connections are shared by all sockets"""
+    connector = aiohttp.TCPConnector(
+        limit=connection_limit,
+        ttl_dns_cache=dns_cache_ttl,
+        keepalive_timeout=keepalive_timeout,
+        enable_cleanup_closed=True)
+    return aiohttp.ClientSession(base_url=base_url, connector=connector, trace_configs=[stats.trace_config()])
@@ -22,6 +22,7 @@ function App() {
     const [groundingFiles, setGroundingFiles] = useState<GroundingFile[]>([]);
     const [selectedFile, setSelectedFile] = useState<GroundingFile | null>(null);
     const [currentTranscript, setCurrentTranscript] = useState<string>("");
+    const [queuePosition, setQueuePosition] = useState(0);
 
     const { startSession, addUserAudio, inputAudioBufferClear } = useRealTime({
         onWebSocketOpen: () => console.log("WebSocket connection opened"),
@@ -51,6 +52,9 @@ function App() {
         },
         onReceivedInputAudioBufferSpeechEnded: () => {
             setCurrentTranscript("");
+        },
+        onReceivedExtensionQueuePosition: message => {
+            setQueuePosition(message.position);
         }
     });
 
@@ -68,6 +72,7 @@ function App() {
             await stopAudioRecording();
             stopAudioPlayer();
             inputAudioBufferClear();
+            setQueuePosition(0);
             setIsRecording(false);
         }
     };
@@ -130,7 +135,7 @@ function App() {
                         </div>
 
                         <div className="mt-16">
-                            <StatusMessage isRecording={isRecording} transcript={currentTranscript} />
+                            <StatusMessage isRecording={isRecording} queuePosition={queuePosition} transcript={currentTranscript} />
                         </div>
                     </motion.div>
 
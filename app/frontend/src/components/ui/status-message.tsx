@@ -6,10 +6,11 @@ import ReactMarkdown from "react-markdown";
 
 type Properties = {
     isRecording: boolean;
+    queuePosition?: number;
     transcript?: string;
 };
 
-export default function StatusMessage({ isRecording, transcript }: Properties) {
+export default function StatusMessage({ isRecording, queuePosition = 0, transcript }: Properties) {
     const { t } = useTranslation();
     const scrollRef = useRef<HTMLDivElement>(null);
 
@@ -45,7 +46,9 @@ export default function StatusMessage({ isRecording, transcript }: Properties) {
                                 ))}
                             </div>
                         </div>
-                        <p className="ml-2 text-gray-700">{t("status.conversationInProgress")}</p>
+                        <p className="ml-2 text-gray-700">
+                            {queuePosition > 0 ? t("status.waitingInQueue", { position: queuePosition }) : t("status.conversationInProgress")}
+                        </p>
                     </motion.div>
                 ) : (
                     <motion.p
@@ -9,6 +9,7 @@ import {
     ResponseDone,
     SessionUpdateCommand,
     ExtensionMiddleTierToolResponse,
+    ExtensionQueuePosition,
     ResponseInputAudioTranscriptionCompleted,
     TranscriptMessage,
     TextDeltaMessage
@@ -30,6 +31,7 @@ type Parameters = {
     onReceivedInputAudioBufferSpeechStarted?: (message: Message) => void;
     onReceivedResponseDone?: (message: ResponseDone) => void;
     onReceivedExtensionMiddleTierToolResponse?: (message: ExtensionMiddleTierToolResponse) => void;
+    onReceivedExtensionQueuePosition?: (message: ExtensionQueuePosition) => void;
     onReceivedResponseAudioTranscriptDelta?: (message: ResponseAudioTranscriptDelta) => void;
     onReceivedInputAudioTranscriptionCompleted?: (message: ResponseInputAudioTranscriptionCompleted) => void;
     onReceivedError?: (message: Message) => void;
@@ -53,6 +55,7 @@ export default function useRealTime({
     onReceivedResponseAudioTranscriptDelta,
     onReceivedInputAudioBufferSpeechStarted,
     onReceivedExtensionMiddleTierToolResponse,
+    onReceivedExtensionQueuePosition,
     onReceivedInputAudioTranscriptionCompleted,
     onReceivedError,
     onReceivedInputAudioBufferTranscript,
@@ -146,6 +149,9 @@ export default function useRealTime({
             case "extension.middle_tier_tool_response":
                 onReceivedExtensionMiddleTierToolResponse?.(message as ExtensionMiddleTierToolResponse);
                 break;
+            case "extension.queue_position":
+                onReceivedExtensionQueuePosition?.(message as ExtensionQueuePosition);
+                break;
             case "error":
                 onReceivedError?.(message);
                 break;
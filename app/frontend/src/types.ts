@@ -69,6 +69,12 @@ export type ExtensionMiddleTierToolResponse = {
     tool_result: string; // JSON string that needs to be parsed into ToolResult
 };
 
+export type ExtensionQueuePosition = {
+    type: "extension.queue_position";
+    position: number; // 0 once the session is admitted
+    queue_length: number;
+};
+
 export type ToolResult = {
     sources: { chunk_id: string; title: string; chunk: string }[];
 };